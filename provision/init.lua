@@ -743,6 +743,48 @@ queue.urgent = function(space, tube, delayed, ...)
     return put_task(space, tube, ipri, delayed, ...)
 end
 
+local function take_ready_task(space, tube)
+    local iterator = box.space[space].index[idx_tube]
+                            :iterator(box.index.EQ, tube, ST_READY)
+
+    for task in iterator do
+        local now = box.time64()
+        local created = box.unpack('l', task[i_created])
+        local ttr = box.unpack('l', task[i_ttr])
+        local ttl = box.unpack('l', task[i_ttl])
+        local event = now + ttr
+        if event > created + ttl then
+            event = created + ttl
+            -- tube started too late
+            if event <= now then
+                return
+            end
+        end
+
+
+        task = box.update(space,
+            task[i_uuid],
+                '=p=p=p+p',
+                i_status,
+                ST_TAKEN,
+
+                i_event,
+                event,
+
+                i_cid,
+                box.session.id(),
+
+                i_ctaken,
+                1
+        )
+
+        queue.workers[space][tube].ch:put(true, 0)
+        queue.consumers[space][tube]:put(true, 0)
+        queue.stat[space][tube]:inc('take')
+        return task
+    end
+end
+
 -- queue.take(space, tube, timeout)
 -- take task for processing
 queue.take = function(space, tube, timeout)
@@ -762,43 +804,8 @@ queue.take = function(space, tube, timeout)
 
     while true do
 
-        local iterator = box.space[space].index[idx_tube]
-                                :iterator(box.index.EQ, tube, ST_READY)
-
-        for task in iterator do
-            local now = box.time64()
-            local created = box.unpack('l', task[i_created])
-            local ttr = box.unpack('l', task[i_ttr])
-            local ttl = box.unpack('l', task[i_ttl])
-            local event = now + ttr
-            if event > created + ttl then
-                event = created + ttl
-                -- tube started too late
-                if event <= now then
-                    break
-                end
-            end
-
-
-            task = box.update(space,
-                task[i_uuid],
-                    '=p=p=p+p',
-                    i_status,
-                    ST_TAKEN,
-
-                    i_event,
-                    event,
-
-                    i_cid,
-                    box.session.id(),
-
-                    i_ctaken,
-                    1
-            )
-
-            queue.workers[space][tube].ch:put(true, 0)
-            queue.consumers[space][tube]:put(true, 0)
-            queue.stat[space][tube]:inc('take')
+        local task = take_ready_task(space, tube)
+        if task ~= nil then
             return rettask(task)
         end
 
@@ -816,6 +823,33 @@ queue.take = function(space, tube, timeout)
     end
 end
 
+-- queue.take_batch(space, tube, count, timeout)
+--  take up to count tasks for processing in one call.
+--  waits (like queue.take) only for the first task, the rest
+--  are taken only if they are ready right now.
+queue.take_batch = function(space, tube, count, timeout)
+    space = tonumber(space)
+    count = tonumber(count)
+    if count == nil or count <= 0 then
+        return
+    end
+
+    local task = queue.take(space, tube, timeout)
+    if task == nil then
+        return
+    end
+
+    local tasks = { task }
+    while #tasks < count do
+        task = take_ready_task(space, tube)
+        if task == nil then
+            break
+        end
+        table.insert(tasks, rettask(task))
+    end
+    return unpack(tasks)
+end
+
 
 -- queue.delete(space, id)
 --  deletes task from queue
@@ -831,10 +865,7 @@ queue.delete = function(space, id)
 end
 
 
--- queue.ack(space, id)
---  done task processing (task will be deleted)
-queue.ack = function(space, id)
-    space = tonumber(space)
+local function select_taken_task(space, id)
     local task = box.select(space, idx_task, id)
     if task == nil then
         error('Task not found')
@@ -847,12 +878,83 @@ queue.ack = function(space, id)
     if box.unpack('i', task[i_cid]) ~= box.session.id() then
         error('Only consumer that took the task can it ack')
     end
+    return task
+end
+
+
+-- queue.ack(space, id)
+--  done task processing (task will be deleted)
+queue.ack = function(space, id)
+    space = tonumber(space)
+    local task = select_taken_task(space, id)
 
     queue.stat[space][ task[i_tube] ]:inc('ack')
     return rettask(box.delete(space, id))
 end
 
 
+local function call_many(method, space, ...)
+    local errors = {}
+    for i = 1, select('#', ...) do
+        local id = select(i, ...)
+        local ok, err = pcall(method, space, id)
+        if not ok then
+            table.insert(errors, { id, tostring(err) })
+        end
+    end
+    return unpack(errors)
+end
+
+
+-- queue.ack_many(space, id, ...)
+--  ack several tasks in one call
+--  returns {id, error} for every task that was not acked
+queue.ack_many = function(space, ...)
+    return call_many(queue.ack, space, ...)
+end
+
+
+-- queue.put_ack(space, id, put_space, tube, delay, ttl, ttr, pri, ...)
+--  put task into tube of put_space (like queue.put) and ack taken
+--  task id in one call. nothing is put if the task can not be acked.
+--  empty pri means priority of the acked task (as queue.meta returns it).
+--  returns the new task
+queue.put_ack = function(space, id, put_space, tube, delay, ttl, ttr, pri, ...)
+    space = tonumber(space)
+    put_space = tonumber(put_space)
+    local task = select_taken_task(space, id)
+
+    if pri == nil or pri == '' then
+        pri = pri_unpack(task[i_pri])
+    end
+
+    queue.stat[put_space][tube]:inc('put')
+    local new_task = put_task(put_space, tube, queue.default.ipri, delay, ttl, ttr, pri, ...)
+
+    -- the task is deleted even if it was released while the new one was
+    -- inserted: its result is already in the queue
+    queue.stat[space][ task[i_tube] ]:inc('ack')
+    box.delete(space, id)
+    return new_task
+end
+
+
+-- queue.put_ack_many(space, id, put_space, tube, delay, ttl, ttr, pri, data, ...)
+--  queue.put_ack for several tasks with one data field each in one call
+--  returns {id, error} for every task that was not acked
+queue.put_ack_many = function(space, ...)
+    local errors = {}
+    for i = 1, select('#', ...), 8 do
+        local id, put_space, tube, delay, ttl, ttr, pri, data = select(i, ...)
+        local ok, err = pcall(queue.put_ack, space, id, put_space, tube, delay, ttl, ttr, pri, data)
+        if not ok then
+            table.insert(errors, { id, tostring(err) })
+        end
+    end
+    return unpack(errors)
+end
+
+
 -- queue.touch(space, id)
 --  prolong ttr for taken task
 queue.touch = function(space, id)
@@ -958,6 +1060,13 @@ queue.bury = function(space, id)
     return rettask(task)
 end
 
+-- queue.bury_many(space, id, ...)
+--  bury several tasks in one call
+--  returns {id, error} for every task that was not buried
+queue.bury_many = function(space, ...)
+    return call_many(queue.bury, space, ...)
+end
+
 -- queue.dig(space, id)
 --  dig(unbury) task
 queue.dig = function(space, id)
@@ -1122,6 +1231,75 @@ queue.release = function(space, id, delay, ttl)
 end
 
 
+-- queue.release_many(space, id, ...)
+--  release several tasks in one call
+--  returns {id, error} for every task that was not released
+queue.release_many = function(space, ...)
+    return call_many(queue.release, space, ...)
+end
+
+-- queue.postpone(space, id, delay)
+--  release taken task with delay, the take is not counted
+--  as an attempt (ctaken is not increased)
+queue.postpone = function(space, id, delay)
+    space = tonumber(space)
+    queue.release(space, id, delay)
+
+    local task = box.select(space, idx_task, id)
+    local ctaken = tonumber(box.unpack('l', task[i_ctaken]))
+    if ctaken > 0 then
+        task = box.update(space, id, '=p', i_ctaken, box.pack('l', ctaken - 1))
+    end
+    return rettask(task)
+end
+
+-- queue.postpone_many(space, delay, id, ...)
+--  postpone several tasks in one call
+--  returns {id, error} for every task that was not postponed
+queue.postpone_many = function(space, delay, ...)
+    local postpone = function(space, id)
+        return queue.postpone(space, id, delay)
+    end
+    return call_many(postpone, space, ...)
+end
+
+-- queue.retry(space, id, max_attempts, base_delay, max_delay)
+--  release taken task with exponential backoff:
+--  delay = base_delay * 2 ^ (attempt - 1) (no more than max_delay)
+--  with random jitter in [delay / 2, delay], attempt - how many times
+--  the task was taken. Buries the task after max_attempts attempts.
+queue.retry = function(space, id, max_attempts, base_delay, max_delay)
+    space = tonumber(space)
+    local task = box.select(space, idx_task, id)
+    if task == nil then
+        error('Task not found')
+    end
+
+    local attempt = tonumber(box.unpack('l', task[i_ctaken]))
+    if attempt >= tonumber(max_attempts) then
+        return queue.bury(space, id)
+    end
+
+    local delay = tonumber(base_delay) * math.pow(2, attempt - 1)
+    if delay > tonumber(max_delay) then
+        delay = tonumber(max_delay)
+    end
+    delay = delay / 2 + math.random() * delay / 2
+
+    return queue.release(space, id, delay)
+end
+
+-- queue.retry_many(space, max_attempts, base_delay, max_delay, id, ...)
+--  retry several tasks in one call
+--  returns {id, error} for every task that was not retried
+queue.retry_many = function(space, max_attempts, base_delay, max_delay, ...)
+    local retry = function(space, id)
+        return queue.retry(space, id, max_attempts, base_delay, max_delay)
+    end
+    return call_many(retry, space, ...)
+end
+
+
 -- queue.requeue(space, id)
 --  marks task as ready and push it at end of queue
 queue.requeue = function(space, id)
@@ -14,6 +14,9 @@ from source.tests.test_redirect_checker import RedirectCheckerTestCase
 from source.tests.test_lib__init import LibInitTestCase
 from source.tests.test_lib_utils import LibUtilsTestCase
 from source.tests.test_lib_worker import LibWorkerTestCase
+from source.tests.test_lib_log import LibLogTestCase
+from source.tests.test_lib_engine import LibEngineTestCase
+from source.tests.test_lib_cache import LibCacheTestCase
 
 @contextmanager
 def mocked_connection():
@@ -31,7 +34,10 @@ if __name__ == '__main__':
         unittest.makeSuite(RedirectCheckerTestCase),
         unittest.makeSuite(LibInitTestCase),
         unittest.makeSuite(LibUtilsTestCase),
-        unittest.makeSuite(LibWorkerTestCase)
+        unittest.makeSuite(LibWorkerTestCase),
+        unittest.makeSuite(LibLogTestCase),
+        unittest.makeSuite(LibEngineTestCase),
+        unittest.makeSuite(LibCacheTestCase)
     ))
     with mocked_connection():
         result = unittest.TextTestRunner().run(suite)
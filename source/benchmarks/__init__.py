@@ -0,0 +1,16 @@
+# coding: utf-8
+import timeit
+
+MILLISECONDS = 10 ** 3
+MICROSECONDS = 10 ** 6
+
+
+def measure(func, args=(), number=10, unit=MICROSECONDS):
+    """
+    Возвращает время одного вызова func(*args): лучшее из трех повторов по number вызовов.
+
+    :param unit: количество единиц времени результата в секунде (MILLISECONDS, MICROSECONDS)
+    :rtype: float
+    """
+    seconds = min(timeit.repeat(lambda: func(*args), number=number, repeat=3))
+    return seconds / number * unit
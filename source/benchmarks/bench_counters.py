@@ -0,0 +1,58 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Сравнение поиска счетчиков на странице в get_counters.
+
+Старый способ (re.match с шаблоном '.*счетчик.*' для каждого типа счетчика)
+сравнивается с get_counters на страницах разного размера.
+
+Запуск из корня проекта: python -m source.benchmarks.bench_counters
+"""
+
+import re
+
+from source.benchmarks import MILLISECONDS, measure
+from source.lib import COUNTER_TYPES, get_counters
+
+NUMBER = 10
+
+REGEXPS = tuple(
+    (name, re.compile(r'.*' + re.escape(needle) + r'.*', re.I + re.S)) for name, needle in COUNTER_TYPES
+)
+
+BLOCK = (
+    '<div class="item"><a href="/item?id=1&amp;ref=main" title="\xd0\xa2\xd0\xbe\xd0\xb2\xd0\xb0\xd1\x80">'
+    '<img src="/img/1.png" alt=""></a><p>\xd0\x9e\xd0\xbf\xd0\xb8\xd1\x81\xd0\xb0\xd0\xbd\xd0\xb8\xd0\xb5 '
+    '<b>\xd1\x82\xd0\xbe\xd0\xb2\xd0\xb0\xd1\x80\xd0\xb0</b></p></div>\n'
+)
+
+COUNTERS = (
+    '<script src="//mc.yandex.ru/metrika/watch.js"></script>'
+    '<img src="//top-fwz1.mail.ru/counter?id=1">'
+)
+
+
+def regexps_get_counters(content):
+    counters = []
+    for counter_name, regexp in REGEXPS:
+        if re.match(regexp, content):
+            counters.append(counter_name)
+    return counters
+
+
+def make_page(size):
+    return BLOCK * (size / len(BLOCK)) + COUNTERS
+
+
+def run(content):
+    baseline = measure(regexps_get_counters, (content,), NUMBER, MILLISECONDS)
+    spent = measure(get_counters, (content,), NUMBER, MILLISECONDS)
+    print '  re.match: {baseline:.3f} ms/page, get_counters: {spent:.3f} ms/page, x{speedup:.0f}'.format(
+        baseline=baseline, spent=spent, speedup=baseline / spent
+    )
+
+
+if __name__ == '__main__':
+    for size in (10 * 1024, 100 * 1024, 1024 * 1024):
+        print 'Page of {size} KB:'.format(size=size / 1024)
+        run(make_page(size))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Сравнение поиска мета-редиректа в check_for_meta.
+
+Разбор страницы BeautifulSoup (find_meta_attrs_soup) сравнивается с find_meta_attrs
+на страницах разного размера с мета-редиректом и без него.
+
+Запуск из корня проекта: python -m source.benchmarks.bench_meta_scanner
+"""
+
+from source.benchmarks import MILLISECONDS, measure
+from source.lib import check_for_meta, find_meta_attrs, find_meta_attrs_soup
+
+NUMBER = 20
+
+URL = 'http://first.com/'
+
+META = '<meta http-equiv="refresh" content="0; url=http://second.com/">'
+
+HEAD = (
+    '<!DOCTYPE html><html><head><title>\xd0\xa1\xd1\x82\xd1\x80\xd0\xb0\xd0\xbd\xd0\xb8\xd1\x86\xd0\xb0</title>'
+    '<link rel="stylesheet" href="/style.css"><script>var config = {"a": 1, "b": [1, 2, 3]};</script>'
+)
+
+BLOCK = (
+    '<div class="item"><a href="/item?id=1&amp;ref=main" title="\xd0\xa2\xd0\xbe\xd0\xb2\xd0\xb0\xd1\x80">'
+    '<img src="/img/1.png" alt=""></a><p>\xd0\x9e\xd0\xbf\xd0\xb8\xd1\x81\xd0\xb0\xd0\xbd\xd0\xb8\xd0\xb5 '
+    '<b>\xd1\x82\xd0\xbe\xd0\xb2\xd0\xb0\xd1\x80\xd0\xb0</b></p></div>\n'
+)
+
+
+def make_page(size, head_meta='', body_meta=''):
+    return ''.join((
+        HEAD,
+        head_meta,
+        '</head><body>',
+        BLOCK * (size / len(BLOCK)),
+        body_meta,
+        '</body></html>',
+    ))
+
+
+PAGES = (
+    ('redirect page, meta in head', make_page(0, head_meta=META)),
+    ('100 KB page, meta in head', make_page(100 * 1024, head_meta=META)),
+    ('100 KB page, no meta', make_page(100 * 1024)),
+    ('100 KB page, meta at the end of body', make_page(100 * 1024, body_meta=META)),
+    ('100 KB page, meta only in a comment at the end', make_page(100 * 1024, body_meta='<!-- ' + META + ' -->')),
+    ('1 MB page, meta in head', make_page(1024 * 1024, head_meta=META)),
+)
+
+
+def run(content):
+    assert find_meta_attrs(content) == find_meta_attrs_soup(content)
+
+    baseline = measure(find_meta_attrs_soup, (content,), NUMBER, MILLISECONDS)
+    spent = measure(find_meta_attrs, (content,), NUMBER, MILLISECONDS)
+    print '  BeautifulSoup: {baseline:.3f} ms/page, find_meta_attrs: {spent:.3f} ms/page, x{speedup:.0f}'.format(
+        baseline=baseline, spent=spent, speedup=baseline / spent
+    )
+    print '  check_for_meta: {time:.3f} ms/page'.format(time=measure(check_for_meta, (content, URL), NUMBER, MILLISECONDS))
+
+
+if __name__ == '__main__':
+    for name, page in PAGES:
+        print '{name} ({size} bytes):'.format(name=name, size=len(page))
+        run(page)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Сравнение нормализации урлов в prepare_url.
+
+Старый способ (разбор и сборка каждого урла в normalize_url) сравнивается с prepare_url
+на наборах урлов, похожих на урлы из цепочек редиректов: уже нормализованные урлы
+с utm-метками, кириллические домены и урлы с пробелами. Урлы повторяются, как и
+в очереди, где одни и те же рекламные ссылки проверяются много раз.
+
+Запуск из корня проекта: python -m source.benchmarks.bench_prepare_url
+"""
+
+import source.lib
+from source.benchmarks import measure
+from source.lib import normalize_url, prepare_url
+
+NUMBER = 10
+REPEATS = 20
+
+NORMALIZED = [
+    'http://www.example{0}.ru/catalog/item-{0}.html?utm_source=target&utm_medium=cpc&utm_campaign={0}',
+    'https://ad.adriver.ru/cgi-bin/click.cgi?sid=1&bt=2&ad={0}&pid={0}&bid=3&bn={0}&rnd=123456',
+    'http://top-fwz1.mail.ru/counter?id={0};js=na',
+    'https://my.shop{0}.com/promo/',
+]
+
+UNICODE = [
+    u'http://магазин{0}.рф/каталог/',
+    u'http://www.example{0}.ru/поиск?q=товар',
+]
+
+SPACES = [
+    'http://www.example{0}.ru/some path/{0} .html',
+]
+
+
+def make_urls(templates, distinct=100):
+    urls = [template.format(i) for template in templates for i in xrange(distinct)]
+    return urls * REPEATS
+
+
+def run(urls):
+    def measure_urls(func):
+        def loop():
+            for url in urls:
+                func(url)
+        return measure(loop, number=NUMBER) / len(urls)
+
+    source.lib.prepared_urls.clear()
+    baseline = measure_urls(normalize_url)
+    spent = measure_urls(prepare_url)
+    print '  normalize_url: {baseline:.2f} us/url, prepare_url: {spent:.2f} us/url, x{speedup:.0f}'.format(
+        baseline=baseline, spent=spent, speedup=baseline / spent
+    )
+
+
+if __name__ == '__main__':
+    for name, templates in (('normalized', NORMALIZED), ('unicode', UNICODE), ('spaces', SPACES),
+                            ('mixed', NORMALIZED + UNICODE + SPACES)):
+        print '{name} urls:'.format(name=name)
+        run(make_urls(templates))
@@ -0,0 +1,60 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Сравнение сериализации тела уведомления в notification_pusher.
+
+Старый способ (копия task.data + json.dumps) сравнивается с serialize_payload
+для каждого доступного JSON-кодировщика.
+
+Запуск из корня проекта: python -m source.benchmarks.bench_pusher_payload
+"""
+
+import json
+
+from mock import Mock
+
+from source.benchmarks import measure
+from source.notification_pusher import get_json_encoder, serialize_payload
+
+NUMBER = 10000
+
+ENCODERS = ('ujson', 'simplejson', 'json')
+
+
+def make_task(fields):
+    data = dict(
+        ('field_{number}'.format(number=number), {'value': number, 'title': u'Значение', 'tags': ['a', 'b', 'c']})
+        for number in xrange(fields)
+    )
+    data['callback_url'] = 'http://partner.example.com/callback/'
+    return Mock(task_id=42, data=data)
+
+
+def copy_and_dumps(task):
+    data = task.data.copy()
+    data.pop('callback_url')
+    data['id'] = task.task_id
+    return json.dumps(data)
+
+
+def run(task):
+    baseline = measure(copy_and_dumps, (task,), NUMBER)
+    print '  copy + json.dumps: {time:.1f} us/task'.format(time=baseline)
+
+    for name in ENCODERS:
+        try:
+            dumps = get_json_encoder([name])
+        except ImportError:
+            print '  {name}: not installed'.format(name=name)
+            continue
+
+        spent = measure(serialize_payload, (task, dumps), NUMBER)
+        print '  serialize_payload + {name}: {time:.1f} us/task, saved {saved:.1f} us/task'.format(
+            name=name, time=spent, saved=baseline - spent
+        )
+
+
+if __name__ == '__main__':
+    for fields in (5, 50, 500):
+        print 'Payload with {fields} fields:'.format(fields=fields)
+        run(make_task(fields))
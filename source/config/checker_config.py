@@ -13,15 +13,28 @@ OUTPUT_QUEUE_SPACE = 0
 OUTPUT_QUEUE_TUBE = 'url_redirect.queue'
 
 WORKER_POOL_SIZE = 10
+# more than 1 runs that many worker loops as greenlets in each worker process
+WORKER_GREENLETS = 1
 QUEUE_TAKE_TIMEOUT = 0.1
+# max tasks taken and results sent in one queue request
+QUEUE_BATCH_SIZE = 10
+# ttr of input tasks (queue.default.ttr in init.lua). At most QUEUE_TASK_TTR // (MAX_REDIRECTS * HTTP_TIMEOUT)
+# tasks are taken at once, so with the defaults below (60 // 90) prefetching is disabled and
+# tasks are taken one by one; results are still sent in batches of QUEUE_BATCH_SIZE
+QUEUE_TASK_TTR = 60
 
 SLEEP = 10
 
 HTTP_TIMEOUT = 3
 MAX_REDIRECTS = 30
+MAX_BODY_BYTES = 1024 * 1024
 RECHECK_DELAY = 300
 USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/31.0.1650.63 Safari/537.36"
 
+REDIRECT_CACHE_SIZE = 10000
+REDIRECT_CACHE_TTL = 300
+REDIRECT_CACHE_SHARED = False
+
 CHECK_URL = "http://t.mail.ru"
 
 LOGGING = {
@@ -33,7 +46,7 @@ LOGGING = {
     },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
+            'class': 'lib.log.AsyncStreamHandler',
             'level': 'DEBUG',
             'stream': getwriter('utf-8')(sys.stderr),
             'formatter': 'basic'
@@ -7,11 +7,42 @@ QUEUE_SPACE = 0
 QUEUE_TAKE_TIMEOUT = 0.1
 QUEUE_TUBE = 'api.push_notifications'
 
-HTTP_CONNECTION_TIMEOUT = 30
+HTTP_CONNECT_TIMEOUT = 3
+HTTP_READ_TIMEOUT = 10
+HTTP_TASK_DEADLINE = 30
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 10
+HTTP_POOL_BLOCK = True
+HTTP_KEEP_ALIVE = True
+JSON_ENCODERS = ['json']
 SLEEP = 0.1
 SLEEP_ON_FAIL = 10
+DRAIN_TIMEOUT = 10
+PROCESS_RESTART_BASE_DELAY = 1
+PROCESS_RESTART_MAX_DELAY = 60
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9101
 
 WORKER_POOL_SIZE = 10
+WORKER_POOL_MIN_SIZE = 2
+WORKER_POOL_MAX_SIZE = 100
+WORKER_POOL_ADJUST_INTERVAL = 10
+WORKER_POOL_MAX_ERROR_RATE = 0.5
+
+HOST_CONCURRENCY_LIMIT = 5
+HOST_CONCURRENCY_LIMITS = {}
+SCHEDULER_BACKLOG_SIZE = 10
+HOST_BACKLOG_SIZE = 5
+HOST_BACKLOG_POSTPONE_DELAY = 5
+
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 10
+RETRY_MAX_DELAY = 600
+
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+CIRCUIT_BREAKER_POSTPONE_DELAY = 10
 
 LOGGING = {
     'version': 1,
@@ -22,7 +53,7 @@ LOGGING = {
     },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
+            'class': 'lib.log.AsyncStreamHandler',
             'level': 'DEBUG',
             'stream': getwriter('utf-8')(sys.stderr),
             'formatter': 'basic'
@@ -1,7 +1,10 @@
 # coding: utf-8
+from HTMLParser import HTMLParser, HTMLParseError
 from StringIO import StringIO
 from logging import getLogger, NullHandler
+import os
 import re
+from string import ascii_lowercase, ascii_uppercase, maketrans
 from urllib import quote, quote_plus
 from urlparse import urljoin, urlsplit, urlparse, urlunparse
 
@@ -18,17 +21,37 @@ OK_REDIRECT = re.compile(r'http://(www\.)?odnoklassniki\.ru/.*st\.redirect', re.
 OK_URL = re.compile(r'http(?:s)?://(www\.)?odnoklassniki\.ru/', re.I)
 MM_URL = re.compile(r'http(?:s)?://my\.mail\.ru/apps/', re.I)
 
+META_TAG = re.compile(r'<meta', re.I)
+UTF16_BOMS = ('\xff\xfe', '\xfe\xff')
+
 COUNTER_TYPES = (
-    ('GOOGLE_ANALYTICS', re.compile(r'.*google-analytics\.com/ga\.js.*', re.I+re.S)),
-    ('YA_METRICA', re.compile(r'.*mc\.yandex\.ru/metrika/watch\.js.*', re.I+re.S)),
-    ('TOP_MAIL_RU', re.compile(r'.*top-fwz1\.mail\.ru/counter.*', re.I+re.S)),
-    ('TOP_MAIL_RU', re.compile(r'.*top\.mail\.ru/jump\?from.*', re.I+re.S)),
-    ('DOUBLECLICK', re.compile(r'.*//googleads\.g\.doubleclick\.net/pagead/viewthroughconversion.*', re.I+re.S)),
-    ('VISUALDNA', re.compile(r'.*//a1\.vdna-assets\.com/analytics\.js.*', re.I+re.S)),
-    ('LI_RU', re.compile(r'.*/counter\.yadro\.ru/hit.*', re.I+re.S)),
-    ('RAMBLER_TOP100', re.compile(r'.*counter\.rambler\.ru/top100.*', re.I+re.S))
+    ('GOOGLE_ANALYTICS', 'google-analytics.com/ga.js'),
+    ('YA_METRICA', 'mc.yandex.ru/metrika/watch.js'),
+    ('TOP_MAIL_RU', 'top-fwz1.mail.ru/counter'),
+    ('TOP_MAIL_RU', 'top.mail.ru/jump?from'),
+    ('DOUBLECLICK', '//googleads.g.doubleclick.net/pagead/viewthroughconversion'),
+    ('VISUALDNA', '//a1.vdna-assets.com/analytics.js'),
+    ('LI_RU', '/counter.yadro.ru/hit'),
+    ('RAMBLER_TOP100', 'counter.rambler.ru/top100')
+)
+
+# ASCII-only case folding, the same as re.I does for str patterns
+ASCII_LOWERCASE = maketrans(ascii_uppercase, ascii_lowercase)
+
+# URLs normalize_url returns unchanged: lowercase scheme, ASCII domain, path without ';'
+# and characters quote() would escape, any printable ASCII query
+NORMALIZED_URL = re.compile(
+    r"[a-z][a-z0-9+.\-]*://[A-Za-z0-9_.\-:@~!$&'()*+,=%]+"
+    r"(?:/[A-Za-z0-9_.\-/%+$!*'(),]*)?"
+    r"(?:\?[!-~]+)?\Z"
 )
 
+PREPARED_URLS_SIZE = 10000
+prepared_urls = {}
+
+# redirect bodies up to this size are read to keep the connection alive
+REDIRECT_BODY_MAX_BYTES = 4096
+
 
 def to_unicode(val, errors='strict'):
     return val if isinstance(val, unicode) else val.decode('utf8', errors=errors)
@@ -42,23 +65,82 @@ def get_counters(content):
     """
     Ищет в хтмл-странице счетичик и возвращает массив типов найденных
     """
+    content = to_str(content).translate(ASCII_LOWERCASE)
     counters = []
-    for counter_name, regexp in COUNTER_TYPES:
-        if re.match(regexp, content):
+    for counter_name, needle in COUNTER_TYPES:
+        if counter_name not in counters and needle in content:
             counters.append(counter_name)
     return counters
 
 
+class MetaTagFound(Exception):
+    pass
+
+
+class MetaTagParser(HTMLParser):
+    """
+    Разбирает хтмл-страницу тем же токенизатором, что и BeautifulSoup с "html.parser",
+    но не строит дерево и останавливается на первом теге meta.
+    """
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            raise MetaTagFound(attrs)
+
+
+def is_ascii(value):
+    try:
+        value.encode('ascii') if isinstance(value, unicode) else value.decode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def find_meta_attrs_soup(content):
+    result = BeautifulSoup(content, "html.parser").find("meta")
+    return result.attrs if result else None
+
+
+def find_meta_attrs(content):
+    """
+    Возвращает атрибуты первого тега meta в хтмл-странице или None, если тега нет.
+
+    Результат совпадает с BeautifulSoup(content, "html.parser").find("meta").attrs.
+    Страница разбирается только до первого тега meta. Если значение content не ASCII,
+    страница в UTF-16 или токенизатор не смог разобрать страницу, атрибуты берутся
+    из BeautifulSoup, который сначала декодирует страницу.
+    """
+    if isinstance(content, str) and content.startswith(UTF16_BOMS):
+        return find_meta_attrs_soup(content)
+
+    if not META_TAG.search(content):
+        return None
+
+    parser = MetaTagParser()
+    try:
+        parser.feed(content)
+        parser.close()
+    except MetaTagFound as e:
+        attrs = dict((attr, '' if value is None else value) for attr, value in e.args[0])
+        if is_ascii(attrs.get('content', '')):
+            return attrs
+    except (HTMLParseError, UnicodeError):
+        pass
+    else:
+        return None
+
+    return find_meta_attrs_soup(content)
+
+
 def check_for_meta(content, url):
     """
     Ищет в хтмл-странице мета-редирект теги и возраещет урл редиректа
     """
-    soup = BeautifulSoup(content, "html.parser")
-    result = soup.find("meta")
-    if result and 'content' in result.attrs:
-        for attr, value in result.attrs.items():
+    attrs = find_meta_attrs(content)
+    if attrs and 'content' in attrs:
+        for attr, value in attrs.items():
             if attr.lower() == 'http-equiv' and value.lower() == 'refresh':
-                splitted = result['content'].split(";")
+                splitted = attrs['content'].split(";")
                 if len(splitted) != 2:
                     return
                 wait, text = splitted
@@ -74,42 +156,185 @@ def fix_market_url(url):
     return 'http://play.google.com/store/apps/' + url.lstrip("market://")
 
 
-def make_pycurl_request(url, timeout, useragent=None):
-    """Делает http запрос (без перехода по редиректам)
-    Возвращает контент ответа и возможный редирект
-    :return: содержимое ответа, урл редиректа
+class CurlPool(object):
+    """
+    Пул переиспользуемых pycurl.Curl.
+
+    Curl после запроса сбрасывается через reset и возвращается в пул, при этом у него
+    остаются открытые соединения. Все curl пула используют общий CurlShare с кешем DNS
+    и SSL сессий. После fork пул в дочернем процессе создается заново.
+    """
+
+    def __init__(self, size=10):
+        self.size = size
+        self.pid = None
+
+    def start(self):
+        self.pid = os.getpid()
+        self.handles = []
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+    def get(self):
+        """
+        :rtype: pycurl.Curl
+        """
+        if self.pid != os.getpid():
+            self.start()
+
+        if self.handles:
+            return self.handles.pop()
+
+        curl = pycurl.Curl()
+        curl.setopt(pycurl.SHARE, self.share)
+        return curl
+
+    def put(self, curl):
+        """
+        Возвращает curl в пул, лишние curl закрываются.
+
+        :type curl: pycurl.Curl
+        """
+        if self.pid != os.getpid() or len(self.handles) >= self.size:
+            curl.close()
+            return
+
+        curl.reset()
+        self.handles.append(curl)
+
+
+curl_pool = CurlPool()
+
+
+class PycurlResponse(object):
+    """
+    Принимает ответ на curl запрос: содержимое (не больше max_body_bytes байт), код ответа
+    и заголовок Location.
+
+    Загрузка прерывается, а в aborted выставляется True, когда содержимое превышает
+    max_body_bytes или когда по заголовкам ответ оказывается http редиректом без Content-Length
+    или с содержимым длиннее REDIRECT_BODY_MAX_BYTES: содержимое редиректов не нужно, но
+    короткое содержимое дочитывается, потому что прерванная загрузка закрывает соединение,
+    и следующий запрос цепочки к тому же хосту не может его переиспользовать.
+    """
+
+    def __init__(self, max_body_bytes=None):
+        self.max_body_bytes = max_body_bytes
+        self.body = StringIO()
+        self.body_size = 0
+        self.aborted = False
+        self.status = None
+        self.location = None
+        self.content_length = None
+
+    def is_redirect(self):
+        return self.location is not None and self.status is not None and 300 <= self.status < 400
+
+    def header(self, line):
+        if line.startswith('HTTP/'):
+            # status line of a new response, e.g. after "100 Continue"
+            parts = line.split(None, 2)
+            self.status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+            self.location = None
+            self.content_length = None
+        elif line[:9].lower() == 'location:':
+            self.location = line[9:].strip()
+        elif line[:15].lower() == 'content-length:':
+            value = line[15:].strip()
+            self.content_length = int(value) if value.isdigit() else None
+        elif not line.strip() and self.is_redirect():
+            if self.content_length is None or self.content_length > REDIRECT_BODY_MAX_BYTES:
+                self.aborted = True
+                return 0
+
+    def write(self, data):
+        if self.max_body_bytes is not None and self.body_size + len(data) > self.max_body_bytes:
+            self.body.write(data[:self.max_body_bytes - self.body_size])
+            self.body_size = self.max_body_bytes
+            self.aborted = True
+            return 0
+
+        self.body.write(data)
+        self.body_size += len(data)
+
+    def getvalue(self):
+        return self.body.getvalue()
+
+
+def setup_pycurl_request(curl, url, timeout, useragent=None, max_body_bytes=None):
+    """Настраивает curl на http запрос (без перехода по редиректам)
+    :return: объект, в который будет записан ответ
+    :rtype: PycurlResponse
 
     """
     prepared_url = to_str(prepare_url(url), 'ignore')
-    buff = StringIO()
-    curl = pycurl.Curl()
+    response = PycurlResponse(max_body_bytes)
     curl.setopt(curl.URL, prepared_url)
     if useragent:
         curl.setopt(curl.USERAGENT, useragent)
-    curl.setopt(curl.WRITEDATA, buff)
+    curl.setopt(curl.WRITEFUNCTION, response.write)
+    curl.setopt(curl.HEADERFUNCTION, response.header)
     curl.setopt(curl.FOLLOWLOCATION, False)
     # curl.setopt(curl.CONNECTTIMEOUT, timeout)
     curl.setopt(curl.TIMEOUT, timeout)
-    curl.perform()
-    content = buff.getvalue()
+    return response
+
+
+def read_pycurl_response(curl, response):
+    """Возвращает результат выполненного curl запроса
+    :return: содержимое ответа, урл редиректа
+
+    """
+    content = response.getvalue()
     redirect_url = curl.getinfo(curl.REDIRECT_URL)
-    curl.close()
+    if redirect_url is None and response.aborted and response.is_redirect():
+        # curl does not report REDIRECT_URL for aborted transfers
+        redirect_url = urljoin(curl.getinfo(curl.EFFECTIVE_URL), response.location)
     if redirect_url is not None:
         redirect_url = to_unicode(redirect_url, 'ignore')
     return content, redirect_url
 
 
-def get_url(url, timeout, user_agent=None):
+def make_pycurl_request(url, timeout, useragent=None, max_body_bytes=None):
+    """Делает http запрос (без перехода по редиректам)
+    Возвращает контент ответа и возможный редирект
+    Содержимое ответа длиннее max_body_bytes обрезается, содержимое http редиректа не загружается
+    :return: содержимое ответа, урл редиректа
+
+    """
+    curl = curl_pool.get()
+    try:
+        response = setup_pycurl_request(curl, url, timeout, useragent, max_body_bytes)
+        try:
+            curl.perform()
+        except pycurl.error:
+            if not response.aborted:
+                raise
+        return read_pycurl_response(curl, response)
+    finally:
+        curl_pool.put(curl)
+
+
+def get_url(url, timeout, user_agent=None, max_body_bytes=None):
     """
     :return: урл, тип редиректа, содержимое страницы (если есть)
     """
-    content = None
     try:
-        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent)
+        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent, max_body_bytes)
     except (pycurl.error, ValueError) as e:
         logger.error(u'error in url {} {}'.format(url, e))
-        return url, 'ERROR', content  # TODO add exception in ERROR
+        return url, 'ERROR', None  # TODO add exception in ERROR
+
+    return get_redirect_from_response(url, content, new_redirect_url)
 
+
+def get_redirect_from_response(url, content, new_redirect_url):
+    """
+    Определяет редирект по ответу на запрос урла.
+
+    :return: урл, тип редиректа, содержимое страницы (если есть)
+    """
     redirect_type = None
 
     # ignoring ok login redirects
@@ -129,7 +354,7 @@ def get_url(url, timeout, user_agent=None):
     return prepare_url(new_redirect_url), redirect_type, content
 
 
-def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
+def get_redirect_history(url, timeout, max_redirects=30, user_agent=None, max_body_bytes=None, cache=None):
     """
     Входные параметры:
 
@@ -137,6 +362,8 @@ def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
     + timeout - таймаут на проверку *одного* урла
     + max_redirects - максимальное количество редиректов, после превышения проверка останавливается
     + user_agent - юзер-агент, если не передает, то будет дефолтный из pycurl
+    + max_body_bytes - максимальный размер загружаемого содержимого страницы, по умолчанию без ограничения
+    + cache - кеш результатов запросов урлов (lib.cache.RedirectCache), по умолчанию не используется
 
 
     Выходные параметры:
@@ -147,44 +374,94 @@ def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
     3. установленные счетчики на конечном урле
 
     """
-    url = prepare_url(url)
-    history_types = []
-    history_urls = [url]
-    redirect_url = url
+    history = RedirectHistory(url, max_redirects)
+    while not history.finished:
+        url = history.next_url
+        hop = cache.get(url) if cache is not None else None
+        if hop is not None:
+            history.add_hop(*hop)
+            continue
+
+        hop = history.add(*get_url(
+            url=url,
+            timeout=timeout,
+            user_agent=user_agent,
+            max_body_bytes=max_body_bytes
+        ))
+        if cache is not None and hop[1] != 'ERROR':
+            cache.set(url, hop)
+    return history.result()
 
-    # ignore mm / ok domains
-    if re.match(MM_URL, url) or re.match(OK_URL, url):
-        return history_types, history_urls, []
 
-    content = None
-    while True:
-        redirect_url, redirect_type, content = get_url(
-            url=redirect_url,
-            timeout=timeout,
-            user_agent=user_agent
-        )
+class RedirectHistory(object):
+    """
+    Состояние проверки цепочки редиректов одного урла.
+
+    Не делает запросов сама: next_url - урл, который нужно запросить следующим,
+    результат запроса передается в add (или в add_hop, если он взят из кеша).
+    Используется get_redirect_history и движком lib.engine, поэтому результаты у них совпадают.
+    """
+
+    def __init__(self, url, max_redirects=30):
+        url = prepare_url(url)
+        self.max_redirects = max_redirects
+        self.types = []
+        self.urls = [url]
+        self.counters = []
+        self.next_url = url
+
+        # ignore mm / ok domains
+        self.finished = bool(re.match(MM_URL, url) or re.match(OK_URL, url))
+
+    def add(self, redirect_url, redirect_type, content):
+        """
+        Добавляет в историю результат запроса next_url.
+
+        :param redirect_url: урл редиректа
+        :param redirect_type: тип редиректа
+        :param content: содержимое страницы
+
+        :return: урл редиректа, тип редиректа, счетчики на странице - результат для кеша
+        :rtype: tuple
+        """
+        hop = redirect_url, redirect_type, get_counters(content) if content else []
+        self.add_hop(*hop)
+        return hop
+
+    def add_hop(self, redirect_url, redirect_type, counters):
+        """
+        Добавляет в историю результат запроса next_url, в котором вместо содержимого
+        страницы уже найденные на ней счетчики.
+        """
+        self.counters = counters
+        self.next_url = redirect_url
+        self.finished = True
         if not redirect_url:
-            break
+            return
 
-        history_types.append(redirect_type)
-        history_urls.append(redirect_url)
+        self.types.append(redirect_type)
+        self.urls.append(redirect_url)
 
         if redirect_type == 'ERROR':
-            break
+            return
 
-        if len(history_urls) > max_redirects:
-            break
-        if redirect_url in history_urls[:-1]:
-            break
+        if len(self.urls) > self.max_redirects:
+            return
+        if redirect_url in self.urls[:-1]:
+            return
 
-    counters = get_counters(content) if content else []
-    return history_types, history_urls, counters
+        self.finished = False
 
+    def result(self):
+        """
+        :return: типы редиректов, урлы редиректов, счетчики на конечном урле
+        :rtype: tuple
+        """
+        return self.types, self.urls, self.counters
 
-def prepare_url(url):
-    """Нормализация урла"""
-    if url is None:
-        return url
+
+def normalize_url(url):
+    """Нормализация урла: idna для домена, экранирование пути и параметров"""
     scheme, netloc, path, qs, anchor, fragments = urlparse(
         to_unicode(url),
         allow_fragments=False
@@ -196,3 +473,23 @@ def prepare_url(url):
     path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
     qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
     return urlunparse((scheme, netloc, path, qs, anchor, fragments))
+
+
+def prepare_url(url):
+    """
+    Нормализация урла.
+
+    Уже нормализованные ascii-урлы возвращаются без разбора, результаты нормализации
+    остальных урлов запоминаются в prepared_urls.
+    """
+    if url is None:
+        return url
+    if NORMALIZED_URL.match(url):
+        return to_unicode(url)
+
+    prepared = prepared_urls.get(url)
+    if prepared is None:
+        if len(prepared_urls) >= PREPARED_URLS_SIZE:
+            prepared_urls.clear()
+        prepared = prepared_urls[url] = normalize_url(url)
+    return prepared
@@ -0,0 +1,72 @@
+# coding: utf-8
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+from threading import Lock, Thread
+from time import time
+
+
+class RedirectCache(object):
+    """
+    Кеш результатов запросов урлов цепочек редиректов.
+
+    Хранит не больше size записей, при переполнении вытесняются записи, которые дольше
+    всего не запрашивались. Запись устаревает через ttl секунд после добавления.
+    """
+
+    def __init__(self, size=10000, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        # the shared cache is accessed from a server thread per worker process
+        self.lock = Lock()
+
+    def get(self, url):
+        """
+        :return: сохраненный результат запроса урла или None
+        """
+        with self.lock:
+            item = self.items.pop(url, None)
+            if item is None:
+                return None
+
+            expires, value = item
+            if expires < time():
+                return None
+
+            self.items[url] = item
+            return value
+
+    def set(self, url, value):
+        with self.lock:
+            self.items.pop(url, None)
+            self.items[url] = time() + self.ttl, value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+class CacheManager(BaseManager):
+    pass
+
+
+CacheManager.register('RedirectCache', RedirectCache)
+
+
+def start_shared_cache(size, ttl):
+    """
+    Запускает в потоке текущего процесса сервер с общим для дочерних процессов RedirectCache.
+
+    Сервер работает в потоке, а не в отдельном процессе, поэтому не попадает в active_children.
+
+    :param size: максимальное количество записей
+    :param ttl: время жизни записи в секундах
+
+    :return: прокси кеша, который можно передавать в дочерние процессы
+    """
+    server = CacheManager().get_server()
+    thread = Thread(target=server.serve_forever, name='redirect_cache')
+    thread.daemon = True
+    thread.start()
+
+    manager = CacheManager(address=server.address)
+    manager.connect()
+    return manager.RedirectCache(size, ttl)
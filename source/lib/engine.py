@@ -0,0 +1,245 @@
+# coding: utf-8
+from collections import deque
+from logging import getLogger
+import select
+
+import gevent
+from gevent.event import AsyncResult, Event
+import pycurl
+
+from . import (CurlPool, RedirectHistory, get_redirect_from_response, read_pycurl_response,
+               setup_pycurl_request)
+
+logger = getLogger('redirect_checker')
+
+
+class CurlMultiEngine(object):
+    """
+    Проверяет много цепочек редиректов одновременно в одном процессе через pycurl.CurlMulti.
+
+    Каждая цепочка - RedirectHistory, как и в get_redirect_history. Когда запрос очередного
+    урла цепочки завершается, в multi добавляется запрос следующего урла. Одновременно
+    выполняется не больше max_transfers запросов, остальные цепочки ждут в очереди.
+    Curl берутся из собственного CurlPool движка. Результаты запросов берутся из кеша cache
+    и сохраняются в него так же, как в get_redirect_history.
+
+    Ожидание сокетов сделано через модуль select, поэтому после gevent.monkey.patch_all
+    движок не блокирует остальные гринлеты.
+    """
+
+    def __init__(self, max_transfers=100, cache=None):
+        self.max_transfers = max_transfers
+        self.cache = cache
+        self.multi = pycurl.CurlMulti()
+        self.pending = deque()
+        self.pool = CurlPool(max_transfers)
+        # CurlMulti does not keep references to added handles
+        self.handles = {}
+
+    def add(self, url, timeout, max_redirects=30, user_agent=None, max_body_bytes=None, callback=None,
+            errback=None):
+        """
+        Добавляет урл на проверку.
+
+        :param callback: функция, вызываемая с результатом get_redirect_history для урла
+        :param errback: функция, вызываемая с исключением, с которым упала проверка урла;
+                        если не задана, исключение пробрасывается из run
+        :rtype: RedirectHistory
+        """
+        history = RedirectHistory(url, max_redirects)
+        history.timeout = timeout
+        history.user_agent = user_agent
+        history.max_body_bytes = max_body_bytes
+        history.callback = callback
+        history.errback = errback
+        if history.finished:
+            self.finish(history)
+        else:
+            self.pending.append(history)
+            self.start_transfers()
+        return history
+
+    def start_transfers(self):
+        while self.pending and len(self.handles) < self.max_transfers:
+            self.start_transfer(self.pending.popleft())
+
+    def start_transfer(self, history):
+        try:
+            self.start_history_transfer(history)
+        except Exception as e:
+            self.fail(history, e)
+
+    def start_history_transfer(self, history):
+        hop = self.cache.get(history.next_url) if self.cache is not None else None
+        if hop is not None:
+            history.add_hop(*hop)
+            self.advance(history)
+            return
+
+        curl = self.pool.get()
+        try:
+            response = setup_pycurl_request(
+                curl, history.next_url, history.timeout, history.user_agent, history.max_body_bytes
+            )
+        except (pycurl.error, ValueError) as e:
+            self.pool.put(curl)
+            self.add_error(history, e)
+            return
+
+        self.handles[curl] = history, response
+        self.multi.add_handle(curl)
+
+    def add_error(self, history, error):
+        logger.error(u'error in url {} {}'.format(history.next_url, error))
+        self.add_result(history, (history.next_url, 'ERROR', None))
+
+    def add_result(self, history, result):
+        url = history.next_url
+        hop = history.add(*result)
+        if self.cache is not None and hop[1] != 'ERROR':
+            self.cache.set(url, hop)
+        self.advance(history)
+
+    def advance(self, history):
+        if history.finished:
+            self.finish(history)
+        else:
+            self.pending.append(history)
+
+    def finish(self, history):
+        if history.callback is not None:
+            history.callback(history.result())
+
+    def fail(self, history, error):
+        """
+        Завершает цепочку, проверка которой упала с исключением error.
+
+        Должна вызываться из блока except: без errback исключение пробрасывается.
+        """
+        if history.errback is None:
+            raise
+        logger.error(u'error in url {} {!r}'.format(history.next_url, error))
+        history.errback(error)
+
+    def perform(self):
+        """
+        Продвигает запросы и обрабатывает завершившиеся, не дожидаясь сокетов.
+        """
+        while True:
+            ret, handles = self.multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+        while True:
+            queued, ok_list, err_list = self.multi.info_read()
+            for curl in ok_list:
+                self.transfer_done(curl)
+            for curl, errno, errmsg in err_list:
+                self.transfer_done(curl, pycurl.error(errno, errmsg))
+            if not queued:
+                break
+
+        self.start_transfers()
+
+    def transfer_done(self, curl, error=None):
+        history, response = self.handles.pop(curl)
+        if response.aborted:
+            error = None
+        if error is None:
+            content, redirect_url = read_pycurl_response(curl, response)
+        self.multi.remove_handle(curl)
+        self.pool.put(curl)
+
+        try:
+            if error is not None:
+                self.add_error(history, error)
+            else:
+                self.add_result(history, get_redirect_from_response(history.next_url, content, redirect_url))
+        except Exception as e:
+            self.fail(history, e)
+
+    def wait(self, timeout=1.0):
+        """
+        Ждет готовности сокетов запросов не дольше timeout секунд.
+        """
+        curl_timeout = self.multi.timeout()
+        if curl_timeout >= 0:
+            timeout = min(timeout, curl_timeout / 1000.0)
+        if timeout <= 0:
+            return
+
+        read, write, exc = self.multi.fdset()
+        select.select(read, write, exc, timeout)
+
+    def run(self):
+        """
+        Выполняет запросы, пока не будут проверены все добавленные урлы.
+        """
+        while self.handles or self.pending:
+            self.perform()
+            if self.handles:
+                self.wait()
+
+    def get_redirect_histories(self, urls, timeout, max_redirects=30, user_agent=None, max_body_bytes=None):
+        """
+        Проверяет урлы одновременно.
+
+        :param urls: урлы для проверки
+        :type urls: list
+
+        :return: результаты get_redirect_history в порядке урлов
+        :rtype: list
+        """
+        histories = [self.add(url, timeout, max_redirects, user_agent, max_body_bytes) for url in urls]
+        self.run()
+        return [history.result() for history in histories]
+
+
+class GeventCurlMultiEngine(CurlMultiEngine):
+    """
+    CurlMultiEngine для гринлетов.
+
+    Запросы всех цепочек выполняет один гринлет движка, а get_redirect_history блокирует
+    только вызвавший его гринлет, поэтому много гринлетов одного процесса проверяют урлы
+    одновременно. Требует gevent.monkey.patch_all, иначе ожидание сокетов в select
+    блокирует весь процесс.
+    """
+
+    def __init__(self, max_transfers=100, cache=None):
+        super(GeventCurlMultiEngine, self).__init__(max_transfers, cache)
+        self.has_work = Event()
+        self.runner = None
+
+    def add(self, url, timeout, max_redirects=30, user_agent=None, max_body_bytes=None, callback=None,
+            errback=None):
+        history = super(GeventCurlMultiEngine, self).add(
+            url, timeout, max_redirects, user_agent, max_body_bytes, callback, errback
+        )
+        if not history.finished:
+            self.has_work.set()
+        return history
+
+    def serve(self):
+        """
+        Выполняет запросы добавленных урлов, пока жив процесс.
+        """
+        while True:
+            self.has_work.wait()
+            try:
+                self.run()
+            except Exception:
+                logger.exception('Curl multi engine failed')
+            # no other greenlet runs between run() and clear(), nothing is lost
+            self.has_work.clear()
+
+    def get_redirect_history(self, url, timeout, max_redirects=30, user_agent=None, max_body_bytes=None):
+        """
+        Аналог get_redirect_history, ожидающий результата без блокировки других гринлетов.
+        """
+        if self.runner is None or self.runner.dead:
+            self.runner = gevent.spawn(self.serve)
+
+        result = AsyncResult()
+        self.add(url, timeout, max_redirects, user_agent, max_body_bytes, callback=result.set,
+                 errback=result.set_exception)
+        return result.get()
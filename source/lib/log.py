@@ -0,0 +1,103 @@
+# coding: utf-8
+from collections import deque
+import logging
+import os
+from thread import error as ThreadError
+
+from gevent.monkey import get_original
+from multiprocessing.util import Finalize
+
+start_new_thread, allocate_lock = get_original('thread', ['start_new_thread', 'allocate_lock'])
+
+
+class AsyncStreamHandler(logging.StreamHandler):
+    """
+    StreamHandler, который пишет записи в поток в фоновом системном потоке.
+
+    emit только добавляет запись в буфер, форматирование и запись выполняются
+    в фоновом потоке, поэтому медленная запись в stderr не останавливает ни основной поток,
+    ни hub gevent. Фоновый поток создается исходными (не подмененными gevent) функциями
+    модуля thread. В буфере хранится не больше capacity записей, при переполнении
+    отбрасываются самые старые.
+
+    После fork фоновый поток запускается заново в дочернем процессе.
+    """
+
+    def __init__(self, stream=None, capacity=10000):
+        logging.StreamHandler.__init__(self, stream)
+        self.capacity = capacity
+        self.closed = False
+        self.start()
+
+    def start(self):
+        """
+        Запускает фоновый поток записи в текущем процессе.
+        """
+        self.pid = os.getpid()
+        self.records = deque(maxlen=self.capacity)
+        self.wakeup = allocate_lock()
+        self.wakeup.acquire()
+        self.stopped = allocate_lock()
+        self.stopped.acquire()
+        start_new_thread(self.run, ())
+
+    def run(self):
+        try:
+            while not self.closed:
+                self.wakeup.acquire()
+                self.write_records()
+        finally:
+            self.stopped.release()
+
+    def wake(self):
+        try:
+            self.wakeup.release()
+        except ThreadError:
+            pass
+
+    def write_records(self):
+        """
+        Записывает в поток все записи из буфера.
+        """
+        while self.records:
+            try:
+                record = self.records.popleft()
+            except IndexError:
+                break
+
+            logging.StreamHandler.emit(self, record)
+
+    def handle(self, record):
+        """
+        Добавляет запись в буфер, если она проходит фильтры.
+
+        В отличие от logging.Handler.handle блокировка обработчика не захватывается.
+        """
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+            Finalize(self, self.close, exitpriority=0)
+
+        self.records.append(record)
+        self.wake()
+
+    def close(self):
+        """
+        Останавливает фоновый поток, записывает оставшиеся записи и закрывает обработчик.
+
+        Записи, скопированные из родительского процесса при fork, не записываются.
+        """
+        if self.pid != os.getpid():
+            self.records.clear()
+        elif not self.closed:
+            self.closed = True
+            self.wake()
+            self.stopped.acquire()
+
+        self.write_records()
+        logging.StreamHandler.close(self)
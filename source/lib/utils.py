@@ -5,6 +5,7 @@ import os
 import socket
 import urllib2
 
+from tarantool.error import DatabaseError
 from tarantool_queue import tarantool_queue
 
 
@@ -103,6 +104,113 @@ def get_tube(host, port, space, name):
     return queue.tube(name)
 
 
+def take_tasks(tube, count, timeout):
+    """
+    Забирает из очереди до count задач за один запрос (queue.take_batch).
+
+    Ожидание timeout секунд происходит только для первой задачи,
+    остальные забираются, только если уже готовы.
+
+    :param tube: очередь tarantool.queue
+    :type tube: tarantool_queue.Tube
+    :param count: максимальное количество задач
+    :type count: int
+    :param timeout: время ожидания первой задачи
+    :type timeout: float
+
+    :rtype: list
+    """
+    queue = tube.queue
+
+    the_tuple = queue.tnt.call('queue.take_batch', (
+        str(queue.space), str(tube.opt['tube']), str(count), str(timeout)
+    ))
+
+    return [
+        tarantool_queue.Task(queue, space=queue.space, task_id=row[0], tube=row[1], status=row[2], raw_data=row[3])
+        for row in the_tuple
+    ]
+
+
+def process_tasks(tasks, action_name, *args):
+    """
+    Выполняет действие над задачами одним запросом queue.<action_name>_many.
+
+    :param tasks: задачи одной tarantool.queue
+    :type tasks: list
+    :param action_name: имя действия (ack, bury, retry)
+    :type action_name: str
+    :param args: аргументы действия, передаются перед идентификаторами задач
+
+    :return: список кортежей (задача, ошибка) для задач, над которыми действие не выполнено
+    :rtype: list
+    """
+    queue = tasks[0].queue
+    tasks_by_id = dict((str(task.task_id), task) for task in tasks)
+
+    for task in tasks:
+        task.modified = True
+
+    response = queue.tnt.call('queue.{name}_many'.format(name=action_name), (
+        (str(queue.space),) + tuple(str(arg) for arg in args) + tuple(tasks_by_id)
+    ))
+
+    return [(tasks_by_id[task_id], DatabaseError(message)) for task_id, message in response]
+
+
+def ack_tasks(tasks):
+    """
+    Подтверждает выполнение задач одним запросом queue.ack_many.
+
+    :param tasks: задачи одной tarantool.queue
+    :type tasks: list
+
+    :return: список кортежей (задача, ошибка) для неподтвержденных задач
+    :rtype: list
+    """
+    return process_tasks(tasks, 'ack')
+
+
+def put_ack_tasks(results):
+    """
+    Кладет новые задачи в очереди и подтверждает выполнение исходных задач одним
+    запросом queue.put_ack_many.
+
+    Новая задача кладется, только если исходная может быть подтверждена, и исходная
+    подтверждается в том же вызове процедуры, что и кладется новая. Очереди новых задач
+    должны находиться на том же сервере tarantool, что и исходные задачи.
+
+    :param results: список кортежей (исходная задача, очередь новой задачи, данные новой задачи,
+        словарь параметров как у Tube.put), pri=None - приоритет исходной задачи
+    :type results: list
+
+    :return: список кортежей (задача, ошибка) для неподтвержденных исходных задач
+    :rtype: list
+    """
+    queue = results[0][0].queue
+    tasks_by_id = {}
+    args = [str(queue.space)]
+
+    for task, tube, data, kwargs in results:
+        task.modified = True
+        tasks_by_id[str(task.task_id)] = task
+        opt = dict(tube.opt, **kwargs)
+        args.extend((
+            str(task.task_id),
+            str(tube.queue.space),
+            str(opt['tube']),
+            str(opt['delay']),
+            str(opt['ttl']),
+            str(opt['ttr']),
+            '' if opt['pri'] is None else str(opt['pri']),
+            tube.serialize(data)
+        ))
+
+    response = queue.tnt.call('queue.put_ack_many', tuple(args))
+
+    return [(tasks_by_id[task_id], DatabaseError(message)) for task_id, message in response]
+
+
 class Config(object):
     """
     Класс для хранения настроек приложения.
@@ -110,9 +218,9 @@ class Config(object):
     pass
 
 
-def spawn_workers(num, target, args, parent_pid):
+def spawn_workers(num, target, args, parent_pid, kwargs=None):
     for _ in xrange(num):
-        p = Process(target=target, args=args, kwargs={'parent_pid': parent_pid})
+        p = Process(target=target, args=args, kwargs=dict(kwargs or {}, parent_pid=parent_pid))
         p.daemon = True
         p.start()
 
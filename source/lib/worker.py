@@ -1,26 +1,37 @@
 # coding: utf-8
-from logging import getLogger
+from collections import deque
+from logging import getLogger, DEBUG
 import os.path
+from Queue import Empty, Queue
+import threading
 
+import gevent
+from gevent.monkey import patch_all
 from tarantool.error import DatabaseError
 from . import to_unicode, get_redirect_history
 
-from utils import get_tube
+from cache import RedirectCache
+from engine import GeventCurlMultiEngine
+from utils import ack_tasks, get_tube, put_ack_tasks, take_tasks
 
 logger = getLogger('redirect_checker')
 
 
-def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None):
+def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None, max_body_bytes=None,
+                                   cache=None, engine=None):
     url = to_unicode(task.data['url'], 'ignore')
     is_recheck = bool(task.data.get('recheck'))
 
-    logger.info(u'Task id={} url={} url_id={} is_recheck={}'.format(
-        task.task_id, url, task.data["url_id"], is_recheck
-    ))
+    logger.info(u'Task id=%s url=%s url_id=%s is_recheck=%s', task.task_id, url, task.data["url_id"], is_recheck)
 
-    history_types, history_urls, counters = get_redirect_history(
-        url, timeout, max_redirects, user_agent
-    )
+    if engine is None:
+        history_types, history_urls, counters = get_redirect_history(
+            url, timeout, max_redirects, user_agent, max_body_bytes, cache
+        )
+    else:
+        history_types, history_urls, counters = engine.get_redirect_history(
+            url, timeout, max_redirects, user_agent, max_body_bytes
+        )
     if 'ERROR' in history_types and not is_recheck:
         task.data['recheck'] = True
         data = task.data
@@ -38,7 +49,21 @@ def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=N
     return is_input, data
 
 
-def worker(config, parent_pid):
+def get_take_size(config):
+    """
+    Возвращает, сколько задач брать из входной очереди одним запросом.
+
+    Взятые задачи проверяются по очереди, поэтому их не больше, чем успевает проверить
+    цикл до истечения config.QUEUE_TASK_TTR: иначе очередь вернет задачи из буфера,
+    и их повторно проверит другой обработчик.
+
+    :rtype: int
+    """
+    check_time = config.MAX_REDIRECTS * config.HTTP_TIMEOUT
+    return max(1, min(config.QUEUE_BATCH_SIZE, config.QUEUE_TASK_TTR // check_time))
+
+
+def worker(config, parent_pid, cache=None, engine=None):
     input_tube = get_tube(
         host=config.INPUT_QUEUE_HOST,
         port=config.INPUT_QUEUE_PORT,
@@ -65,35 +90,198 @@ def worker(config, parent_pid):
         name=output_tube.opt['tube']
     ))
 
+    if cache is None and config.REDIRECT_CACHE_SIZE:
+        cache = RedirectCache(config.REDIRECT_CACHE_SIZE, config.REDIRECT_CACHE_TTL)
+
+    # threading is looked up at call time: green_worker monkey patches it after import
+    input_lock = threading.Lock()
+    results = Queue()
+    flusher = threading.Thread(
+        target=flush_results,
+        args=(results, input_tube, output_tube, input_lock, config),
+        name='results_flusher'
+    )
+    flusher.daemon = True
+    flusher.start()
+
     parent_proc = '/proc/{}'.format(parent_pid)
+    tasks = deque()
+    take_size = get_take_size(config)
+    logger.info(u'Take up to {size} tasks at once.'.format(size=take_size))
+
+    try:
+        # run while parent is alive
+        while os.path.exists(parent_proc):
+            if not flusher.is_alive():
+                logger.error('Results flusher is dead. exiting')
+                break
 
-    # run while parent is alive
-    while os.path.exists(parent_proc):
-        task = input_tube.take(config.QUEUE_TAKE_TIMEOUT)
-        if task:
-            logger.info(u'Starting task id={}.'.format(task.task_id))
+            if not tasks:
+                with input_lock:
+                    tasks.extend(take_tasks(input_tube, take_size, config.QUEUE_TAKE_TIMEOUT))
+                if not tasks:
+                    continue
+
+            task = tasks.popleft()
+            logger.info(u'Starting task id=%s.', task.task_id)
             result = get_redirect_history_from_task(
                 task,
                 config.HTTP_TIMEOUT,
                 config.MAX_REDIRECTS,
-                config.USER_AGENT
+                config.USER_AGENT,
+                config.MAX_BODY_BYTES,
+                cache,
+                engine
             )
-            if result:
-                is_input, data = result
-                if is_input:
-                    input_tube.put(
-                        data,
-                        delay=config.RECHECK_DELAY,
-                        pri=task.meta()['pri']
-                    )
-                else:
-                    output_tube.put(data)
-                logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
+            results.put((task, result))
+        else:
+            logger.info('Parent is dead. exiting')
+    finally:
+        results.put(None)
+        flusher.join()
+        # the server releases tasks left in the buffer when the connection is closed
+        input_tube.queue.tnt.close()
+
+
+def flush_results(results, input_tube, output_tube, input_lock, config):
+    """
+    Отправляет в очереди результаты проверок из results, пока не получит None.
+
+    Результаты, накопившиеся за время отправки предыдущих, отправляются вместе,
+    но не больше config.QUEUE_BATCH_SIZE за раз.
+
+    :param results: очередь кортежей (задача, результат get_redirect_history_from_task)
+    :type results: Queue.Queue
+    :param input_lock: блокировка соединения входной очереди, общего с worker
+    """
+    # queue.put_ack can put results only into the server the task was taken from
+    put_ack = (config.INPUT_QUEUE_HOST, config.INPUT_QUEUE_PORT) == (config.OUTPUT_QUEUE_HOST,
+                                                                     config.OUTPUT_QUEUE_PORT)
+    while True:
+        batch = [results.get()]
+        while len(batch) < config.QUEUE_BATCH_SIZE:
             try:
-                task.ack()
-                logger.info(u'Task id={} done'.format(task.task_id))
-            except DatabaseError as e:
-                logger.info('Task ack fail')
-                logger.exception(e)
-    else:
-        logger.info('Parent is dead. exiting')
+                batch.append(results.get_nowait())
+            except Empty:
+                break
+
+        stopped = batch[-1] is None
+        if stopped:
+            batch.pop()
+        if batch:
+            send_results(batch, input_tube, output_tube, input_lock, config.RECHECK_DELAY, put_ack)
+        if stopped:
+            return
+
+
+def send_results(batch, input_tube, output_tube, input_lock, recheck_delay, put_ack=True):
+    """
+    Кладет результаты проверок в очереди и подтверждает задачи.
+
+    Если put_ack, результаты кладутся и задачи подтверждаются одним запросом queue.put_ack_many,
+    иначе результаты кладутся по одному, а задачи подтверждаются одним запросом queue.ack_many.
+    Задача, результат которой не удалось положить в очередь, не подтверждается.
+
+    :param batch: список кортежей (задача, результат get_redirect_history_from_task)
+    :type batch: list
+    """
+    moves = []
+    acks = []
+    for task, result in batch:
+        if not result:
+            acks.append(task)
+            continue
+
+        is_input, data = result
+        if is_input:
+            moves.append((task, input_tube, data, {'delay': recheck_delay, 'pri': None}))
+        else:
+            moves.append((task, output_tube, data, {}))
+        if logger.isEnabledFor(DEBUG):
+            logger.debug(u'Task id=%s data:%s', task.task_id, data)
+
+    if not put_ack:
+        acks.extend(put_results(moves, input_lock))
+        moves = []
+
+    for send, args, done in ((put_ack_tasks, moves, [move[0] for move in moves]), (ack_tasks, acks, acks)):
+        if not done:
+            continue
+
+        try:
+            with input_lock:
+                errors = send(args)
+        except DatabaseError as e:
+            logger.info('Task ack fail')
+            logger.exception(e)
+            continue
+
+        failed = set()
+        for task, error in errors:
+            failed.add(task)
+            logger.info(u'Task id=%s ack fail: %s', task.task_id, error)
+        for task in done:
+            if task not in failed:
+                logger.info(u'Task id=%s done', task.task_id)
+
+
+def put_results(moves, input_lock):
+    """
+    Кладет результаты проверок в очереди по одному.
+
+    :param moves: список кортежей (задача, очередь, данные, параметры Tube.put), pri=None - приоритет задачи
+    :type moves: list
+
+    :return: задачи, результаты которых положены в очереди
+    :rtype: list
+    """
+    done = []
+    for task, tube, data, kwargs in moves:
+        try:
+            if tube.queue is task.queue:
+                with input_lock:
+                    put_result(task, tube, data, kwargs)
+            else:
+                put_result(task, tube, data, kwargs)
+        except DatabaseError as e:
+            logger.info(u'Task id=%s put fail', task.task_id)
+            logger.exception(e)
+            continue
+        done.append(task)
+    return done
+
+
+def put_result(task, tube, data, kwargs):
+    if kwargs.get('pri', 0) is None:
+        kwargs = dict(kwargs, pri=task.meta()['pri'])
+    tube.put(data, **kwargs)
+
+
+def green_worker(config, parent_pid, cache=None):
+    """
+    Запускает в процессе config.WORKER_GREENLETS циклов worker в гринлетах.
+
+    Запросы всех гринлетов выполняет общий GeventCurlMultiEngine, поэтому процесс
+    проверяет одновременно до config.WORKER_GREENLETS урлов. Завершившийся цикл, в том числе
+    из-за исключения, через config.SLEEP секунд заменяется новым, пока жив родительский процесс.
+    """
+    patch_all()
+
+    if cache is None and config.REDIRECT_CACHE_SIZE:
+        cache = RedirectCache(config.REDIRECT_CACHE_SIZE, config.REDIRECT_CACHE_TTL)
+    engine = GeventCurlMultiEngine(config.WORKER_GREENLETS, cache)
+
+    logger.info(u'Starting {} worker greenlets.'.format(config.WORKER_GREENLETS))
+    greenlets = set(
+        gevent.spawn(worker, config, parent_pid, cache, engine) for _ in xrange(config.WORKER_GREENLETS)
+    )
+    parent_proc = '/proc/{}'.format(parent_pid)
+
+    # replace dead worker loops while parent is alive
+    while greenlets:
+        for greenlet in gevent.wait(greenlets, count=1):
+            greenlets.discard(greenlet)
+            if not greenlet.successful():
+                logger.error(u'Worker greenlet failed: {!r}'.format(greenlet.exception))
+            if os.path.exists(parent_proc):
+                greenlets.add(gevent.spawn_later(config.SLEEP, worker, config, parent_pid, cache, engine))
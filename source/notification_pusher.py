@@ -2,24 +2,37 @@
 # coding: utf-8
 
 import argparse
+import importlib
 import json
 import logging
 import os
 import signal
 import sys
+from collections import OrderedDict, deque
+from functools import partial
 from logging.config import dictConfig
+from math import ceil
 from threading import current_thread
+from time import time
+from urlparse import urlsplit
 
 import gevent
 from gevent import Greenlet
 from gevent import queue as gevent_queue
 from gevent import sleep
+from gevent.event import Event
+from gevent.lock import RLock
 from gevent.monkey import patch_all
 from gevent.pool import Pool
 import requests
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.poolmanager import PoolManager, SSL_KEYWORDS
+from requests.packages.urllib3.util import Timeout as HTTPTimeout
 import tarantool
 import tarantool_queue
 
+from lib.utils import process_tasks, take_tasks
+
 SIGNAL_EXIT_CODE_OFFSET = 128
 """Коды выхода рассчитываются как 128 + номер сигнала"""
 
@@ -31,8 +44,201 @@ exit_code = 0
 
 logger = logging.getLogger('pusher')
 
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+"""Границы интервалов гистограмм времени в секундах"""
+
+TASK_ACTION_PROCEDURES = {'postpone_backlog': 'postpone'}
+"""Действия над задачами, выполняемые процедурой tarantool.queue другого действия"""
+
+JSON_ENCODER_OPTIONS = {
+    # ujson escapes '/' and rounds floats to 9 digits by default, 15 is its maximum
+    'ujson': {'escape_forward_slashes': False, 'double_precision': 15},
+}
+"""Аргументы dumps модулей, по умолчанию сериализующих не так, как json"""
+
+
+class Histogram(object):
+    """
+    Гистограмма значений с фиксированными границами интервалов.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for number, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[number] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """
+    Метрики приложения: счетчики, гистограммы и значения, вычисляемые при запросе.
+
+    Объект является WSGI-приложением, которое отдает метрики
+    в текстовом формате Prometheus по адресу /metrics.
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Увеличивает счетчик.
+
+        :param name: имя метрики
+        :type name: str
+        :param labels: кортеж пар (имя метки, значение)
+        :type labels: tuple
+        :param value: на сколько увеличить счетчик
+        :type value: int
+        """
+        counter = self.counters.setdefault(name, {})
+        counter[labels] = counter.get(labels, 0) + value
+
+    def observe(self, name, value, labels=()):
+        """
+        Добавляет значение в гистограмму.
+
+        :param name: имя метрики
+        :type name: str
+        :param value: значение
+        :type value: float
+        :param labels: кортеж пар (имя метки, значение)
+        :type labels: tuple
+        """
+        histograms = self.histograms.setdefault(name, {})
+        if labels not in histograms:
+            histograms[labels] = Histogram(self.buckets)
+        histograms[labels].observe(value)
+
+    def gauge(self, name, func):
+        """
+        Регистрирует метрику, значение которой вычисляется функцией func при запросе.
+        """
+        self.gauges[name] = func
+
+    @staticmethod
+    def format_sample(name, labels, value):
+        if labels:
+            name += '{' + ','.join(
+                '{key}="{value}"'.format(
+                    key=key,
+                    value=str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                )
+                for key, label_value in labels
+            ) + '}'
+        return '{name} {value}'.format(name=name, value=repr(value) if isinstance(value, float) else value)
+
+    def render(self):
+        """
+        Возвращает метрики в текстовом формате Prometheus.
+
+        :rtype: str
+        """
+        lines = []
+
+        for name in sorted(self.counters):
+            lines.append('# TYPE {name} counter'.format(name=name))
+            for labels, value in sorted(self.counters[name].iteritems()):
+                lines.append(self.format_sample(name, labels, value))
+
+        for name in sorted(self.gauges):
+            lines.append('# TYPE {name} gauge'.format(name=name))
+            lines.append(self.format_sample(name, (), self.gauges[name]()))
+
+        for name in sorted(self.histograms):
+            lines.append('# TYPE {name} histogram'.format(name=name))
+            for labels, histogram in sorted(self.histograms[name].iteritems()):
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(self.format_sample(name + '_bucket', labels + (('le', bound),), count))
+                lines.append(self.format_sample(name + '_bucket', labels + (('le', '+Inf'),), histogram.count))
+                lines.append(self.format_sample(name + '_sum', labels, histogram.sum))
+                lines.append(self.format_sample(name + '_count', labels, histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not Found\n']
+
+        body = self.render()
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(body)))
+        ])
+        return [body]
+
+
+metrics = Metrics()
+"""Метрики процесса"""
+
+
+def get_json_encoder(names):
+    """
+    Возвращает функцию сериализации в JSON из первого доступного модуля.
+
+    :param names: имена модулей с функцией dumps в порядке предпочтения (ujson, simplejson, json),
+                  dumps вызывается с аргументами из JSON_ENCODER_OPTIONS
+    :type names: list
+
+    :rtype: callable
+    """
+    for name in names:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            continue
+
+        logger.info('Use JSON encoder from [{name}].'.format(name=name))
+        options = JSON_ENCODER_OPTIONS.get(name)
+        return partial(module.dumps, **options) if options else module.dumps
+
+    raise ImportError('None of JSON encoders {names} is available.'.format(names=names))
+
+
+def serialize_payload(task, dumps=json.dumps):
+    """
+    Сериализует тело уведомления: данные задачи без callback_url и с идентификатором задачи.
+
+    :param task: задача
+    :type task: tarantool_queue.Task
+    :param dumps: функция сериализации в JSON
+    :type dumps: callable
+
+    :rtype: str
+    """
+    payload = dict(task.data, id=task.task_id)
+    del payload['callback_url']
+    return dumps(payload)
+
 
-def notification_worker(task, task_queue, *args, **kwargs):
+def observe_callback(host, started_at, worker):
+    """
+    Учитывает в метриках время обработки и результат задачи хоста.
+
+    :param host: хост
+    :type host: str
+    :param started_at: время запуска обработчика
+    :type started_at: float
+    :param worker: завершившийся greenlet, значение - имя действия над задачей
+    :type worker: gevent.Greenlet
+    """
+    labels = (('host', host),)
+    metrics.observe('pusher_callback_latency_seconds', time() - started_at, labels)
+    metrics.inc('pusher_callbacks_total', labels + (('result', worker.value),))
+
+
+def notification_worker(task, task_queue, session, *args, **kwargs):
     """
     Обработчик задачи отправки уведомления.
 
@@ -40,57 +246,564 @@ def notification_worker(task, task_queue, *args, **kwargs):
     :type task: tarantool_queue.Task
     :param task_queue: очередь для обработанных задач
     :type task_queue: gevent.queue.Queue
+    :param session: http-сессия с пулом соединений
+    :type session: requests.Session
     :param args:
-    :param kwargs:
+    :param kwargs: параметры запроса; deadline - максимальное время обработки задачи в секундах,
+                   dumps - функция сериализации в JSON
+
+    :return: имя действия, которое нужно выполнить над задачей:
+             ack - уведомление доставлено, retry - ошибка соединения или код ответа 5xx
+    :rtype: str
     """
+    deadline = kwargs.pop('deadline', None)
+    dumps = kwargs.pop('dumps', json.dumps)
+
     try:
         current_thread().name = "pusher.worker#{task_id}".format(task_id=task.task_id)
 
-        data = task.data.copy()
+        url = task.data['callback_url']
+
+        logger.info('Send data to callback url [%s].', url)
+
+        with gevent.Timeout(deadline, requests.Timeout('Deadline {deadline}s exceeded.'.format(deadline=deadline))):
+            response = session.post(
+                url, data=serialize_payload(task, dumps), stream=True, *args, **kwargs
+            )
+            # the body is read here, not in session.post, to close the connection on the deadline
+            try:
+                response.content
+            except BaseException:
+                discard_response(response)
+                raise
+
+        logger.info('Callback url [%s] response status code=%s.', url, response.status_code)
+
+        if response.status_code >= 500:
+            logger.warning('Retry task id=%s later.', task.task_id)
+            action_name = 'retry'
+        else:
+            action_name = 'ack'
+    except requests.RequestException as exc:
+        logger.exception(exc)
+        action_name = 'retry'
+
+    task_queue.put((task, action_name))
+    return action_name
+
+
+def discard_response(response):
+    """
+    Закрывает соединение недочитанного ответа и возвращает его в пул.
+
+    urllib3 возвращает соединение в пул, только когда ответ прочитан до конца,
+    иначе место в пуле теряется.
+
+    :param response: ответ, полученный с stream=True
+    :type response: requests.Response
+    """
+    raw = response.raw
+    if raw._connection is not None:
+        raw._connection.close()
+    raw.release_conn()
+
+
+class LockedConnection(tarantool.Connection):
+    """
+    Соединение с tarantool, которое можно использовать из нескольких greenlet'ов.
+
+    Запросы выполняются по очереди: задачу нужно подтверждать через то же
+    соединение, через которое она была взята, а протокол не позволяет
+    отправлять запросы параллельно.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(LockedConnection, self).__init__(*args, **kwargs)
+        self.lock = RLock()
+
+    def call(self, func_name, *args, **kwargs):
+        with self.lock:
+            return super(LockedConnection, self).call(func_name, *args, **kwargs)
+
+
+def get_task_host(task):
+    """
+    Возвращает хост, на который отправляется уведомление задачи.
+
+    :param task: задача
+    :type task: tarantool_queue.Task
+
+    :rtype: str
+    """
+    return urlsplit(task.data.get('callback_url') or '').netloc.lower()
+
 
-        url = data.pop('callback_url')
-        data['id'] = task.task_id
+class HostScheduler(object):
+    """
+    Планировщик задач по хостам callback_url.
 
-        logger.info('Send data to callback url [{url}].'.format(url=url))
+    Для одного хоста одновременно выполняется не больше limit задач
+    (для отдельных хостов ограничение можно задать в limits),
+    хосты, для которых есть задачи, обслуживаются по кругу.
+    Задачи одного хоста ждут в планировщике не больше backlog штук.
+    """
 
-        response = requests.post(
-            url, data=json.dumps(data), *args, **kwargs
+    def __init__(self, limit, limits=None, backlog=None):
+        self.limit = limit
+        self.limits = limits or {}
+        self.backlog = backlog
+        self.pending = OrderedDict()
+        self.active = {}
+        self.pending_count = 0
+        self.host_done = Event()
+
+    def __len__(self):
+        return self.pending_count
+
+    def host_limit(self, host):
+        return self.limits.get(host, self.limit)
+
+    def ready_count(self):
+        """
+        Возвращает количество ожидающих задач хостов, у которых не исчерпано
+        ограничение на количество одновременных задач.
+
+        :rtype: int
+        """
+        return sum(
+            len(tasks) for host, tasks in self.pending.iteritems()
+            if self.active.get(host, 0) < self.host_limit(host)
         )
 
-        logger.info('Callback url [{url}] response status code={status_code}.'.format(
-            url=url, status_code=response.status_code
+    def add(self, task):
+        """
+        Добавляет задачу в очередь ее хоста.
+
+        :return: False, если у хоста уже ждут backlog задач и задача не добавлена
+        :rtype: bool
+        """
+        host = get_task_host(task)
+        tasks = self.pending.get(host)
+        if self.backlog is not None and len(tasks or ()) >= self.backlog:
+            return False
+
+        if tasks is None:
+            tasks = self.pending[host] = deque()
+        tasks.append(task)
+        self.pending_count += 1
+        return True
+
+    def pop(self):
+        """
+        Возвращает задачу следующего по кругу хоста, у которого не исчерпано
+        ограничение на количество одновременных задач, или None.
+
+        :rtype: tarantool_queue.Task
+        """
+        for host in self.pending.keys():
+            if self.active.get(host, 0) >= self.host_limit(host):
+                continue
+
+            tasks = self.pending.pop(host)
+            task = tasks.popleft()
+            if tasks:
+                self.pending[host] = tasks
+
+            self.pending_count -= 1
+            self.active[host] = self.active.get(host, 0) + 1
+            return task
+
+    def done(self, host, worker=None):
+        """
+        Отмечает, что задача хоста host выполнена.
+
+        :param host: хост
+        :type host: str
+        :param worker: завершившийся greenlet (передается при вызове через Greenlet.link)
+        """
+        self.active[host] -= 1
+        if not self.active[host]:
+            del self.active[host]
+        self.host_done.set()
+
+    def wait(self, timeout):
+        """
+        Ждет, пока не будет выполнена какая-нибудь задача, но не больше timeout секунд.
+        """
+        self.host_done.clear()
+        self.host_done.wait(timeout)
+
+    def drain(self):
+        """
+        Удаляет из планировщика и возвращает все ожидающие задачи.
+
+        :rtype: list
+        """
+        tasks = [task for tasks in self.pending.itervalues() for task in tasks]
+        self.pending.clear()
+        self.pending_count = 0
+        return tasks
+
+
+class CircuitBreaker(object):
+    """
+    Предохранитель для хостов callback_url.
+
+    После failure_threshold ошибок подряд цепь хоста размыкается (open):
+    задачи хоста не выполняются reset_timeout секунд. Затем цепь становится
+    полуоткрытой (half-open) и пропускает одну пробную задачу: если она выполнена
+    успешно, цепь замыкается (closed), иначе снова размыкается.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = {}
+        self.opened_at = {}
+        self.probing = set()
+
+    def state(self, host):
+        """
+        Возвращает состояние цепи хоста.
+
+        :param host: хост
+        :type host: str
+
+        :rtype: str
+        """
+        if host not in self.opened_at:
+            return self.CLOSED
+
+        if host in self.probing or time() - self.opened_at[host] < self.reset_timeout:
+            return self.OPEN
+
+        return self.HALF_OPEN
+
+    def allow(self, host):
+        """
+        Проверяет, можно ли выполнить задачу хоста.
+
+        В полуоткрытом состоянии разрешенная задача становится пробной.
+
+        :param host: хост
+        :type host: str
+
+        :rtype: bool
+        """
+        state = self.state(host)
+
+        if state == self.HALF_OPEN:
+            logger.info('Circuit of host [{host}] is half-open, send probe.'.format(host=host))
+            self.probing.add(host)
+
+        return state != self.OPEN
+
+    def done(self, host, worker):
+        """
+        Учитывает результат задачи хоста.
+
+        :param host: хост
+        :type host: str
+        :param worker: завершившийся greenlet, значение - имя действия над задачей
+        :type worker: gevent.Greenlet
+        """
+        self.probing.discard(host)
+
+        if worker.value == 'ack':
+            if self.opened_at.pop(host, None) is not None:
+                logger.info('Circuit of host [{host}] is closed.'.format(host=host))
+            self.failures.pop(host, None)
+            return
+
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if host in self.opened_at or self.failures[host] >= self.failure_threshold:
+            logger.warning('Circuit of host [{host}] is open after {count} failure(s).'.format(
+                host=host, count=self.failures[host]
+            ))
+            self.opened_at[host] = time()
+
+
+class PoolSizeController(object):
+    """
+    Подбирает размер пула обработчиков по времени обработки задач,
+    доле ошибок и количеству задач, ожидающих обработки.
+
+    Нужное количество обработчиков оценивается по закону Литтла:
+    (выполненные + ожидающие задачи) / длительность окна * среднее время обработки.
+    Если доля ошибок больше max_error_rate, пул не увеличивается.
+    """
+
+    def __init__(self, size, min_size, max_size, max_error_rate):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_error_rate = max_error_rate
+        self.reset()
+
+    def reset(self):
+        self.window_start = time()
+        self.completed = 0
+        self.errors = 0
+        self.total_latency = 0.0
+
+    def free_count(self, pool):
+        """
+        Возвращает количество свободных обработчиков с учетом текущего размера.
+
+        :param pool: пул размера max_size
+        :type pool: gevent.pool.Pool
+
+        :rtype: int
+        """
+        return max(pool.free_count() - (self.max_size - self.size), 0)
+
+    def done(self, started_at, worker):
+        """
+        Учитывает завершение обработчика, запущенного в started_at.
+
+        :param started_at: время запуска обработчика
+        :type started_at: float
+        :param worker: завершившийся greenlet, значение - имя действия над задачей
+        :type worker: gevent.Greenlet
+        """
+        self.completed += 1
+        self.total_latency += time() - started_at
+        if worker.value != 'ack':
+            self.errors += 1
+
+    def adjust(self, backlog):
+        """
+        Пересчитывает размер пула по статистике окна и начинает новое окно.
+
+        :param backlog: количество задач, ожидающих обработки
+        :type backlog: int
+
+        :return: новый размер пула
+        :rtype: int
+        """
+        if self.completed:
+            interval = max(time() - self.window_start, 1e-3)
+            latency = self.total_latency / self.completed
+            required = int(ceil((self.completed + backlog) / interval * latency))
+
+            if float(self.errors) / self.completed > self.max_error_rate:
+                required = min(required, self.size)
+        else:
+            required = self.size + backlog if backlog else self.min_size
+
+        self.size = max(self.min_size, min(self.max_size, required))
+        self.reset()
+        return self.size
+
+
+def adjust_pool_size(pool_size, tube, scheduled_count):
+    """
+    Пересчитывает размер пула по количеству готовых задач в tarantool.queue
+    (queue.statistics) и задач у планировщика.
+
+    :param pool_size: контроллер размера пула
+    :type pool_size: PoolSizeController
+    :param tube: очередь tarantool.queue
+    :type tube: tarantool_queue.Tube
+    :param scheduled_count: количество задач у планировщика
+    :type scheduled_count: int
+    """
+    stat = tube.statistics()
+    backlog = int(stat.get('tasks', {}).get('ready', 0)) + scheduled_count
+
+    old_size = pool_size.size
+    new_size = pool_size.adjust(backlog)
+
+    if new_size != old_size:
+        logger.info('Resize worker pool {old_size} -> {new_size}, backlog={backlog}.'.format(
+            old_size=old_size, new_size=new_size, backlog=backlog
         ))
 
-        task_queue.put((task, 'ack'))
-    except requests.RequestException as exc:
-        logger.exception(exc)
-        task_queue.put((task, 'bury'))
 
+class PoolTimeoutMixin(object):
+    """
+    Пул соединений urllib3, который использует таймауты пула (отдельные
+    на установку соединения и на чтение ответа) вместо таймаута запроса.
 
-def done_with_processed_tasks(task_queue):
+    Соединение запроса, завершившегося исключением (в том числе gevent.Timeout),
+    закрывается и его место возвращается в пул.
+    """
+
+    def _get_timeout(self, timeout):
+        return self.timeout.clone()
+
+    def _make_request(self, conn, method, url, **kwargs):
+        try:
+            return super(PoolTimeoutMixin, self)._make_request(conn, method, url, **kwargs)
+        except BaseException:
+            # requests calls urlopen with release_conn=False, so urlopen does not
+            # return the connection to the pool when the request fails
+            conn.close()
+            self._put_conn(None)
+            raise
+
+
+class PoolTimeoutHTTPConnectionPool(PoolTimeoutMixin, HTTPConnectionPool):
+    pass
+
+
+class PoolTimeoutHTTPSConnectionPool(PoolTimeoutMixin, HTTPSConnectionPool):
+    pass
+
+
+class PoolTimeoutManager(PoolManager):
+    """
+    PoolManager, создающий пулы соединений с таймаутами пула.
+    """
+
+    pool_classes_by_scheme = {
+        'http': PoolTimeoutHTTPConnectionPool,
+        'https': PoolTimeoutHTTPSConnectionPool,
+    }
+
+    def _new_pool(self, scheme, host, port):
+        kwargs = self.connection_pool_kw
+        if scheme == 'http':
+            kwargs = dict((key, value) for key, value in kwargs.iteritems() if key not in SSL_KEYWORDS)
+
+        return self.pool_classes_by_scheme[scheme](host, port, **kwargs)
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """
+    HTTP-адаптер с отдельными таймаутами на установку соединения и на чтение ответа.
+
+    requests 2.2 передает в urllib3 одно значение для обоих таймаутов,
+    поэтому таймауты задаются пулам соединений, а параметр timeout запроса не используется.
+    """
+
+    def __init__(self, connect_timeout, read_timeout, **kwargs):
+        self.timeout = HTTPTimeout(connect=connect_timeout, read=read_timeout)
+        super(TimeoutHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=requests.adapters.DEFAULT_POOLBLOCK):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+
+        self.poolmanager = PoolTimeoutManager(
+            num_pools=connections, maxsize=maxsize, block=block, timeout=self.timeout
+        )
+
+
+def create_http_session(config):
+    """
+    Создает http-сессию, общую для всех обработчиков.
+
+    Соединения к хостам переиспользуются: хранится не больше
+    config.HTTP_POOL_CONNECTIONS пулов, в каждом не больше
+    config.HTTP_POOL_MAXSIZE соединений к одному хосту.
+    Соединение устанавливается не дольше config.HTTP_CONNECT_TIMEOUT секунд,
+    ответ ждем не дольше config.HTTP_READ_TIMEOUT секунд между пакетами.
+
+    :param config: конфигурация
+    :type config: Config
+
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+
+    adapter = TimeoutHTTPAdapter(
+        connect_timeout=config.HTTP_CONNECT_TIMEOUT,
+        read_timeout=config.HTTP_READ_TIMEOUT,
+        pool_connections=config.HTTP_POOL_CONNECTIONS,
+        pool_maxsize=config.HTTP_POOL_MAXSIZE,
+        pool_block=config.HTTP_POOL_BLOCK
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if not config.HTTP_KEEP_ALIVE:
+        session.headers['Connection'] = 'close'
+
+    return session
+
+
+def done_with_processed_tasks(task_queue, action_args=None):
     """
     Удаляет завешенные задачи.
 
+    Задачи группируются по действию, и для каждого действия
+    в tarantool.queue отправляется один запрос.
+
     :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия)
+    :param action_args: словарь имя действия -> кортеж аргументов действия
+    :type action_args: dict
     """
-    logger.debug('Send info about finished tasks to queue.')
+    action_args = action_args or {}
+
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug('Send info about finished tasks to queue.')
+
+    tasks_by_action = {}
 
     for _ in xrange(task_queue.qsize()):
         try:
             task, action_name = task_queue.get_nowait()
-
-            logger.debug('{name} task#{task_id}.'.format(
-                name=action_name.capitalize(),
-                task_id=task.task_id
-            ))
-
-            try:
-                getattr(task, action_name)()
-            except tarantool.DatabaseError as exc:
-                logger.exception(exc)
         except gevent_queue.Empty:
             break
 
+        tasks_by_action.setdefault((task.queue, action_name), []).append(task)
+
+    for (_, action_name), tasks in tasks_by_action.iteritems():
+        if debug:
+            logger.debug('%s %s task(s).', action_name.capitalize(), len(tasks))
+
+        try:
+            errors = process_tasks(
+                tasks, TASK_ACTION_PROCEDURES.get(action_name, action_name), *action_args.get(action_name, ())
+            )
+        except tarantool.DatabaseError as exc:
+            logger.exception(exc)
+            continue
+
+        metrics.inc('pusher_tasks_total', (('action', action_name),), len(tasks) - len(errors))
+
+        for task, exc in errors:
+            logger.error('%s task#%s failed: %s', action_name.capitalize(), task.task_id, exc)
+
+
+def drain_workers(worker_pool, scheduler, task_queue, timeout):
+    """
+    Ждет завершения обработчиков, но не больше timeout секунд, и останавливает оставшиеся.
+
+    Задачи остановленных обработчиков и задачи, ожидающие у планировщика,
+    помещаются в task_queue для возврата в tarantool.queue (release).
+
+    :param worker_pool: пул обработчиков
+    :type worker_pool: gevent.pool.Pool
+    :param scheduler: планировщик задач
+    :type scheduler: HostScheduler
+    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия)
+    :type task_queue: gevent.queue.Queue
+    :param timeout: время ожидания обработчиков
+    :type timeout: float
+    """
+    logger.info('Wait for {count} worker(s) up to {timeout} second(s).'.format(
+        count=len(worker_pool), timeout=timeout
+    ))
+    worker_pool.join(timeout=timeout)
+
+    tasks = [worker.args[0] for worker in worker_pool]
+    if tasks:
+        logger.warning('Kill {count} unfinished worker(s).'.format(count=len(tasks)))
+        worker_pool.kill()
+
+    tasks.extend(scheduler.drain())
+
+    for task in tasks:
+        task_queue.put((task, 'release'))
+
 
 def stop_handler(signum):
     """
@@ -110,6 +823,31 @@ def stop_handler(signum):
     exit_code = SIGNAL_EXIT_CODE_OFFSET + signum
 
 
+def ack_flusher(task_queue, timeout, action_args=None):
+    """
+    Отправляет в tarantool.queue информацию о завершенных задачах,
+    как только они появляются в очереди.
+
+    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия)
+    :type task_queue: gevent.queue.Queue
+    :param timeout: как часто проверять, что приложение должно продолжать работу
+    :type timeout: float
+    :param action_args: словарь имя действия -> кортеж аргументов действия
+    :type action_args: dict
+    """
+    current_thread().name = 'pusher.flusher'
+
+    while run_application:
+        try:
+            task_queue.peek(timeout=timeout)
+        except gevent_queue.Empty:
+            continue
+
+        done_with_processed_tasks(task_queue, action_args)
+    else:
+        done_with_processed_tasks(task_queue, action_args)
+
+
 def main_loop(config):
     """
     Основной цикл приложения.
@@ -119,12 +857,28 @@ def main_loop(config):
 
     Алгоритм:
      * Открываем соединение с tarantool.queue, использую config.QUEUE_* настройки.
-     * Создаем пул обработчиков.
-     * Создаем очередь куда обработчики будут помещать выполненные задачи.
-     * Пока количество обработчиков <= config.WORKER_POOL_SIZE, берем задачу из tarantool.queue
-       и запускаем greenlet для ее обработки.
-     * Посылаем уведомления о том, что задачи завершены в tarantool.queue.
-     * Спим config.SLEEP секунд.
+     * Создаем пул обработчиков и общую для них http-сессию.
+     * Создаем очередь куда обработчики будут помещать выполненные задачи и запускаем greenlet,
+       который посылает в tarantool.queue уведомления о завершении задач по мере их появления.
+     * Ждем, пока в пуле появится свободный обработчик.
+     * Раз в config.WORKER_POOL_ADJUST_INTERVAL секунд пересчитываем размер пула
+       (от config.WORKER_POOL_MIN_SIZE до config.WORKER_POOL_MAX_SIZE).
+     * Запускаем greenlet'ы для задач, выбранных планировщиком: хосты обслуживаются по кругу,
+       для одного хоста одновременно выполняется не больше config.HOST_CONCURRENCY_LIMIT задач.
+       Задача обрабатывается не дольше config.HTTP_TASK_DEADLINE секунд.
+     * Забираем из tarantool.queue одним запросом столько задач, сколько свободных обработчиков,
+       но так, чтобы у планировщика было не больше config.SCHEDULER_BACKLOG_SIZE задач, готовых
+       к выполнению. Задачи хоста, у которого в планировщике уже ждут config.HOST_BACKLOG_SIZE задач,
+       возвращаются в очередь с задержкой config.HOST_BACKLOG_POSTPONE_DELAY секунд.
+     * Задачи, которые не удалось выполнить, возвращаются в очередь с экспоненциально растущей
+       задержкой (от config.RETRY_BASE_DELAY до config.RETRY_MAX_DELAY секунд) и хоронятся
+       после config.RETRY_MAX_ATTEMPTS попыток.
+     * После config.CIRCUIT_BREAKER_FAILURE_THRESHOLD ошибок подряд задачи хоста
+       config.CIRCUIT_BREAKER_RESET_TIMEOUT секунд не выполняются, а сразу возвращаются в очередь
+       с задержкой config.CIRCUIT_BREAKER_POSTPONE_DELAY секунд.
+     * После остановки ждем завершения обработчиков не больше config.DRAIN_TIMEOUT секунд,
+       отправляем в tarantool.queue информацию о завершенных задачах и возвращаем
+       в очередь незавершенные задачи и задачи планировщика.
     """
     logger.info('Connect to queue server on {host}:{port} space #{space}.'.format(
         host=config.QUEUE_HOST, port=config.QUEUE_PORT, space=config.QUEUE_SPACE
@@ -132,6 +886,7 @@ def main_loop(config):
     queue = tarantool_queue.Queue(
         host=config.QUEUE_HOST, port=config.QUEUE_PORT, space=config.QUEUE_SPACE
     )
+    queue.tarantool_connection = LockedConnection
 
     logger.info('Use tube [{tube}], take timeout={take_timeout}.'.format(
         tube=config.QUEUE_TUBE,
@@ -140,45 +895,133 @@ def main_loop(config):
 
     tube = queue.tube(config.QUEUE_TUBE)
 
-    logger.info('Create worker pool[{size}].'.format(size=config.WORKER_POOL_SIZE))
-    worker_pool = Pool(config.WORKER_POOL_SIZE)
+    logger.info('Create worker pool[{size}], min size={min_size}, max size={max_size}.'.format(
+        size=config.WORKER_POOL_SIZE, min_size=config.WORKER_POOL_MIN_SIZE, max_size=config.WORKER_POOL_MAX_SIZE
+    ))
+    worker_pool = Pool(config.WORKER_POOL_MAX_SIZE)
+    pool_size = PoolSizeController(
+        config.WORKER_POOL_SIZE,
+        config.WORKER_POOL_MIN_SIZE,
+        config.WORKER_POOL_MAX_SIZE,
+        config.WORKER_POOL_MAX_ERROR_RATE
+    )
+    adjust_at = time() + config.WORKER_POOL_ADJUST_INTERVAL
+
+    logger.info('Create http session, pool connections={connections}, pool maxsize={maxsize}.'.format(
+        connections=config.HTTP_POOL_CONNECTIONS, maxsize=config.HTTP_POOL_MAXSIZE
+    ))
+    session = create_http_session(config)
+    dumps = get_json_encoder(config.JSON_ENCODERS)
 
     processed_task_queue = gevent_queue.Queue()
 
-    logger.info('Run main loop. Worker pool size={count}. Sleep time is {sleep}.'.format(
-        count=config.WORKER_POOL_SIZE, sleep=config.SLEEP
+    logger.info('Retry failed tasks {attempts} times, delay from {base_delay} to {max_delay}.'.format(
+        attempts=config.RETRY_MAX_ATTEMPTS, base_delay=config.RETRY_BASE_DELAY, max_delay=config.RETRY_MAX_DELAY
     ))
+    action_args = {
+        'retry': (config.RETRY_MAX_ATTEMPTS, config.RETRY_BASE_DELAY, config.RETRY_MAX_DELAY),
+        'postpone': (config.CIRCUIT_BREAKER_POSTPONE_DELAY,),
+        'postpone_backlog': (config.HOST_BACKLOG_POSTPONE_DELAY,)
+    }
 
-    while run_application:
-        free_workers_count = worker_pool.free_count()
+    logger.info('Run ack flusher. Check time is {sleep}.'.format(sleep=config.SLEEP))
+    flusher = gevent.spawn(ack_flusher, processed_task_queue, config.SLEEP, action_args)
 
-        logger.debug('Pool has {count} free workers.'.format(count=free_workers_count))
+    logger.info('Create host scheduler, host limit={limit}, backlog size={size}, host backlog size={host_size}.'.format(
+        limit=config.HOST_CONCURRENCY_LIMIT, size=config.SCHEDULER_BACKLOG_SIZE, host_size=config.HOST_BACKLOG_SIZE
+    ))
+    scheduler = HostScheduler(
+        config.HOST_CONCURRENCY_LIMIT, config.HOST_CONCURRENCY_LIMITS, config.HOST_BACKLOG_SIZE
+    )
 
-        for number in xrange(free_workers_count):
-            logger.debug('Get task from tube for worker#{number}.'.format(number=number))
+    logger.info('Create circuit breaker, failure threshold={threshold}, reset timeout={timeout}.'.format(
+        threshold=config.CIRCUIT_BREAKER_FAILURE_THRESHOLD, timeout=config.CIRCUIT_BREAKER_RESET_TIMEOUT
+    ))
+    breaker = CircuitBreaker(config.CIRCUIT_BREAKER_FAILURE_THRESHOLD, config.CIRCUIT_BREAKER_RESET_TIMEOUT)
 
-            task = tube.take(config.QUEUE_TAKE_TIMEOUT)
+    metrics.gauge('pusher_worker_pool_size', lambda: pool_size.size)
+    metrics.gauge('pusher_worker_pool_free', lambda: pool_size.free_count(worker_pool))
+    metrics.gauge('pusher_processed_queue_size', processed_task_queue.qsize)
+    metrics.gauge('pusher_scheduled_tasks', scheduler.__len__)
 
-            if task:
-                logger.info('Start worker#{number} for task id={task_id}.'.format(
-                    task_id=task.task_id, number=number
-                ))
+    logger.info('Run main loop.')
+
+    try:
+        while run_application:
+            worker_pool.wait_available()
+
+            if not run_application:
+                break
+
+            if time() >= adjust_at:
+                adjust_pool_size(pool_size, tube, len(scheduler))
+                adjust_at = time() + config.WORKER_POOL_ADJUST_INTERVAL
+
+            number = 0
+            free_workers_count = pool_size.free_count(worker_pool)
+            while number < free_workers_count:
+                task = scheduler.pop()
+                if task is None:
+                    break
+
+                host = get_task_host(task)
+                if not breaker.allow(host):
+                    logger.info('Circuit of host [%s] is open, postpone task id=%s.', host, task.task_id)
+                    scheduler.done(host)
+                    processed_task_queue.put((task, 'postpone'))
+                    continue
+
+                logger.info('Start worker#%s for task id=%s.', number, task.task_id)
 
                 worker = Greenlet(
                     notification_worker,
                     task,
                     processed_task_queue,
-                    timeout=config.HTTP_CONNECTION_TIMEOUT,
+                    session,
+                    deadline=config.HTTP_TASK_DEADLINE,
+                    dumps=dumps,
                     verify=False
                 )
+                worker.link(partial(scheduler.done, host))
+                worker.link(partial(breaker.done, host))
+                worker.link(partial(pool_size.done, time()))
+                worker.link(partial(observe_callback, host, time()))
                 worker_pool.add(worker)
                 worker.start()
+                number += 1
 
-        done_with_processed_tasks(processed_task_queue)
+            free_workers_count = pool_size.free_count(worker_pool)
+            # tasks of hosts at their limit do not take backlog space from other hosts
+            take_count = min(free_workers_count, config.SCHEDULER_BACKLOG_SIZE - scheduler.ready_count())
 
-        sleep(config.SLEEP)
-    else:
-        logger.info('Stop application loop.')
+            if take_count > 0:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Get up to %s tasks from tube.', take_count)
+
+                started_at = time()
+                tasks = take_tasks(tube, take_count, config.QUEUE_TAKE_TIMEOUT)
+                metrics.observe('pusher_take_latency_seconds', time() - started_at)
+                metrics.inc('pusher_taken_tasks_total', value=len(tasks))
+
+                for task in tasks:
+                    if not scheduler.add(task):
+                        logger.info('Backlog of host [%s] is full, postpone task id=%s.',
+                                    get_task_host(task), task.task_id)
+                        processed_task_queue.put((task, 'postpone_backlog'))
+            else:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug('Wait for workers, %s tasks are scheduled.', len(scheduler))
+
+                scheduler.wait(config.SLEEP)
+    except Exception:
+        flusher.kill()
+        raise
+
+    logger.info('Stop application loop.')
+
+    drain_workers(worker_pool, scheduler, processed_task_queue, config.DRAIN_TIMEOUT)
+    flusher.join()
+    done_with_processed_tasks(processed_task_queue, action_args)
 
 
 def parse_cmd_args(args):
@@ -213,6 +1056,14 @@ def parse_cmd_args(args):
         dest='pidfile',
         help='Path to pidfile.'
     )
+    parser.add_argument(
+        '-p',
+        '--processes',
+        dest='processes',
+        type=int,
+        default=1,
+        help='Number of pusher processes.'
+    )
 
     return parser.parse_args(args=args)
 
@@ -298,24 +1149,45 @@ def init(args):
         os.path.realpath(os.path.expanduser(args.config))
     )
 
-    patch_all()
     dictConfig(config.LOGGING)
+    patch_all()
     current_thread().name = 'pusher.main'
     install_signal_handlers()
     return config
 
 
-def main(argv):
+def start_metrics_server(config):
     """
-    Точка входа в приложение.
+    Запускает http-сервер метрик на config.METRICS_HOST:config.METRICS_PORT.
 
-    В случае возникновения ошибки в приложении, оно засыпает на config.SLEEP_ON_FAIL секунд.
+    :param config: конфигурация
+    :type config: Config
 
-    :param argv: агрументы командной строки.
-    :type argv: list
+    :return: сервер или None, если config.METRICS_PORT не задан
+    :rtype: gevent.pywsgi.WSGIServer
     """
+    if not config.METRICS_PORT:
+        return None
+
+    from gevent.pywsgi import WSGIServer
+
+    logger.info('Serve metrics on {host}:{port}.'.format(host=config.METRICS_HOST, port=config.METRICS_PORT))
 
-    config = init(parse_cmd_args(argv[1:]))
+    server = WSGIServer((config.METRICS_HOST, config.METRICS_PORT), metrics, log=None)
+    server.start()
+    return server
+
+
+def run_pusher(config):
+    """
+    Запускает основной цикл и перезапускает его в случае ошибки.
+
+    В случае возникновения ошибки в приложении, оно засыпает на config.SLEEP_ON_FAIL секунд.
+
+    :param config: конфигурация
+    :type config: Config
+    """
+    metrics_server = start_metrics_server(config)
 
     while run_application:
         try:
@@ -330,6 +1202,152 @@ def main(argv):
     else:
         logger.info('Stop application loop in main.')
 
+    if metrics_server is not None:
+        metrics_server.stop()
+
+
+def spawn_pusher_process(config, number):
+    """
+    Запускает дочерний процесс, который обрабатывает задачи из той же очереди.
+
+    Обработчики сигналов наследуются от родительского процесса.
+    Сервер метрик процесса слушает порт config.METRICS_PORT + number.
+
+    :param config: конфигурация
+    :type config: Config
+    :param number: номер процесса
+    :type number: int
+
+    :return: pid дочернего процесса
+    :rtype: int
+    """
+    pid = os.fork()
+
+    if pid == 0:
+        code = 1
+        try:
+            current_thread().name = 'pusher.main#{number}'.format(number=number)
+            if config.METRICS_PORT:
+                config.METRICS_PORT += number
+            run_pusher(config)
+            code = exit_code
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    return pid
+
+
+def reap_pusher_processes(processes):
+    """
+    Удаляет из processes завершившиеся дочерние процессы.
+
+    :param processes: словарь pid -> номер процесса
+    :type processes: dict
+    """
+    while processes:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            processes.clear()
+            break
+
+        if not pid:
+            break
+
+        number = processes.pop(pid, None)
+        logger.log(
+            logging.ERROR if run_application else logging.INFO,
+            'Pusher process #{number} pid={pid} exited with status {status}.'.format(
+                number=number, pid=pid, status=status
+            )
+        )
+
+
+def supervise(config, count):
+    """
+    Запускает count процессов-обработчиков и перезапускает завершившиеся.
+
+    Процесс, проработавший меньше config.PROCESS_RESTART_MAX_DELAY секунд, перезапускается
+    с задержкой, которая удваивается при каждом таком завершении подряд: от
+    config.PROCESS_RESTART_BASE_DELAY до config.PROCESS_RESTART_MAX_DELAY секунд.
+
+    После получения сигнала завершения пересылает его обработчикам
+    и ждет их завершения.
+
+    :param config: конфигурация
+    :type config: Config
+    :param count: количество процессов
+    :type count: int
+    """
+    current_thread().name = 'pusher.supervisor'
+
+    processes = {}
+    started_at = {}
+    restart_at = {}
+    crashes = {}
+
+    while run_application:
+        running = set(processes.values())
+        now = time()
+        for number in xrange(count):
+            if number in running:
+                continue
+
+            if number in started_at:
+                uptime = now - started_at.pop(number)
+                crashes[number] = crashes.get(number, 0) + 1 if uptime < config.PROCESS_RESTART_MAX_DELAY else 0
+                if crashes[number]:
+                    delay = min(
+                        config.PROCESS_RESTART_BASE_DELAY * 2 ** (crashes[number] - 1),
+                        config.PROCESS_RESTART_MAX_DELAY
+                    )
+                    restart_at[number] = now + delay
+                    logger.error('Pusher process #{number} exited after {uptime:.1f}s, restart in {delay}s.'.format(
+                        number=number, uptime=uptime, delay=delay
+                    ))
+
+            if now < restart_at.get(number, 0):
+                continue
+
+            pid = spawn_pusher_process(config, number)
+            logger.info('Start pusher process #{number} pid={pid}.'.format(number=number, pid=pid))
+            processes[pid] = number
+            started_at[number] = now
+
+        sleep(config.SLEEP)
+        reap_pusher_processes(processes)
+
+    signum = exit_code - SIGNAL_EXIT_CODE_OFFSET
+    for pid in processes:
+        logger.info('Send signal #{signum} to pusher process pid={pid}.'.format(signum=signum, pid=pid))
+        os.kill(pid, signum)
+
+    while processes:
+        sleep(config.SLEEP)
+        reap_pusher_processes(processes)
+
+    logger.info('Stop supervisor.')
+
+
+def main(argv):
+    """
+    Точка входа в приложение.
+
+    Если указано больше одного процесса, текущий процесс становится
+    супервизором для процессов-обработчиков.
+
+    :param argv: агрументы командной строки.
+    :type argv: list
+    """
+    args = parse_cmd_args(argv[1:])
+    config = init(args)
+
+    if args.processes > 1:
+        supervise(config, args.processes)
+    else:
+        run_pusher(config)
+
     return exit_code
 
 
@@ -7,9 +7,10 @@ from logging.config import dictConfig
 from multiprocessing import active_children
 from time import sleep
 
+from lib.cache import start_shared_cache
 from lib.utils import (check_network_status, create_pidfile, daemonize,
                        load_config_from_pyfile, parse_cmd_args, spawn_workers)
-from lib.worker import worker
+from lib.worker import green_worker, worker
 
 logger = logging.getLogger('redirect_checker')
 
@@ -20,6 +21,17 @@ def main_loop(config):
             config.WORKER_POOL_SIZE, config.SLEEP
         ))
     parent_pid = os.getpid()
+    worker_target = worker
+    if config.WORKER_GREENLETS > 1:
+        worker_target = green_worker
+        logger.info(u'Worker greenlets per process={}.'.format(config.WORKER_GREENLETS))
+    worker_kwargs = {}
+    if config.REDIRECT_CACHE_SHARED:
+        worker_kwargs['cache'] = start_shared_cache(config.REDIRECT_CACHE_SIZE, config.REDIRECT_CACHE_TTL)
+        logger.info(u'Started shared redirect cache. Size={}. TTL is {}.'.format(
+            config.REDIRECT_CACHE_SIZE, config.REDIRECT_CACHE_TTL
+        ))
+
     while True:
         if check_network_status(config.CHECK_URL, config.HTTP_TIMEOUT):
             required_workers_count = config.WORKER_POOL_SIZE - len(
@@ -29,9 +41,10 @@ def main_loop(config):
                     'Spawning {} workers'.format(required_workers_count))
                 spawn_workers(
                     num=required_workers_count,
-                    target=worker,
+                    target=worker_target,
                     args=(config,),
-                    parent_pid=parent_pid
+                    parent_pid=parent_pid,
+                    kwargs=worker_kwargs
                 )
         else:
             logger.critical('Network is down. stopping workers')
@@ -0,0 +1,41 @@
+from BaseHTTPServer import HTTPServer
+import socket
+from SocketServer import ThreadingMixIn
+
+from gevent.monkey import get_original
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    Test server running in a real thread: other tests run gevent.monkey.patch_all.
+    """
+    daemon_threads = True
+    # engine tests open more concurrent connections than the default backlog of 5
+    request_queue_size = 128
+    timeout = 0.1
+
+    def start(self):
+        start_new_thread, allocate_lock = get_original('thread', ['start_new_thread', 'allocate_lock'])
+        self.running = True
+        self.stopped = allocate_lock()
+        self.stopped.acquire()
+        start_new_thread(self.run, ())
+
+    def run(self):
+        while self.running:
+            self.handle_request()
+        self.stopped.release()
+
+    def stop(self):
+        self.running = False
+        self.stopped.acquire()
+        self.server_close()
+
+
+def create_local_connection(address, timeout=None, source_address=None):
+    # run_tests.py forbids socket.create_connection, the test server is local
+    assert address[0] == '127.0.0.1'
+    sock = socket.socket()
+    sock.settimeout(timeout)
+    sock.connect(address)
+    return sock
@@ -1,5 +1,7 @@
+import re
 import unittest
 from mock import Mock, patch
+import source.lib
 from source.lib import *
 
 REDIRECT_META = 'meta_tag'
@@ -8,9 +10,71 @@ REDIRECT_HTTP = 'http_status'
 URL = 'http://url.ru'
 TIMEOUT = 5
 
+META_REFRESH = '<meta http-equiv="refresh" content="0; url=http://second.com/next?a=1&amp;b=2">'
+META_CORPUS = [
+    '',
+    'plain text without tags',
+    '<html><head><title>t</title></head><body>no meta</body></html>',
+    '<html><head>' + META_REFRESH + '</head></html>',
+    '<HTML><HEAD><META HTTP-EQUIV="REFRESH" CONTENT="5;URL=/relative/path"></HEAD></HTML>',
+    '<meta charset="utf-8"><meta http-equiv="refresh" content="0; url=http://second.com/">',
+    '<meta http-equiv="refresh" content="0; url=http://second.com/"/>',
+    '<meta http-equiv=refresh content=0;url=http://second.com/>',
+    "<meta http-equiv='refresh' content='0; url=\"http://second.com/\"'>",
+    '<meta http-equiv="refresh" http-equiv="none" content="0; url=http://second.com/">',
+    '<meta http-equiv="none" http-equiv="refresh" content="0; url=http://second.com/">',
+    '<meta http-equiv="refresh" content="0; url=http://first.com/" content="0; url=http://second.com/">',
+    '<meta http-equiv content="0; url=http://second.com/">',
+    '<meta http-equiv="refresh" content>',
+    '<meta http-equiv="refresh" content="0">',
+    '<meta http-equiv="refresh" content="0; url=http://second.com/; extra">',
+    '<!-- <meta http-equiv="refresh" content="0; url=http://comment.com/"> --><p>x</p>',
+    '<!-- ' + META_REFRESH + ' -->' + '<meta http-equiv="refresh" content="1; url=/after-comment">',
+    '<script>document.write(\'<meta http-equiv="refresh" content="0; url=http://script.com/">\')</script>',
+    '<script>var s = "<meta>";</script><meta http-equiv="refresh" content="0; url=/after-script">',
+    '<style>/* <meta http-equiv="refresh" content="0; url=/style"> */</style>',
+    '<textarea><meta http-equiv="refresh" content="0; url=/textarea"></textarea>',
+    '<a title="<meta http-equiv=refresh content=\'0; url=/attr\'>">link</a>',
+    '<html><head></head><body><p>text</p>' + META_REFRESH + '</body></html>',
+    '<![CDATA[<meta http-equiv="refresh" content="0; url=/cdata">]]>',
+    '<!DOCTYPE html><?xml version="1.0"?>' + META_REFRESH,
+    '<meta http-equiv="refresh" content="0; url=http://second.com/"',
+    '<meta\nhttp-equiv="refresh"\ncontent="0;\nurl=http://second.com/">',
+    '<metadata http-equiv="refresh" content="0; url=/metadata">',
+    '<meta/http-equiv="refresh" content="0; url=/slash">',
+    '<meta http-equiv="refresh" content="0; url=http://second.com/&#1087;&#1091;&#1090;&#1100;">',
+    '<meta http-equiv="refresh" content="0; url=http://second.com/&nbsp;&unknown;">',
+    '<meta http-equiv="Refresh" content="0; url=http://second.com/\xd0\xbf\xd1\x83\xd1\x82\xd1\x8c">',
+    '<meta http-equiv="Refresh" content="0; url=http://second.com/\xef\xf3\xf2\xfc">',
+    '<meta charset="windows-1251"><title>\xcf\xf0\xe8\xe2\xe5\xf2</title>'
+    '<meta http-equiv="refresh" content="0; url=http://second.com/\xef\xf3\xf2\xfc">',
+    '<title>\xd0\x9f\xd1\x80\xd0\xb8\xd0\xb2\xd0\xb5\xd1\x82</title>' + META_REFRESH,
+    '<p title="\xef\xf3\xf2\xfc &amp;">x</p>' + META_REFRESH,
+    u'<meta http-equiv="refresh" content="0; url=http://second.com/\u043f\u0443\u0442\u044c">',
+    u'<p>\u041f\u0440\u0438\u0432\u0435\u0442</p><meta http-equiv="refresh" content="0; url=/unicode">',
+    '\xef\xbb\xbf<meta http-equiv="refresh" content="0; url=/utf8-bom">',
+    u'<meta http-equiv="refresh" content="0; url=/utf16">'.encode('utf-16'),
+    '<meta http-equiv="refresh" content="0; URL = \'http://second.com/quoted\'">',
+    '<body onload="x">' * 50 + META_REFRESH,
+    '<html><head><script>' + 'var a = "<\\/script>";' * 100 + '</script>' + META_REFRESH + '</head></html>',
+    '<meta name="viewport"><meta http-equiv="refresh" content="0; url=/second-meta">',
+    '<meta http-equiv=" refresh " content="0; url=/spaces">',
+    '<noscript><meta http-equiv="refresh" content="0; url=/noscript"></noscript>',
+    '< meta http-equiv="refresh" content="0; url=/space-before-name">',
+    '<meta http-equiv="refresh" content="0; url=/ok"><meta http-equiv="refresh" content="0; url=/second">',
+    '<!--[if IE]><meta http-equiv="refresh" content="0; url=/ie"><![endif]-->',
+    '<! <meta http-equiv="refresh" content="0; url=/bogus-comment">',
+    '<meta http-equiv="refresh" content="0; url=/a"b">',
+]
+
 
 class LibInitTestCase(unittest.TestCase):
 
+    def setUp(self):
+        patcher = patch('source.lib.curl_pool', CurlPool())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_check_for_meta__meta_skip(self):
         content = """<nothing>"""
         self.assertIsNone(check_for_meta(content, 'http://first.com/'))
@@ -41,6 +105,41 @@ class LibInitTestCase(unittest.TestCase):
         content = """<meta http-equiv="refresh" content="5; url=""" + redirect_url + """">"""
         self.assertEquals(urljoin(this_url, redirect_url), check_for_meta(content, this_url))
 
+    def test_check_for_meta__same_as_beautiful_soup(self):
+        for content in META_CORPUS:
+            expected_attrs = find_meta_attrs_soup(content)
+            with patch('source.lib.find_meta_attrs', find_meta_attrs_soup):
+                expected = check_for_meta(content, 'http://first.com/')
+
+            self.assertEquals(expected_attrs, find_meta_attrs(content), repr(content))
+            self.assertEquals(expected, check_for_meta(content, 'http://first.com/'), repr(content))
+            self.assertEquals(type(expected), type(check_for_meta(content, 'http://first.com/')), repr(content))
+
+    def test_find_meta_attrs__without_meta_not_parsed(self):
+        with patch('source.lib.MetaTagParser') as parser:
+            with patch('source.lib.BeautifulSoup') as soup:
+                self.assertIsNone(find_meta_attrs('<html><body>' * 1000))
+
+        self.assertFalse(parser.called)
+        self.assertFalse(soup.called)
+
+    def test_find_meta_attrs__stops_at_first_meta(self):
+        content = '<meta http-equiv="refresh" content="0; url=/first">' + '</p>' * 1000
+        with patch.object(MetaTagParser, 'handle_endtag') as handle_endtag:
+            with patch('source.lib.BeautifulSoup') as soup:
+                attrs = find_meta_attrs(content)
+
+        self.assertEquals({'http-equiv': 'refresh', 'content': '0; url=/first'}, attrs)
+        self.assertFalse(handle_endtag.called)
+        self.assertFalse(soup.called)
+
+    def test_find_meta_attrs__not_ascii_content_fallback(self):
+        content = '<meta http-equiv="refresh" content="0; url=/\xef\xf3\xf2\xfc">'
+        with patch('source.lib.find_meta_attrs_soup', return_value={'content': 'soup'}) as soup:
+            self.assertEquals({'content': 'soup'}, find_meta_attrs(content))
+
+        soup.assert_called_once_with(content)
+
     def test_fix_market_url__ok_market_url(self):
         market_url = 'market://bestOfTheBestUrl'
         begin_http_url = 'http://play.google.com/store/apps/'
@@ -57,6 +156,39 @@ class LibInitTestCase(unittest.TestCase):
         return_counters = get_counters(content)
         self.assertEquals(['GOOGLE_ANALYTICS', 'YA_METRICA'], return_counters)
 
+    def test_get_counters__top_mail_ru_once(self):
+        content = 'top-fwz1.mail.ru/counter?id=1 top.mail.ru/jump?from=1'
+        self.assertEquals(['TOP_MAIL_RU'], get_counters(content))
+
+    def test_get_counters__ignore_case(self):
+        content = '<script src="//MC.Yandex.RU/metrika/watch.js"></script>'
+        self.assertEquals(['YA_METRICA'], get_counters(content))
+
+    def test_get_counters__unicode(self):
+        content = u'\u041f\u0440\u0438\u0432\u0435\u0442 counter.rambler.ru/top100'
+        self.assertEquals(['RAMBLER_TOP100'], get_counters(content))
+
+    def test_get_counters__same_as_regexps(self):
+        regexps = [
+            (name, re.compile(r'.*' + re.escape(needle) + r'.*', re.I + re.S)) for name, needle in COUNTER_TYPES
+        ]
+        contents = [
+            '',
+            'GOOGLE-ANALYTICS.COM/GA.JS\nMc.Yandex.Ru/Metrika/Watch.js',
+            'top-fwz1.mail.ru/counter.yadro.ru/hit counter.rambler.ru/top100',
+            '<img src="//googleads.g.doubleclick.net/pagead/viewthroughconversion/1/">'
+            '<script src="//a1.vdna-assets.com/analytics.js"></script>',
+            '\xd0\xa1\xd1\x87\xd0\xb5\xd1\x82\xd1\x87\xd0\xb8\xd0\xba top.mail.ru/jump?from=1',
+            'google-analytics.com/ga.j mc.yandex.ru/metrika/watch top.mail.ru/jump?fro',
+        ]
+        for content in contents:
+            expected = []
+            for name, regexp in regexps:
+                if regexp.match(content) and name not in expected:
+                    expected.append(name)
+
+            self.assertEquals(expected, get_counters(content), repr(content))
+
     def test_get_counters_null(self):
         content = 'content_without_counters'
         return_counters = get_counters(content)
@@ -154,6 +286,41 @@ class LibInitTestCase(unittest.TestCase):
                 self.assertEquals([URL, redirect_url], history_urls)
                 self.assertEquals(counters, return_counters)
 
+    def test_get_redirect_history__cache_miss(self):
+        cache = Mock()
+        cache.get.return_value = None
+        content = 'google-analytics.com/ga.js'
+        with patch('source.lib.get_url', return_value=[None, None, content]):
+            history_types, history_urls, return_counters = get_redirect_history(URL, TIMEOUT, cache=cache)
+
+        self.assertEquals(['GOOGLE_ANALYTICS'], return_counters)
+        cache.get.assert_called_once_with(URL)
+        cache.set.assert_called_once_with(URL, (None, None, ['GOOGLE_ANALYTICS']))
+
+    def test_get_redirect_history__cache_hit(self):
+        redirect_url = 'http://redirect-url.ru'
+        hops = {
+            URL: (redirect_url, REDIRECT_HTTP, []),
+            redirect_url: (None, None, ['YA_METRICA']),
+        }
+        cache = Mock()
+        cache.get.side_effect = hops.get
+        with patch('source.lib.get_url') as get_url:
+            result = get_redirect_history(URL, TIMEOUT, cache=cache)
+
+        self.assertEquals(([REDIRECT_HTTP], [URL, redirect_url], ['YA_METRICA']), result)
+        self.assertFalse(get_url.called)
+        self.assertFalse(cache.set.called)
+
+    def test_get_redirect_history__cache_error_not_saved(self):
+        cache = Mock()
+        cache.get.return_value = None
+        with patch('source.lib.get_url', return_value=[URL, 'ERROR', None]):
+            history_types, history_urls, return_counters = get_redirect_history(URL, TIMEOUT, cache=cache)
+
+        self.assertEquals(['ERROR'], history_types)
+        self.assertFalse(cache.set.called)
+
     def test_get_url__not_redirect(self):
         not_redirect_url = 'http://odnoklassniki.ru/redirect-url/st.redirect'
         with patch("source.lib.make_pycurl_request", return_value=['content', not_redirect_url]):
@@ -278,6 +445,160 @@ class LibInitTestCase(unittest.TestCase):
                     self.assertEquals('content', result_content)
                     self.assertEquals(url_none, result_redirect_url)
 
+    def test_make_pycurl_request__curl_returned_to_pool(self):
+        curl = Mock()
+        curl.getinfo.return_value = None
+        with patch('pycurl.Curl', return_value=curl):
+            make_pycurl_request(URL, TIMEOUT)
+            make_pycurl_request(URL, TIMEOUT)
+
+        self.assertEquals(2, curl.perform.call_count)
+        curl.setopt.assert_any_call(pycurl.SHARE, source.lib.curl_pool.share)
+        self.assertEquals(2, curl.reset.call_count)
+        self.assertFalse(curl.close.called)
+
+    def test_make_pycurl_request__curl_returned_to_pool_on_error(self):
+        curl = Mock()
+        curl.perform.side_effect = pycurl.error(7, 'connect error')
+        with patch('pycurl.Curl', return_value=curl):
+            self.assertRaises(pycurl.error, make_pycurl_request, URL, TIMEOUT)
+
+        self.assertEquals([curl], source.lib.curl_pool.handles)
+
+    def test_make_pycurl_request__max_body_bytes(self):
+        curl = Mock()
+        curl.getinfo.return_value = None
+
+        def perform():
+            write = [c[0][1] for c in curl.setopt.call_args_list if c[0][0] == curl.WRITEFUNCTION][0]
+            write('12345')
+            if write('67890') == 0:
+                raise pycurl.error(pycurl.E_WRITE_ERROR, 'Failure writing output to destination')
+
+        curl.perform.side_effect = perform
+        with patch('pycurl.Curl', return_value=curl):
+            result_content, result_redirect_url = make_pycurl_request(URL, TIMEOUT, max_body_bytes=7)
+
+        self.assertEquals('1234567', result_content)
+        self.assertIsNone(result_redirect_url)
+        # a Range request could get 206 or 416 instead of the page
+        self.assertNotIn(curl.RANGE, [c[0][0] for c in curl.setopt.call_args_list])
+
+    def test_make_pycurl_request__error_not_aborted(self):
+        curl = Mock()
+        curl.perform.side_effect = pycurl.error(pycurl.E_WRITE_ERROR, 'Failure writing output to destination')
+        with patch('pycurl.Curl', return_value=curl):
+            self.assertRaises(pycurl.error, make_pycurl_request, URL, TIMEOUT, max_body_bytes=7)
+
+    def test_pycurl_response__write_without_limit(self):
+        response = PycurlResponse()
+        self.assertIsNone(response.write('a' * 100))
+        self.assertEquals('a' * 100, response.getvalue())
+        self.assertFalse(response.aborted)
+
+    def test_pycurl_response__write_limit(self):
+        response = PycurlResponse(max_body_bytes=5)
+        self.assertIsNone(response.write('12345'))
+        self.assertEquals(0, response.write('6'))
+        self.assertEquals('12345', response.getvalue())
+        self.assertTrue(response.aborted)
+
+    def test_pycurl_response__header(self):
+        response = PycurlResponse()
+        response.header('HTTP/1.1 100 Continue\r\n')
+        response.header('HTTP/1.1 302 Found\r\n')
+        response.header('LOCATION: /next\r\n')
+        self.assertEquals(302, response.status)
+        self.assertEquals('/next', response.location)
+
+        response.header('HTTP/2 200\r\n')
+        self.assertEquals(200, response.status)
+        self.assertIsNone(response.location)
+
+    def test_pycurl_response__header_abort_redirect(self):
+        response = PycurlResponse()
+        self.assertIsNone(response.header('HTTP/1.1 302 Found\r\n'))
+        self.assertIsNone(response.header('Location: /next\r\n'))
+        self.assertEquals(0, response.header('\r\n'))
+        self.assertTrue(response.aborted)
+
+    def test_pycurl_response__header_abort_redirect_with_long_body(self):
+        response = PycurlResponse()
+        response.header('HTTP/1.1 302 Found\r\n')
+        response.header('Location: /next\r\n')
+        response.header('Content-Length: {}\r\n'.format(REDIRECT_BODY_MAX_BYTES + 1))
+        self.assertEquals(0, response.header('\r\n'))
+        self.assertTrue(response.aborted)
+
+    def test_pycurl_response__header_redirect_with_short_body(self):
+        response = PycurlResponse()
+        response.header('HTTP/1.1 302 Found\r\n')
+        response.header('Location: /next\r\n')
+        response.header('Content-Length: 5\r\n')
+        self.assertIsNone(response.header('\r\n'))
+        self.assertIsNone(response.write('moved'))
+        self.assertFalse(response.aborted)
+
+    def test_pycurl_response__header_redirect_without_location(self):
+        response = PycurlResponse()
+        response.header('HTTP/1.1 302 Found\r\n')
+        self.assertIsNone(response.header('\r\n'))
+        self.assertFalse(response.aborted)
+
+    def test_pycurl_response__header_not_redirect_with_location(self):
+        response = PycurlResponse()
+        response.header('HTTP/1.1 201 Created\r\n')
+        response.header('Location: /next\r\n')
+        self.assertIsNone(response.header('\r\n'))
+        self.assertFalse(response.aborted)
+
+    def test_read_pycurl_response__aborted_redirect(self):
+        curl = Mock()
+        curl.getinfo.side_effect = lambda info: {curl.REDIRECT_URL: None, curl.EFFECTIVE_URL: URL + '/a/b'}[info]
+        response = PycurlResponse(max_body_bytes=1)
+        response.header('HTTP/1.1 301 Moved Permanently\r\n')
+        response.header('Location: c\r\n')
+        response.write('body')
+
+        self.assertEquals(('b', URL + '/a/c'), read_pycurl_response(curl, response))
+
+    def test_read_pycurl_response__aborted_not_redirect(self):
+        curl = Mock()
+        curl.getinfo.return_value = None
+        response = PycurlResponse(max_body_bytes=1)
+        response.header('HTTP/1.1 200 OK\r\n')
+        response.header('Location: c\r\n')
+        response.write('body')
+
+        self.assertEquals(('b', None), read_pycurl_response(curl, response))
+
+    def test_curl_pool__close_over_size(self):
+        pool = CurlPool(size=1)
+        first, second = Mock(), Mock()
+        with patch('pycurl.Curl', side_effect=[first, second]):
+            self.assertIs(first, pool.get())
+            self.assertIs(second, pool.get())
+        pool.put(first)
+        pool.put(second)
+
+        self.assertEquals([first], pool.handles)
+        first.reset.assert_called_once_with()
+        second.close.assert_called_once_with()
+
+    def test_curl_pool__after_fork(self):
+        pool = CurlPool()
+        curl, new_curl = Mock(), Mock()
+        with patch('pycurl.Curl', side_effect=[curl, new_curl]):
+            pool.get()
+            share = pool.share
+            with patch('source.lib.os.getpid', return_value=-1):
+                pool.put(curl)
+                self.assertIs(new_curl, pool.get())
+
+        curl.close.assert_called_once_with()
+        self.assertIsNot(share, pool.share)
+        self.assertEquals([], pool.handles)
+
     def test_prepare_url__none_url(self):
         none_url = None
         self.assertEquals(prepare_url(none_url), none_url)
@@ -301,6 +622,45 @@ class LibInitTestCase(unittest.TestCase):
         result = prepare_url(url_bad_netloc)
         self.assertEquals(url_bad_netloc, result)
 
+    def test_prepare_url__same_as_normalize_url(self):
+        urls = [
+            'http://netloc/path;parameters?query=argument#fragment',
+            'http://netloc/ p a t h ;parameters?query=argument#fragment',
+            'http://.netloc/path',
+            'HTTP://Netloc:8080/path/?',
+            'https://user@netloc/a#b?q=a b',
+            'http://netloc/%D0%BF?q=%20&r=1',
+            '//netloc/path',
+            'http://\xd0\xbf\xd1\x80\xd0\xb8\xd0\xbc\xd0\xb5\xd1\x80.\xd1\x80\xd1\x84/\xd0\xbf',
+            u'http://\u043f\u0440\u0438\u043c\u0435\u0440.\u0440\u0444/?q=\u043f',
+        ]
+        with patch('source.lib.prepared_urls', {}):
+            for url in urls * 2:
+                expected, result = normalize_url(url), prepare_url(url)
+                self.assertEquals(expected, result)
+                self.assertIs(type(expected), type(result))
+
+    def test_prepare_url__normalized_url_not_parsed(self):
+        url = 'http://netloc/path/to?query=argument&b=%20#fragment'
+        with patch('source.lib.normalize_url') as normalize:
+            self.assertEquals(url, prepare_url(url))
+        self.assertFalse(normalize.called)
+
+    def test_prepare_url__memoized(self):
+        url = 'http://netloc/ p a t h '
+        with patch('source.lib.prepared_urls', {}):
+            with patch('source.lib.normalize_url', return_value=u'normalized') as normalize:
+                self.assertEquals(u'normalized', prepare_url(url))
+                self.assertEquals(u'normalized', prepare_url(url))
+        normalize.assert_called_once_with(url)
+
+    def test_prepare_url__memo_size_limited(self):
+        with patch('source.lib.prepared_urls', {}) as prepared_urls:
+            with patch('source.lib.PREPARED_URLS_SIZE', 2):
+                for url in ('http://a/ 1', 'http://a/ 2', 'http://a/ 3'):
+                    prepare_url(url)
+                self.assertEquals({'http://a/ 3': u'http://a/%203'}, prepared_urls)
+
     def test_to_unicode__from_unicode(self):
         self.assertEquals(to_unicode(u'unicode'), u'unicode')
         self.assertIsInstance(to_unicode(u'unicode'), unicode)
@@ -0,0 +1,63 @@
+import unittest
+from mock import Mock, patch
+from source.lib.cache import RedirectCache, start_shared_cache
+
+
+class LibCacheTestCase(unittest.TestCase):
+
+    def test_redirect_cache__miss(self):
+        cache = RedirectCache()
+        self.assertIsNone(cache.get('http://url.ru'))
+
+    def test_redirect_cache__set_get(self):
+        cache = RedirectCache()
+        cache.set('http://url.ru', ('http://redirect-url.ru', 'http_status', []))
+        self.assertEquals(('http://redirect-url.ru', 'http_status', []), cache.get('http://url.ru'))
+
+    def test_redirect_cache__ttl(self):
+        cache = RedirectCache(ttl=10)
+        with patch('source.lib.cache.time', return_value=100):
+            cache.set('http://url.ru', 'value')
+        with patch('source.lib.cache.time', return_value=110):
+            self.assertEquals('value', cache.get('http://url.ru'))
+        with patch('source.lib.cache.time', return_value=111):
+            self.assertIsNone(cache.get('http://url.ru'))
+        self.assertEquals({}, cache.items)
+
+    def test_redirect_cache__lru(self):
+        cache = RedirectCache(size=2)
+        cache.set('first', 1)
+        cache.set('second', 2)
+        cache.get('first')
+        cache.set('third', 3)
+
+        self.assertEquals(1, cache.get('first'))
+        self.assertIsNone(cache.get('second'))
+        self.assertEquals(3, cache.get('third'))
+
+    def test_redirect_cache__set_existing(self):
+        cache = RedirectCache(size=2)
+        cache.set('first', 1)
+        cache.set('second', 2)
+        cache.set('first', 10)
+        cache.set('third', 3)
+
+        self.assertEquals(10, cache.get('first'))
+        self.assertIsNone(cache.get('second'))
+
+    def test_start_shared_cache(self):
+        server_manager = Mock()
+        client_manager = Mock()
+        thread = Mock()
+        with patch('source.lib.cache.CacheManager', side_effect=[server_manager, client_manager]) as CacheManager:
+            with patch('source.lib.cache.Thread', return_value=thread) as Thread:
+                cache = start_shared_cache(10, 60)
+
+        server = server_manager.get_server.return_value
+        Thread.assert_called_once_with(target=server.serve_forever, name='redirect_cache')
+        self.assertTrue(thread.daemon)
+        thread.start.assert_called_once_with()
+        CacheManager.assert_called_with(address=server.address)
+        client_manager.connect.assert_called_once_with()
+        client_manager.RedirectCache.assert_called_once_with(10, 60)
+        self.assertEquals(client_manager.RedirectCache.return_value, cache)
@@ -0,0 +1,265 @@
+from BaseHTTPServer import BaseHTTPRequestHandler
+import socket
+import unittest
+
+import gevent
+from mock import Mock, patch
+from source.lib import get_redirect_history
+from source.lib.cache import RedirectCache
+from source.lib.engine import CurlMultiEngine, GeventCurlMultiEngine
+from source.tests.http_server import ThreadingHTTPServer
+
+TIMEOUT = 5
+
+COUNTERS_PAGE = '<html><script src="//google-analytics.com/ga.js"></script></html>'
+
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith('/redirect/'):
+            left = int(self.path.rsplit('/', 1)[1])
+            location = '/redirect/{}'.format(left - 1) if left else '/final'
+            self.send_response(302)
+            self.send_header('Location', location)
+            self.end_headers()
+        elif self.path == '/loop':
+            self.send_response(301)
+            self.send_header('Location', '/loop')
+            self.end_headers()
+        elif self.path == '/meta':
+            self.send_page('<html><head><meta http-equiv="refresh" content="0; url=/final"></head></html>')
+        elif self.path == '/final':
+            self.send_page(COUNTERS_PAGE)
+        elif self.path == '/big':
+            self.send_page(COUNTERS_PAGE + ' ' * 100000 + COUNTERS_PAGE.replace('google-analytics.com/ga.js',
+                                                                            'mc.yandex.ru/metrika/watch.js'))
+        elif self.path == '/big-redirect':
+            self.send_response(302)
+            self.send_header('Location', '/final')
+            self.end_headers()
+            self.wfile.write(' ' * 100000)
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def send_page(self, page):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, *args):
+        pass
+
+
+class KeepAliveRedirectHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.clients.add(self.client_address)
+        if self.path.startswith('/redirect/'):
+            left = int(self.path.rsplit('/', 1)[1])
+            location = '/redirect/{}'.format(left - 1) if left else '/final'
+            self.send_response(302)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '5')
+            self.end_headers()
+            self.wfile.write('moved')
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(COUNTERS_PAGE)))
+            self.end_headers()
+            self.wfile.write(COUNTERS_PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+def get_closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class LibEngineTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), RedirectHandler)
+        cls.base_url = 'http://127.0.0.1:{}'.format(cls.server.server_address[1])
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def get_urls(self):
+        return [
+            self.base_url + '/redirect/3',
+            self.base_url + '/meta',
+            self.base_url + '/loop',
+            self.base_url + '/final',
+            self.base_url + '/missing',
+            'http://127.0.0.1:{}/'.format(get_closed_port()),
+            'https://my.mail.ru/apps/',
+        ]
+
+    def test_get_redirect_histories__same_as_get_redirect_history(self):
+        urls = self.get_urls()
+        expected = [get_redirect_history(url, TIMEOUT) for url in urls]
+
+        results = CurlMultiEngine().get_redirect_histories(urls, TIMEOUT)
+
+        self.assertEquals(expected, results)
+
+    def test_get_redirect_histories__max_redirects(self):
+        url = self.base_url + '/redirect/5'
+
+        results = CurlMultiEngine().get_redirect_histories([url], TIMEOUT, max_redirects=2)
+
+        self.assertEquals([get_redirect_history(url, TIMEOUT, max_redirects=2)], results)
+        self.assertEquals(3, len(results[0][1]))
+
+    def test_get_redirect_histories__more_urls_than_transfers(self):
+        urls = [self.base_url + '/redirect/{}'.format(i % 4) for i in xrange(10)]
+        engine = CurlMultiEngine(max_transfers=3)
+        max_transfers = []
+        perform = engine.perform
+
+        def track_perform():
+            max_transfers.append(len(engine.handles))
+            perform()
+
+        with patch.object(engine, 'perform', side_effect=track_perform):
+            results = engine.get_redirect_histories(urls, TIMEOUT)
+
+        self.assertEquals([get_redirect_history(url, TIMEOUT) for url in urls], results)
+        self.assertEquals(3, max(max_transfers))
+        self.assertFalse(engine.handles)
+
+    def test_get_redirect_histories__http_redirects_counters(self):
+        results = CurlMultiEngine().get_redirect_histories([self.base_url + '/redirect/1'], TIMEOUT)
+
+        history_types, history_urls, counters = results[0]
+        self.assertEquals(['http_status', 'http_status'], history_types)
+        self.assertEquals(self.base_url + '/final', history_urls[-1])
+        self.assertEquals(['GOOGLE_ANALYTICS'], counters)
+
+    def test_get_redirect_histories__max_body_bytes(self):
+        urls = [self.base_url + '/big', self.base_url + '/big-redirect'] + self.get_urls()
+        expected = [get_redirect_history(url, TIMEOUT, max_body_bytes=1000) for url in urls]
+
+        results = CurlMultiEngine().get_redirect_histories(urls, TIMEOUT, max_body_bytes=1000)
+
+        self.assertEquals(expected, results)
+        self.assertEquals(([], [self.base_url + '/big'], ['GOOGLE_ANALYTICS']), results[0])
+        self.assertEquals((['http_status'], [self.base_url + '/big-redirect', self.base_url + '/final'],
+                           ['GOOGLE_ANALYTICS']), results[1])
+
+    def test_get_redirect_histories__without_max_body_bytes(self):
+        results = CurlMultiEngine().get_redirect_histories([self.base_url + '/big'], TIMEOUT)
+
+        self.assertEquals([([], [self.base_url + '/big'], ['GOOGLE_ANALYTICS', 'YA_METRICA'])], results)
+
+    def test_get_redirect_histories__redirect_body_skipped(self):
+        url = self.base_url + '/big-redirect'
+
+        results = CurlMultiEngine().get_redirect_histories([url], TIMEOUT)
+
+        self.assertEquals([get_redirect_history(url, TIMEOUT)], results)
+        self.assertEquals((['http_status'], [url, self.base_url + '/final'], ['GOOGLE_ANALYTICS']), results[0])
+
+    def test_get_redirect_histories__cache(self):
+        urls = self.get_urls()
+        cache = RedirectCache()
+        expected = CurlMultiEngine(cache=cache).get_redirect_histories(urls, TIMEOUT)
+
+        with patch('source.lib.engine.setup_pycurl_request', side_effect=ValueError('no requests')) as setup:
+            results = CurlMultiEngine(cache=cache).get_redirect_histories(urls, TIMEOUT)
+
+        self.assertEquals([get_redirect_history(url, TIMEOUT) for url in urls], expected)
+        self.assertEquals(expected, results)
+        # only the connection error is not cached
+        self.assertEquals(1, setup.call_count)
+
+    def test_add__callback(self):
+        callback = Mock()
+        engine = CurlMultiEngine()
+        engine.add(self.base_url + '/meta', TIMEOUT, callback=callback)
+
+        self.assertFalse(callback.called)
+        engine.run()
+
+        callback.assert_called_once_with(
+            (['meta_tag'], [self.base_url + '/meta', self.base_url + '/final'], ['GOOGLE_ANALYTICS'])
+        )
+
+    def test_add__ignored_url_finished_without_transfer(self):
+        callback = Mock()
+        engine = CurlMultiEngine()
+
+        engine.add('https://www.odnoklassniki.ru/', TIMEOUT, callback=callback)
+
+        callback.assert_called_once_with(([], ['https://www.odnoklassniki.ru/'], []))
+        self.assertFalse(engine.handles)
+        self.assertFalse(engine.pending)
+
+    def test_add__setup_error(self):
+        callback = Mock()
+        engine = CurlMultiEngine()
+
+        with patch('source.lib.engine.setup_pycurl_request', side_effect=ValueError('bad url')):
+            engine.add('http://url.ru', TIMEOUT, callback=callback)
+
+        callback.assert_called_once_with((['ERROR'], ['http://url.ru', 'http://url.ru'], []))
+        self.assertFalse(engine.handles)
+
+    def test_gevent_engine__concurrent_greenlets(self):
+        urls = self.get_urls() + [self.base_url + '/redirect/{}'.format(i % 4) for i in xrange(10)]
+        engine = GeventCurlMultiEngine()
+        max_transfers = []
+        perform = engine.perform
+
+        def track_perform():
+            max_transfers.append(len(engine.handles))
+            perform()
+
+        with patch.object(engine, 'perform', side_effect=track_perform):
+            greenlets = [gevent.spawn(engine.get_redirect_history, url, TIMEOUT) for url in urls]
+            gevent.joinall(greenlets, timeout=TIMEOUT * 4)
+
+        self.assertEquals([get_redirect_history(url, TIMEOUT) for url in urls], [g.value for g in greenlets])
+        # every greenlet waits for its chain while the others are transferred
+        self.assertEquals(len(urls) - 1, max(max_transfers))
+        self.assertFalse(engine.handles)
+        engine.runner.kill()
+
+    def test_gevent_engine__error_raised_in_caller(self):
+        engine = GeventCurlMultiEngine()
+        error = ValueError('bad page')
+        with patch('source.lib.engine.get_redirect_from_response', Mock(side_effect=error)):
+            greenlet = gevent.spawn(engine.get_redirect_history, self.base_url + '/redirect/1', TIMEOUT)
+            greenlet.join(timeout=TIMEOUT * 2)
+
+        self.assertTrue(greenlet.ready())
+        self.assertIs(error, greenlet.exception)
+        self.assertFalse(engine.handles)
+        # the engine keeps serving other callers
+        url = self.base_url + '/redirect/0'
+        self.assertEquals(get_redirect_history(url, TIMEOUT), engine.get_redirect_history(url, TIMEOUT))
+        engine.runner.kill()
+
+    def test_get_redirect_histories__reuses_connection_of_short_redirects(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveRedirectHandler)
+        server.clients = set()
+        server.start()
+        try:
+            url = 'http://127.0.0.1:{}/redirect/4'.format(server.server_address[1])
+            results = CurlMultiEngine().get_redirect_histories([url], TIMEOUT)
+        finally:
+            server.stop()
+
+        self.assertEquals(['http_status'] * 5, results[0][0])
+        self.assertEquals(1, len(server.clients))
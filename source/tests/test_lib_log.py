@@ -0,0 +1,79 @@
+import logging
+import unittest
+from StringIO import StringIO
+from mock import Mock, patch
+from source.lib.log import AsyncStreamHandler
+
+
+def make_record(msg, *args):
+    return logging.LogRecord('test', logging.INFO, __file__, 1, msg, args, None)
+
+
+class LibLogTestCase(unittest.TestCase):
+
+    def make_handler(self, stream, **kwargs):
+        with patch('source.lib.log.start_new_thread'):
+            handler = AsyncStreamHandler(stream, **kwargs)
+        self.addCleanup(handler.stopped.release)
+        return handler
+
+    def test_async_stream_handler(self):
+        stream = StringIO()
+        handler = AsyncStreamHandler(stream)
+
+        handler.handle(make_record('first %s', 1))
+        handler.handle(make_record('second %s', 2))
+        handler.close()
+
+        self.assertEqual(stream.getvalue(), 'first 1\nsecond 2\n')
+
+    def test_async_stream_handler_filter(self):
+        stream = StringIO()
+        handler = AsyncStreamHandler(stream)
+        handler.addFilter(Mock(filter=Mock(return_value=False)))
+
+        self.assertFalse(handler.handle(make_record('message')))
+        handler.close()
+
+        self.assertEqual(stream.getvalue(), '')
+
+    def test_async_stream_handler_handle_without_lock(self):
+        handler = self.make_handler(StringIO())
+        handler.lock = Mock()
+        record = make_record('message')
+
+        handler.handle(record)
+
+        self.assertFalse(handler.lock.acquire.called)
+        self.assertEqual(list(handler.records), [record])
+
+    def test_async_stream_handler_capacity(self):
+        stream = StringIO()
+        handler = self.make_handler(stream, capacity=1)
+
+        handler.handle(make_record('first'))
+        handler.handle(make_record('second'))
+        handler.write_records()
+
+        self.assertEqual(stream.getvalue(), 'second\n')
+
+    def test_async_stream_handler_after_fork(self):
+        handler = self.make_handler(StringIO())
+
+        with patch('os.getpid', Mock(return_value=handler.pid + 1)):
+            with patch.object(handler, 'start') as mock_start:
+                with patch('source.lib.log.Finalize') as mock_finalize:
+                    handler.handle(make_record('message'))
+
+        mock_start.assert_called_once_with()
+        mock_finalize.assert_called_once_with(handler, handler.close, exitpriority=0)
+
+    def test_async_stream_handler_close_after_fork(self):
+        stream = StringIO()
+        handler = self.make_handler(stream)
+        handler.handle(make_record('message'))
+
+        with patch('os.getpid', Mock(return_value=handler.pid + 1)):
+            handler.close()
+
+        self.assertEqual(stream.getvalue(), '')
@@ -114,6 +114,74 @@ class LibUtilsTestCase(unittest.TestCase):
             get_tube(host, port, space, name)
         Queue.assert_called_once_with(host=host, port=port, space=space)
 
+    def test_take_tasks(self):
+        tube = Mock(opt={'tube': 'tube'})
+        tube.queue.space = 0
+        tube.queue.tnt.call.return_value = [('id1', 'tube', 't', 'data1'), ('id2', 'tube', 't', 'data2')]
+
+        tasks = take_tasks(tube, 2, 0.5)
+
+        tube.queue.tnt.call.assert_called_once_with('queue.take_batch', ('0', 'tube', '2', '0.5'))
+        self.assertEquals(['id1', 'id2'], [task.task_id for task in tasks])
+        self.assertEquals(['data1', 'data2'], [task.raw_data for task in tasks])
+        self.assertIs(tube.queue, tasks[0].queue)
+
+    def test_ack_tasks(self):
+        queue = Mock(space=0)
+        queue.tnt.call.return_value = [('id2', 'Task not found')]
+        tasks = [Mock(queue=queue, task_id='id1'), Mock(queue=queue, task_id='id2')]
+
+        errors = ack_tasks(tasks)
+
+        method, args = queue.tnt.call.call_args[0]
+        self.assertEqual('queue.ack_many', method)
+        self.assertEqual('0', args[0])
+        self.assertEqual(['id1', 'id2'], sorted(args[1:]))
+        self.assertEqual(1, len(errors))
+        self.assertIs(tasks[1], errors[0][0])
+        self.assertIsInstance(errors[0][1], DatabaseError)
+        self.assertTrue(all(task.modified for task in tasks))
+
+    def test_take_tasks_empty(self):
+        tube = Mock(opt={'tube': 'tube'})
+        tube.queue.tnt.call.return_value = []
+
+        self.assertEqual([], take_tasks(tube, 2, 0))
+
+    def test_process_tasks_with_args(self):
+        queue = Mock(space=0)
+        queue.tnt.call.return_value = []
+        task = Mock(queue=queue, task_id='id1')
+
+        errors = process_tasks([task], 'retry', 5, 10, 600)
+
+        queue.tnt.call.assert_called_once_with('queue.retry_many', ('0', '5', '10', '600', 'id1'))
+        self.assertEqual([], errors)
+
+    def test_put_ack_tasks(self):
+        queue = Mock(space=0)
+        queue.tnt.call.return_value = [('id2', 'Task is not taken')]
+        tasks = [Mock(queue=queue, task_id='id1'), Mock(queue=queue, task_id='id2')]
+        input_tube = Mock(queue=queue, opt={'tube': 'input', 'delay': 0, 'ttl': 0, 'ttr': 0, 'pri': 0})
+        input_tube.serialize.side_effect = lambda data: 'packed ' + data
+        output_tube = Mock(queue=Mock(space=1), opt={'tube': 'output', 'delay': 0, 'ttl': 0, 'ttr': 0, 'pri': 0})
+        output_tube.serialize.side_effect = lambda data: 'packed ' + data
+
+        errors = put_ack_tasks([
+            (tasks[0], input_tube, 'recheck', {'delay': 300, 'pri': None}),
+            (tasks[1], output_tube, 'result', {}),
+        ])
+
+        queue.tnt.call.assert_called_once_with('queue.put_ack_many', (
+            '0',
+            'id1', '0', 'input', '300', '0', '0', '', 'packed recheck',
+            'id2', '1', 'output', '0', '0', '0', '0', 'packed result',
+        ))
+        self.assertEqual(1, len(errors))
+        self.assertIs(tasks[1], errors[0][0])
+        self.assertIsInstance(errors[0][1], DatabaseError)
+        self.assertTrue(all(task.modified for task in tasks))
+
     def test_spawn_workers(self):
         num = 3
         target = Mock()
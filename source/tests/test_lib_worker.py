@@ -1,5 +1,6 @@
+from Queue import Queue
 import unittest
-from mock import Mock, patch, MagicMock
+from mock import Mock, patch, MagicMock, call
 from source.lib.worker import *
 
 URL = 'http://url.ru'
@@ -60,8 +61,55 @@ class LibWorkerTestCase(unittest.TestCase):
             self.assertFalse(is_input_result)
             self.assertEquals(data_modified, result_data)
 
+    def test_get_redirect_history_from_task__engine(self):
+        task = Mock()
+        task.data = {
+            'url': 'url',
+            'url_id': 'url_id',
+        }
+        engine = Mock()
+        engine.get_redirect_history.return_value = [[], ['url'], []]
+        with patch('source.lib.worker.get_redirect_history') as get_redirect_history:
+            is_input_result, result_data = get_redirect_history_from_task(task, TIMEOUT, engine=engine)
+
+        self.assertFalse(get_redirect_history.called)
+        engine.get_redirect_history.assert_called_once_with(u'url', TIMEOUT, 30, None, None)
+        self.assertFalse(is_input_result)
+        self.assertEquals([[], ['url'], []], result_data['result'])
+
+    def run_worker(self, tasks, result, exists_count=None, input_tube=None, output_tube=None, ack_errors=(),
+                   put_ack=False):
+        config = Mock(QUEUE_BATCH_SIZE=10, QUEUE_TASK_TTR=60, MAX_REDIRECTS=3, HTTP_TIMEOUT=2, RECHECK_DELAY=300,
+                      REDIRECT_CACHE_SIZE=0, INPUT_QUEUE_HOST='input', INPUT_QUEUE_PORT=1, OUTPUT_QUEUE_PORT=1)
+        config.OUTPUT_QUEUE_HOST = 'input' if put_ack else 'output'
+        parent_pid = 42
+        input_tube = input_tube or MagicMock()
+        output_tube = output_tube or MagicMock()
+        if exists_count is None:
+            exists_count = len(tasks)
+        with patch('source.lib.worker.get_tube', side_effect=[input_tube, output_tube]):
+            with patch('os.path.exists', side_effect=[True] * exists_count + [False]):
+                with patch('source.lib.worker.take_tasks', side_effect=[tasks, []]) as take_tasks:
+                    with patch('source.lib.worker.ack_tasks', return_value=list(ack_errors)) as ack_tasks:
+                        with patch('source.lib.worker.put_ack_tasks', return_value=list(ack_errors)) as put_ack_tasks:
+                            with patch('source.lib.worker.get_redirect_history_from_task',
+                                       return_value=result) as get_redirect_history_from_task:
+                                with patch('source.lib.worker.logger') as logger:
+                                    worker(config, parent_pid)
+
+        self.put_ack_tasks = put_ack_tasks
+        return take_tasks, ack_tasks, get_redirect_history_from_task, logger
+
+    def test_get_take_size(self):
+        self.assertEquals(1, get_take_size(Mock(QUEUE_BATCH_SIZE=10, QUEUE_TASK_TTR=60, MAX_REDIRECTS=30,
+                                                HTTP_TIMEOUT=3)))
+        self.assertEquals(4, get_take_size(Mock(QUEUE_BATCH_SIZE=10, QUEUE_TASK_TTR=60, MAX_REDIRECTS=5,
+                                                HTTP_TIMEOUT=3)))
+        self.assertEquals(10, get_take_size(Mock(QUEUE_BATCH_SIZE=10, QUEUE_TASK_TTR=60, MAX_REDIRECTS=1,
+                                                 HTTP_TIMEOUT=1)))
+
     def test_worker__parent_proc_not_exist(self):
-        config = Mock()
+        config = Mock(QUEUE_BATCH_SIZE=10, QUEUE_TASK_TTR=60, MAX_REDIRECTS=3, HTTP_TIMEOUT=2)
         parent_pid = 42
         tube = MagicMock()
         with patch('source.lib.worker.get_tube', return_value=tube):
@@ -71,74 +119,163 @@ class LibWorkerTestCase(unittest.TestCase):
         self.assertEquals(os_path_exist.call_count, 1)
 
     def test_worker__not_task(self):
-        config = Mock()
-        parent_pid = 42
-        tube = MagicMock()
-        tube.take.return_value = None
-        with patch('source.lib.worker.get_tube', return_value=tube):
-            with patch('os.path.exists', side_effect=[True, False]):
-                with patch('source.lib.worker.get_redirect_history_from_task') as get_redirect_history_from_task:
-                    worker(config, parent_pid)
+        take_tasks, ack_tasks, get_redirect_history_from_task, _ = self.run_worker([], None, exists_count=1)
 
         self.assertEquals(get_redirect_history_from_task.call_count, 0)
+        self.assertFalse(ack_tasks.called)
 
     def test_worker__not_result(self):
-        config = Mock()
-        parent_pid = 42
-        tube = MagicMock()
         task = MagicMock()
-        tube.take.return_value=task
-        with patch('source.lib.worker.get_tube', return_value=tube):
-            with patch('os.path.exists', side_effect=[True, False]):
-                with patch('source.lib.worker.get_redirect_history_from_task', return_value=None):
-                    with patch('source.lib.worker.logger', ) as logger:
-                        worker(config, parent_pid)
+        _, ack_tasks, _, logger = self.run_worker([task], None)
 
+        ack_tasks.assert_called_once_with([task])
         self.assertEquals(logger.debug.call_count, 0)
 
     def test_worker__input_tube_put(self):
-        config = MagicMock()
-        parent_pid = 42
-        tube = MagicMock()
+        task = MagicMock()
+        task.meta.return_value = {'pri': 7}
+        input_tube = MagicMock()
+        _, ack_tasks, _, _ = self.run_worker([task], [True, 'data'], input_tube=input_tube)
+
+        input_tube.put.assert_called_once_with('data', delay=300, pri=7)
+        ack_tasks.assert_called_once_with([task])
+
+    def test_worker__input_tube_put_ack(self):
+        task = MagicMock()
         input_tube = MagicMock()
+        _, ack_tasks, _, _ = self.run_worker([task], [True, 'data'], input_tube=input_tube, put_ack=True)
+
+        self.put_ack_tasks.assert_called_once_with([(task, input_tube, 'data', {'delay': 300, 'pri': None})])
+        self.assertFalse(input_tube.put.called)
+        self.assertFalse(task.meta.called)
+        self.assertFalse(ack_tasks.called)
+
+    def test_worker__output_tube_put_ack(self):
+        tasks = [MagicMock(task_id='id1'), MagicMock(task_id='id2')]
         output_tube = MagicMock()
-        with patch('source.lib.worker.get_tube', return_value=tube):
-            with patch('os.path.exists', side_effect=[True, False]):
-                with patch('source.lib.worker.get_tube', side_effect=[input_tube, output_tube]):
-                    with patch('source.lib.worker.get_redirect_history_from_task', return_value=['is_input', 'data']):
-                        with patch('source.lib.worker.logger'):
-                            worker(config, parent_pid)
+        _, ack_tasks, _, logger = self.run_worker(tasks, [None, 'data'], output_tube=output_tube, put_ack=True)
+
+        logger.info.assert_any_call(u'Task id=%s done', 'id1')
+        logger.info.assert_any_call(u'Task id=%s done', 'id2')
+
+        self.assertEquals([(task, output_tube, 'data', {}) for task in tasks],
+                          sum([call_args[0][0] for call_args in self.put_ack_tasks.call_args_list], []))
+        self.assertFalse(output_tube.put.called)
+        self.assertFalse(ack_tasks.called)
 
-        self.assertEquals(input_tube.put.call_count, 1)
+    def test_worker__put_ack_errors_logged(self):
+        task = MagicMock(task_id='id1')
+        _, _, _, logger = self.run_worker([task], [None, 'data'], ack_errors=[(task, 'Task is not taken')],
+                                          put_ack=True)
+
+        logger.info.assert_any_call(u'Task id=%s ack fail: %s', 'id1', 'Task is not taken')
+        self.assertNotIn(call(u'Task id=%s done', 'id1'), logger.info.call_args_list)
 
     def test_worker__output_tube_put(self):
-        config = Mock()
-        parent_pid = 42
-        tube = MagicMock()
-        input_tube = MagicMock()
+        task = MagicMock()
         output_tube = MagicMock()
-        with patch('source.lib.worker.get_tube', return_value=tube):
-            with patch('os.path.exists', side_effect=[True, False]):
-                with patch('source.lib.worker.get_tube', side_effect=[input_tube, output_tube]):
-                    with patch('source.lib.worker.get_redirect_history_from_task', return_value=[None, 'data']):
-                        with patch('source.lib.worker.logger'):
-                            worker(config, parent_pid)
+        _, ack_tasks, _, _ = self.run_worker([task], [None, 'data'], output_tube=output_tube)
+
+        output_tube.put.assert_called_once_with('data')
+        ack_tasks.assert_called_once_with([task])
 
-        self.assertEquals(output_tube.put.call_count, 1)
+    def test_worker__prefetched_tasks(self):
+        tasks = [MagicMock(), MagicMock(), MagicMock()]
+        take_tasks, ack_tasks, get_redirect_history_from_task, _ = self.run_worker(tasks, [None, 'data'])
+
+        # 60 s of ttr fit 10 checks of 3 redirects with 2 s timeout
+        self.assertEquals(1, take_tasks.call_count)
+        self.assertEquals(10, take_tasks.call_args[0][1])
+        self.assertEquals(tasks, [call_args[0][0] for call_args in get_redirect_history_from_task.call_args_list])
+        self.assertEquals(tasks, sum([call_args[0][0] for call_args in ack_tasks.call_args_list], []))
+
+    def test_worker__put_error_not_acked(self):
+        from source.lib.worker import DatabaseError
+
+        tasks = [MagicMock(), MagicMock()]
+        output_tube = MagicMock()
+        output_tube.put.side_effect = [DatabaseError, None]
+        _, ack_tasks, _, logger = self.run_worker(tasks, [None, 'data'], output_tube=output_tube)
+
+        self.assertTrue(logger.exception.called)
+        self.assertEquals(tasks[1:], sum([call_args[0][0] for call_args in ack_tasks.call_args_list], []))
 
     def test_worker__database_error_exception(self):
         from source.lib.worker import DatabaseError
 
-        config = Mock()
+        task = MagicMock()
+        with patch('source.lib.worker.ack_tasks', side_effect=DatabaseError):
+            with patch('source.lib.worker.get_tube', return_value=MagicMock()):
+                with patch('os.path.exists', side_effect=[True, False]):
+                    with patch('source.lib.worker.take_tasks', return_value=[task]):
+                        with patch('source.lib.worker.get_redirect_history_from_task', return_value=None):
+                            with patch('source.lib.worker.logger') as logger:
+                                worker(Mock(QUEUE_BATCH_SIZE=10, QUEUE_TASK_TTR=60, MAX_REDIRECTS=3, HTTP_TIMEOUT=2), 42)
+
+        self.assertTrue(logger.exception.called)
+
+    def test_worker__ack_errors_logged(self):
+        task = MagicMock(task_id='id1')
+        _, _, _, logger = self.run_worker([task], None, ack_errors=[(task, 'Task not found')])
+
+        logger.info.assert_any_call(u'Task id=%s ack fail: %s', 'id1', 'Task not found')
+
+    def test_worker__flusher_dead(self):
+        with patch('source.lib.worker.flush_results'):
+            with patch('source.lib.worker.get_tube', return_value=MagicMock()):
+                with patch('os.path.exists', return_value=True):
+                    with patch('source.lib.worker.take_tasks', return_value=[]) as take_tasks:
+                        with patch('source.lib.worker.logger') as logger:
+                            with patch('source.lib.worker.threading.Thread.is_alive', return_value=False):
+                                worker(Mock(QUEUE_BATCH_SIZE=10, QUEUE_TASK_TTR=60, MAX_REDIRECTS=3, HTTP_TIMEOUT=2), 42)
+
+        self.assertFalse(take_tasks.called)
+        self.assertTrue(logger.error.called)
+
+    def test_flush_results__batches(self):
+        config = Mock(QUEUE_BATCH_SIZE=2, RECHECK_DELAY=300, INPUT_QUEUE_HOST='localhost', INPUT_QUEUE_PORT=1,
+                      OUTPUT_QUEUE_HOST='localhost', OUTPUT_QUEUE_PORT=1)
+        results = Queue()
+        for i in xrange(3):
+            results.put(('task{}'.format(i), None))
+        results.put(None)
+
+        with patch('source.lib.worker.send_results') as send_results:
+            flush_results(results, 'input', 'output', 'lock', config)
+
+        self.assertEquals([
+            (([('task0', None), ('task1', None)], 'input', 'output', 'lock', 300, True),),
+            (([('task2', None)], 'input', 'output', 'lock', 300, True),),
+        ], [tuple(call_args)[:1] for call_args in send_results.call_args_list])
+
+    def test_green_worker(self):
+        config = Mock(WORKER_GREENLETS=3, REDIRECT_CACHE_SIZE=10, REDIRECT_CACHE_TTL=60)
         parent_pid = 42
-        tube = MagicMock()
-        task = Mock()
-        tube.take.return_value = task
-        task.ack.side_effect = DatabaseError
-        with patch('source.lib.worker.get_tube', return_value=tube):
-            with patch('os.path.exists', side_effect=[True, False]):
-                with patch('source.lib.worker.get_redirect_history_from_task', return_value=None):
+        with patch('source.lib.worker.patch_all') as patch_all:
+            with patch('source.lib.worker.worker') as worker_mock:
+                with patch('os.path.exists', Mock(return_value=False)):
+                    green_worker(config, parent_pid)
+
+        self.assertEquals(1, patch_all.call_count)
+        self.assertEquals(3, worker_mock.call_count)
+        engines = set()
+        for call_args in worker_mock.call_args_list:
+            worker_config, worker_parent_pid, cache, engine = call_args[0]
+            self.assertIs(config, worker_config)
+            self.assertEquals(parent_pid, worker_parent_pid)
+            self.assertIsInstance(engine, GeventCurlMultiEngine)
+            self.assertIs(cache, engine.cache)
+            self.assertEquals(3, engine.max_transfers)
+            engines.add(engine)
+        self.assertEquals(1, len(engines))
+
+    def test_green_worker__respawns_failed_worker(self):
+        config = Mock(WORKER_GREENLETS=2, REDIRECT_CACHE_SIZE=10, REDIRECT_CACHE_TTL=60, SLEEP=0)
+        with patch('source.lib.worker.patch_all'):
+            with patch('source.lib.worker.worker', Mock(side_effect=[Exception('boom'), None, None])) as worker_mock:
+                with patch('os.path.exists', Mock(side_effect=[True, False, False])):
                     with patch('source.lib.worker.logger') as logger:
-                        worker(config, parent_pid)
+                        green_worker(config, 42)
 
-        self.assertTrue(logger.exception.called)
\ No newline at end of file
+        self.assertEquals(3, worker_mock.call_count)
+        self.assertEquals(1, logger.error.call_count)
@@ -1,21 +1,59 @@
+from BaseHTTPServer import BaseHTTPRequestHandler
+import gevent
 import json
 import requests
 import unittest
 import tarantool
 import source
 from tarantool_queue import tarantool_queue
-from mock import Mock, patch, mock_open
+from mock import Mock, MagicMock, patch, mock_open, ANY
 from gevent import queue as gevent_queue
+from gevent.pool import Pool
+from source.tests.http_server import ThreadingHTTPServer, create_local_connection
 from source.notification_pusher import notification_worker, daemonize, done_with_processed_tasks, \
-    install_signal_handlers, load_config_from_pyfile, parse_cmd_args, create_pidfile, main, init
+    install_signal_handlers, load_config_from_pyfile, parse_cmd_args, create_pidfile, main, init, \
+    create_http_session, ack_flusher, LockedConnection, \
+    get_task_host, get_json_encoder, serialize_payload, HostScheduler, CircuitBreaker, PoolSizeController, \
+    adjust_pool_size, spawn_pusher_process, \
+    reap_pusher_processes, supervise, drain_workers, Histogram, Metrics, observe_callback, \
+    start_metrics_server, run_pusher
 
 MAGIC_NUMBER = 42
 
 
-def app_stop(arg):
+class OkHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+def app_stop(*args):
     source.notification_pusher.run_application = False
 
 
+def stop_on_call(number):
+    calls = []
+
+    def side_effect(*args):
+        calls.append(args)
+        if len(calls) == number:
+            app_stop()
+    return side_effect
+
+
+def take_and_stop(tasks):
+    def take_tasks(*args):
+        app_stop()
+        return tasks
+    return take_tasks
+
+
 class NotificationPusherTestCase(unittest.TestCase):
     def test_notification_worker_ok(self):
         callback_url_str = 'callback_url'
@@ -23,14 +61,16 @@ class NotificationPusherTestCase(unittest.TestCase):
 
         task = Mock(task_id=MAGIC_NUMBER, data={callback_url_str: url, 'id': MAGIC_NUMBER})
         task_queue = Mock()
+        session = Mock()
+        session.post.return_value = Mock(status_code=200)
 
-        with patch('source.notification_pusher.requests.post') as mock_post:
-            notification_worker(task, task_queue)
+        action_name = notification_worker(task, task_queue, session)
 
         task.data.pop(callback_url_str)
-        mock_post.assert_called_with(url, data=json.dumps(task.data))
+        session.post.assert_called_with(url, data=json.dumps(task.data), stream=True)
 
         task_queue.put.assert_called_once_with((task, 'ack'))
+        self.assertEqual(action_name, 'ack')
 
     def test_notification_worker_with_except(self):
         callback_url_str = 'callback_url'
@@ -38,49 +78,564 @@ class NotificationPusherTestCase(unittest.TestCase):
 
         task = Mock(task_id=MAGIC_NUMBER, data={callback_url_str: url, 'id': MAGIC_NUMBER})
         task_queue = Mock()
+        session = Mock()
+        session.post.side_effect = requests.RequestException
 
-        with patch('source.notification_pusher.requests.post', side_effect=requests.RequestException) as mock_post:
-            notification_worker(task, task_queue)
+        action_name = notification_worker(task, task_queue, session)
 
         task.data.pop(callback_url_str)
-        mock_post.assert_called_with(url, data=json.dumps(task.data))
+        session.post.assert_called_with(url, data=json.dumps(task.data), stream=True)
+
+        task_queue.put.assert_called_once_with((task, 'retry'))
+        self.assertEqual(action_name, 'retry')
+
+    def test_notification_worker_deadline(self):
+        task = Mock(task_id=MAGIC_NUMBER, data={'callback_url': 'url'})
+        task_queue = Mock()
+        session = Mock()
+        session.post.side_effect = lambda *args, **kwargs: gevent.sleep(1)
+
+        action_name = notification_worker(task, task_queue, session, deadline=0.01, verify=False)
+
+        session.post.assert_called_once_with('url', data=ANY, stream=True, verify=False)
+        task_queue.put.assert_called_once_with((task, 'retry'))
+        self.assertEqual(action_name, 'retry')
+
+    def test_notification_worker_deadline_returns_pool_connections(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), OkHandler)
+        server.start()
+        self.addCleanup(server.stop)
+        url = 'http://127.0.0.1:{port}/'.format(port=server.server_address[1])
+        config = Mock(HTTP_CONNECT_TIMEOUT=1, HTTP_READ_TIMEOUT=1, HTTP_POOL_CONNECTIONS=1, HTTP_POOL_MAXSIZE=2,
+                      HTTP_POOL_BLOCK=True, HTTP_KEEP_ALIVE=True)
+        session = create_http_session(config)
+        deadline = requests.Timeout('Deadline 1s exceeded.')
+
+        def run_worker():
+            task = Mock(task_id=MAGIC_NUMBER, data={'callback_url': url})
+            with patch('socket.create_connection', create_local_connection):
+                return notification_worker(task, Mock(), session)
+
+        # the deadline fires while waiting for the response and while reading the body
+        with patch('requests.packages.urllib3.connectionpool.HTTPConnectionPool._make_request',
+                   side_effect=deadline):
+            self.assertEqual(['retry', 'retry', 'retry'], [run_worker() for _ in xrange(3)])
+        with patch('requests.packages.urllib3.response.HTTPResponse.read', side_effect=deadline):
+            self.assertEqual(['retry', 'retry', 'retry'], [run_worker() for _ in xrange(3)])
+
+        pool = session.get_adapter(url).poolmanager.connection_from_url(url)
+        self.assertEqual(2, pool.pool.qsize())
+        self.assertEqual('ack', run_worker())
+
+    def test_notification_worker_server_error(self):
+        task = Mock(task_id=MAGIC_NUMBER, data={'callback_url': 'url'})
+        task_queue = Mock()
+        session = Mock()
+        session.post.return_value = Mock(status_code=503)
+
+        action_name = notification_worker(task, task_queue, session)
+
+        task_queue.put.assert_called_once_with((task, 'retry'))
+        self.assertEqual(action_name, 'retry')
+
+    def test_serialize_payload(self):
+        task = Mock(task_id=MAGIC_NUMBER, data={'callback_url': 'url', 'id': 1, 'key': 'value'})
+
+        payload = serialize_payload(task)
+
+        self.assertEqual(json.loads(payload), {'id': MAGIC_NUMBER, 'key': 'value'})
+        self.assertEqual(task.data, {'callback_url': 'url', 'id': 1, 'key': 'value'})
+
+    def test_serialize_payload_with_dumps(self):
+        task = Mock(task_id=MAGIC_NUMBER, data={'callback_url': 'url'})
+        dumps = Mock(return_value='payload')
+
+        self.assertEqual(serialize_payload(task, dumps), 'payload')
+        dumps.assert_called_once_with({'id': MAGIC_NUMBER})
+
+    def test_get_json_encoder(self):
+        self.assertIs(get_json_encoder(['source.tests.missing_json_module', 'json']), json.dumps)
+
+    def test_get_json_encoder_options(self):
+        module = Mock()
+        with patch('importlib.import_module', Mock(return_value=module)):
+            dumps = get_json_encoder(['ujson'])
+
+        dumps({'url': 'http://host/'})
+
+        module.dumps.assert_called_once_with({'url': 'http://host/'}, escape_forward_slashes=False,
+                                             double_precision=15)
 
-        task_queue.put.assert_called_once_with((task, 'bury'))
+    def test_get_json_encoder_not_available(self):
+        self.assertRaises(ImportError, get_json_encoder, ['source.tests.missing_json_module'])
 
     def test_done_with_processed_tasks(self):
+        queue = Mock()
+        ack_task1 = Mock(queue=queue)
+        ack_task2 = Mock(queue=queue)
+        bury_task = Mock(queue=queue)
+
+        task_queue = Mock()
+        task_queue.get_nowait.side_effect = [(ack_task1, 'ack'), (bury_task, 'bury'), (ack_task2, 'ack')]
+        task_queue.qsize.return_value = 3
+
+        with patch('source.notification_pusher.process_tasks', Mock(return_value=[])) as mock_process_tasks:
+            done_with_processed_tasks(task_queue)
+
+        self.assertEqual(mock_process_tasks.call_count, 2)
+        mock_process_tasks.assert_any_call([ack_task1, ack_task2], 'ack')
+        mock_process_tasks.assert_any_call([bury_task], 'bury')
+        task_queue.qsize.assert_called_once_with()
+
+    def test_done_with_processed_tasks_action_args(self):
         task = Mock()
-        action_name = "test"
+        task_queue = Mock()
+        task_queue.get_nowait.return_value = (task, 'retry')
+        task_queue.qsize.return_value = 1
+
+        with patch('source.notification_pusher.process_tasks', Mock(return_value=[])) as mock_process_tasks:
+            done_with_processed_tasks(task_queue, {'retry': (5, 10, 600)})
 
+        mock_process_tasks.assert_called_once_with([task], 'retry', 5, 10, 600)
+
+    def test_done_with_processed_tasks_backlog_postpone(self):
+        task = Mock()
         task_queue = Mock()
-        task_queue.get_nowait.return_value = (task, action_name)
+        task_queue.get_nowait.return_value = (task, 'postpone_backlog')
         task_queue.qsize.return_value = 1
 
-        done_with_processed_tasks(task_queue)
+        with patch('source.notification_pusher.process_tasks', Mock(return_value=[])) as mock_process_tasks:
+            done_with_processed_tasks(task_queue, {'postpone': (10,), 'postpone_backlog': (5,)})
 
-        task.test.assert_called_once_with()
-        task_queue.qsize.assert_called_once_with()
+        mock_process_tasks.assert_called_once_with([task], 'postpone', 5)
 
     def test_done_with_processed_tasks_empty_exception(self):
         task_queue = Mock()
         task_queue.get_nowait.side_effect = gevent_queue.Empty
         task_queue.qsize.return_value = 1
 
-        done_with_processed_tasks(task_queue)
+        with patch('source.notification_pusher.process_tasks') as mock_process_tasks:
+            done_with_processed_tasks(task_queue)
 
+        self.assertFalse(mock_process_tasks.called)
         task_queue.qsize.assert_called_once_with()
 
     def test_done_with_processed_tasks_database_error_exception(self):
         task_queue = Mock()
-        task_queue.get_nowait.return_value = (Mock(), "test")
+        task_queue.get_nowait.return_value = (Mock(), 'ack')
         task_queue.qsize.return_value = 1
 
-        with patch('source.notification_pusher.getattr', Mock(side_effect=tarantool.DatabaseError), create=True):
+        with patch('source.notification_pusher.process_tasks', Mock(side_effect=tarantool.DatabaseError)):
             with patch('source.notification_pusher.logger.exception') as mock_exception:
                 done_with_processed_tasks(task_queue)
 
         self.assertEqual(mock_exception.call_count, 1)
         task_queue.qsize.assert_called_once_with()
 
+    def test_done_with_processed_tasks_task_error(self):
+        task = Mock()
+        task_queue = Mock()
+        task_queue.get_nowait.return_value = (task, 'bury')
+        task_queue.qsize.return_value = 1
+
+        with patch('source.notification_pusher.process_tasks',
+                   Mock(return_value=[(task, tarantool.DatabaseError('Task not found'))])):
+            with patch('source.notification_pusher.logger.error') as mock_error:
+                done_with_processed_tasks(task_queue)
+
+        self.assertEqual(mock_error.call_count, 1)
+
+    def test_histogram_observe(self):
+        histogram = Histogram((0.1, 1))
+
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        self.assertEqual(histogram.counts, [1, 2])
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.sum, 5.55)
+
+    def test_metrics_render(self):
+        metrics = Metrics(buckets=(1,))
+        metrics.inc('tasks_total', (('action', 'ack'),), 2)
+        metrics.inc('tasks_total', (('action', 'retry'),))
+        metrics.gauge('queue_size', lambda: 3)
+        metrics.observe('latency_seconds', 0.5, (('host', 'a"b'),))
+
+        self.assertEqual(metrics.render(), '\n'.join([
+            '# TYPE tasks_total counter',
+            'tasks_total{action="ack"} 2',
+            'tasks_total{action="retry"} 1',
+            '# TYPE queue_size gauge',
+            'queue_size 3',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{host="a\\"b",le="1"} 1',
+            'latency_seconds_bucket{host="a\\"b",le="+Inf"} 1',
+            'latency_seconds_sum{host="a\\"b"} 0.5',
+            'latency_seconds_count{host="a\\"b"} 1',
+        ]) + '\n')
+
+    def test_metrics_wsgi(self):
+        metrics = Metrics()
+        metrics.inc('tasks_total')
+        start_response = Mock()
+
+        body = metrics({'PATH_INFO': '/metrics'}, start_response)
+
+        self.assertEqual(body, ['# TYPE tasks_total counter\ntasks_total 1\n'])
+        self.assertEqual(start_response.call_args[0][0], '200 OK')
+
+    def test_metrics_wsgi_not_found(self):
+        start_response = Mock()
+
+        Metrics()({'PATH_INFO': '/'}, start_response)
+
+        self.assertEqual(start_response.call_args[0][0], '404 Not Found')
+
+    @patch('source.notification_pusher.metrics', Metrics(buckets=(1,)))
+    def test_observe_callback(self):
+        with patch('source.notification_pusher.time', Mock(return_value=12.0)):
+            observe_callback('host', 11.5, Mock(value='ack'))
+
+        metrics = source.notification_pusher.metrics
+        self.assertEqual(metrics.counters['pusher_callbacks_total'], {(('host', 'host'), ('result', 'ack')): 1})
+        self.assertEqual(metrics.histograms['pusher_callback_latency_seconds'][(('host', 'host'),)].sum, 0.5)
+
+    @patch('source.notification_pusher.metrics', Metrics())
+    def test_done_with_processed_tasks_metrics(self):
+        task1 = Mock()
+        task2 = Mock(queue=task1.queue)
+        task_queue = Mock()
+        task_queue.get_nowait.side_effect = [(task1, 'ack'), (task2, 'ack')]
+        task_queue.qsize.return_value = 2
+
+        with patch('source.notification_pusher.process_tasks',
+                   Mock(return_value=[(task2, tarantool.DatabaseError('Task not found'))])):
+            done_with_processed_tasks(task_queue)
+
+        self.assertEqual(source.notification_pusher.metrics.counters['pusher_tasks_total'], {(('action', 'ack'),): 1})
+
+    def test_get_task_host(self):
+        task = Mock(data={'callback_url': 'https://Partner.ru:8080/callback?a=b'})
+        self.assertEqual(get_task_host(task), 'partner.ru:8080')
+
+    def test_get_task_host_without_callback_url(self):
+        self.assertEqual(get_task_host(Mock(data={})), '')
+
+    def test_host_scheduler_round_robin(self):
+        scheduler = HostScheduler(limit=2)
+        tasks = [
+            Mock(data={'callback_url': 'http://first/1'}),
+            Mock(data={'callback_url': 'http://first/2'}),
+            Mock(data={'callback_url': 'http://second/1'}),
+        ]
+        for task in tasks:
+            scheduler.add(task)
+
+        self.assertEqual(len(scheduler), 3)
+        self.assertEqual([scheduler.pop() for _ in xrange(3)], [tasks[0], tasks[2], tasks[1]])
+        self.assertEqual(len(scheduler), 0)
+        self.assertIsNone(scheduler.pop())
+
+    def test_host_scheduler_host_limit(self):
+        scheduler = HostScheduler(limit=1, limits={'slow': 2})
+        slow_tasks = [Mock(data={'callback_url': 'http://slow/'}) for _ in xrange(3)]
+        fast_task = Mock(data={'callback_url': 'http://fast/'})
+        for task in slow_tasks + [fast_task]:
+            scheduler.add(task)
+
+        self.assertEqual([scheduler.pop() for _ in xrange(3)], [slow_tasks[0], fast_task, slow_tasks[1]])
+        self.assertIsNone(scheduler.pop())
+
+        scheduler.done('slow', Mock())
+
+        self.assertTrue(scheduler.host_done.is_set())
+        self.assertIs(scheduler.pop(), slow_tasks[2])
+
+    def test_host_scheduler_host_backlog(self):
+        scheduler = HostScheduler(limit=1, backlog=2)
+        slow_tasks = [Mock(data={'callback_url': 'http://slow/'}) for _ in xrange(3)]
+        fast_task = Mock(data={'callback_url': 'http://fast/'})
+
+        self.assertEqual([scheduler.add(task) for task in slow_tasks + [fast_task]], [True, True, False, True])
+        self.assertEqual(scheduler.ready_count(), 3)
+        self.assertIs(scheduler.pop(), slow_tasks[0])
+        # the other slow task waits for the host and is not ready
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(scheduler.ready_count(), 1)
+
+    def test_host_scheduler_rejected_task_not_pending(self):
+        scheduler = HostScheduler(limit=1, backlog=0)
+
+        self.assertFalse(scheduler.add(Mock(data={'callback_url': 'http://host/'})))
+        self.assertEqual(scheduler.pending, {})
+        self.assertIsNone(scheduler.pop())
+
+    def test_host_scheduler_done(self):
+        scheduler = HostScheduler(limit=1)
+        scheduler.add(Mock(data={'callback_url': 'http://host/'}))
+        scheduler.pop()
+
+        scheduler.done('host')
+
+        self.assertEqual(scheduler.active, {})
+
+    def test_host_scheduler_wait(self):
+        scheduler = HostScheduler(limit=1)
+        scheduler.host_done.set()
+
+        with patch.object(scheduler.host_done, 'wait') as mock_wait:
+            scheduler.wait(MAGIC_NUMBER)
+
+        self.assertFalse(scheduler.host_done.is_set())
+        mock_wait.assert_called_once_with(MAGIC_NUMBER)
+
+    def test_host_scheduler_drain(self):
+        scheduler = HostScheduler(limit=1)
+        task1 = Mock(data={'callback_url': 'http://a/'})
+        task2 = Mock(data={'callback_url': 'http://b/'})
+        scheduler.add(task1)
+        scheduler.add(task2)
+
+        self.assertEqual(sorted(scheduler.drain()), sorted([task1, task2]))
+        self.assertEqual(len(scheduler), 0)
+        self.assertIsNone(scheduler.pop())
+
+    def test_drain_workers(self):
+        finished_task = Mock()
+        unfinished_task = Mock()
+        scheduled_task = Mock(data={'callback_url': 'http://host/'})
+        scheduler = HostScheduler(limit=1)
+        scheduler.add(scheduled_task)
+        task_queue = gevent_queue.Queue()
+        worker_pool = Pool()
+        worker_pool.spawn(lambda task: task_queue.put((task, 'ack')), finished_task)
+        unfinished_worker = worker_pool.spawn(lambda task: gevent.sleep(10), unfinished_task)
+
+        drain_workers(worker_pool, scheduler, task_queue, 0.01)
+
+        self.assertTrue(unfinished_worker.dead)
+        self.assertEqual(len(worker_pool), 0)
+        self.assertEqual([task_queue.get_nowait() for _ in xrange(task_queue.qsize())], [
+            (finished_task, 'ack'), (unfinished_task, 'release'), (scheduled_task, 'release')
+        ])
+
+    def test_circuit_breaker_opens_after_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+        breaker.done('host', Mock(value='retry'))
+        self.assertTrue(breaker.allow('host'))
+
+        with patch('source.notification_pusher.time', Mock(return_value=100.0)):
+            breaker.done('host', Mock(value='retry'))
+
+        with patch('source.notification_pusher.time', Mock(return_value=110.0)):
+            self.assertEqual(breaker.state('host'), CircuitBreaker.OPEN)
+            self.assertFalse(breaker.allow('host'))
+        self.assertTrue(breaker.allow('other'))
+
+    def test_circuit_breaker_success_resets_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+
+        breaker.done('host', Mock(value='retry'))
+        breaker.done('host', Mock(value='ack'))
+        breaker.done('host', Mock(value='retry'))
+
+        self.assertEqual(breaker.state('host'), CircuitBreaker.CLOSED)
+
+    def test_circuit_breaker_half_open_probe(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+
+        with patch('source.notification_pusher.time', Mock(return_value=100.0)):
+            breaker.done('host', Mock(value='retry'))
+
+        with patch('source.notification_pusher.time', Mock(return_value=130.0)):
+            self.assertEqual(breaker.state('host'), CircuitBreaker.HALF_OPEN)
+            self.assertTrue(breaker.allow('host'))
+            self.assertFalse(breaker.allow('host'))
+
+            breaker.done('host', Mock(value='ack'))
+
+        self.assertEqual(breaker.state('host'), CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow('host'))
+
+    def test_circuit_breaker_half_open_probe_failed(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+
+        with patch('source.notification_pusher.time', Mock(return_value=100.0)):
+            breaker.done('host', Mock(value='retry'))
+
+        with patch('source.notification_pusher.time', Mock(return_value=130.0)):
+            breaker.allow('host')
+            breaker.done('host', Mock(value='retry'))
+            self.assertEqual(breaker.state('host'), CircuitBreaker.OPEN)
+
+    def test_pool_size_controller_free_count(self):
+        pool_size = PoolSizeController(size=3, min_size=1, max_size=10, max_error_rate=0.5)
+
+        self.assertEqual(pool_size.free_count(Mock(free_count=Mock(return_value=10))), 3)
+        self.assertEqual(pool_size.free_count(Mock(free_count=Mock(return_value=8))), 1)
+        self.assertEqual(pool_size.free_count(Mock(free_count=Mock(return_value=5))), 0)
+
+    def test_pool_size_controller_done(self):
+        pool_size = PoolSizeController(size=3, min_size=1, max_size=10, max_error_rate=0.5)
+
+        with patch('source.notification_pusher.time', Mock(return_value=12.0)):
+            pool_size.done(10.0, Mock(value='ack'))
+            pool_size.done(11.0, Mock(value='bury'))
+
+        self.assertEqual(pool_size.completed, 2)
+        self.assertEqual(pool_size.errors, 1)
+        self.assertEqual(pool_size.total_latency, 3.0)
+
+    def test_pool_size_controller_adjust_grow(self):
+        with patch('source.notification_pusher.time', Mock(return_value=0.0)):
+            pool_size = PoolSizeController(size=3, min_size=1, max_size=10, max_error_rate=0.5)
+        pool_size.completed = 10
+        pool_size.total_latency = 10.0
+
+        with patch('source.notification_pusher.time', Mock(return_value=2.0)):
+            self.assertEqual(pool_size.adjust(backlog=6), 8)
+
+        self.assertEqual(pool_size.completed, 0)
+        self.assertEqual(pool_size.window_start, 2.0)
+
+    def test_pool_size_controller_adjust_max_size(self):
+        with patch('source.notification_pusher.time', Mock(return_value=0.0)):
+            pool_size = PoolSizeController(size=3, min_size=1, max_size=10, max_error_rate=0.5)
+        pool_size.completed = 10
+        pool_size.total_latency = 10.0
+
+        with patch('source.notification_pusher.time', Mock(return_value=1.0)):
+            self.assertEqual(pool_size.adjust(backlog=100), 10)
+
+    def test_pool_size_controller_adjust_errors(self):
+        with patch('source.notification_pusher.time', Mock(return_value=0.0)):
+            pool_size = PoolSizeController(size=3, min_size=1, max_size=10, max_error_rate=0.5)
+        pool_size.completed = 10
+        pool_size.errors = 6
+        pool_size.total_latency = 10.0
+
+        with patch('source.notification_pusher.time', Mock(return_value=1.0)):
+            self.assertEqual(pool_size.adjust(backlog=100), 3)
+
+    def test_pool_size_controller_adjust_idle(self):
+        pool_size = PoolSizeController(size=3, min_size=1, max_size=10, max_error_rate=0.5)
+
+        self.assertEqual(pool_size.adjust(backlog=0), 1)
+
+    def test_pool_size_controller_adjust_no_completed(self):
+        pool_size = PoolSizeController(size=3, min_size=1, max_size=10, max_error_rate=0.5)
+
+        self.assertEqual(pool_size.adjust(backlog=4), 7)
+
+    def test_adjust_pool_size(self):
+        tube = Mock()
+        tube.statistics.return_value = {'tasks': {'ready': '5'}}
+        pool_size = Mock(size=1)
+        pool_size.adjust.return_value = 2
+
+        with patch('source.notification_pusher.logger') as mock_logger:
+            adjust_pool_size(pool_size, tube, 3)
+
+        pool_size.adjust.assert_called_once_with(8)
+        self.assertEqual(mock_logger.info.call_count, 1)
+
+    @patch('source.notification_pusher.tarantool_queue', Mock(spec=tarantool_queue))
+    @patch('source.notification_pusher.gevent.spawn', Mock())
+    def test_main_loop_adjust_pool_size(self):
+        config = self.init_config()
+        config.WORKER_POOL_ADJUST_INTERVAL = 0
+        mock_pool = MagicMock()
+        mock_pool().free_count.return_value = 0
+        mock_pool().wait_available.side_effect = stop_on_call(2)
+
+        with patch('source.notification_pusher.Pool', mock_pool):
+            with patch('source.notification_pusher.run_application', True):
+                with patch('source.notification_pusher.adjust_pool_size') as mock_adjust_pool_size:
+                    with patch('source.notification_pusher.HostScheduler.wait'):
+                        source.notification_pusher.main_loop(config)
+
+        self.assertEqual(mock_adjust_pool_size.call_count, 1)
+
+    @patch('source.notification_pusher.tarantool_queue', Mock(spec=tarantool_queue))
+    @patch('source.notification_pusher.gevent.spawn')
+    def test_main_loop_circuit_open(self, mock_spawn):
+        config = self.init_config()
+        task = Mock(data={'callback_url': 'http://host/'})
+        mock_pool = MagicMock()
+        mock_pool().free_count.return_value = 1
+        mock_pool().wait_available.side_effect = stop_on_call(3)
+
+        with patch('source.notification_pusher.Pool', mock_pool):
+            with patch('source.notification_pusher.run_application', True):
+                with patch('source.notification_pusher.Greenlet') as mock_greenlet:
+                    with patch('source.notification_pusher.CircuitBreaker.allow', Mock(return_value=False)):
+                        with patch('source.notification_pusher.take_tasks', Mock(side_effect=[[task], []])):
+                            with patch('source.notification_pusher.done_with_processed_tasks'):
+                                source.notification_pusher.main_loop(config)
+
+        self.assertFalse(mock_greenlet.called)
+        processed_task_queue = mock_spawn.call_args[0][1]
+        self.assertEqual(processed_task_queue.get_nowait(), (task, 'postpone'))
+
+    @patch('source.notification_pusher.tarantool_queue', Mock(spec=tarantool_queue))
+    @patch('source.notification_pusher.gevent.spawn')
+    def test_main_loop_slow_host_backlog(self, mock_spawn):
+        config = self.init_config()
+        slow_tasks = [Mock(data={'callback_url': 'http://slow/'}) for _ in xrange(3)]
+        fast_task = Mock(data={'callback_url': 'http://fast/'})
+        mock_pool = MagicMock()
+        mock_pool().free_count.return_value = 2
+        mock_pool().wait_available.side_effect = stop_on_call(4)
+        # workers of the slow host never finish
+        mock_take_tasks = Mock(side_effect=[slow_tasks, [fast_task], []])
+
+        with patch('source.notification_pusher.Pool', mock_pool):
+            with patch('source.notification_pusher.run_application', True):
+                with patch('source.notification_pusher.Greenlet') as mock_greenlet:
+                    with patch('source.notification_pusher.take_tasks', mock_take_tasks):
+                        with patch('source.notification_pusher.done_with_processed_tasks'):
+                            source.notification_pusher.main_loop(config)
+
+        # the slow task waiting for its host does not take backlog space of the fast host
+        self.assertEqual([call_args[0][1] for call_args in mock_take_tasks.call_args_list], [2, 2, 2])
+        self.assertEqual([call_args[0][1] for call_args in mock_greenlet.call_args_list], [slow_tasks[0], fast_task])
+        processed_task_queue = mock_spawn.call_args[0][1]
+        self.assertEqual(processed_task_queue.get_nowait(), (slow_tasks[2], 'postpone_backlog'))
+
+    def test_create_http_session(self):
+        config = self.init_config()
+
+        session = create_http_session(config)
+
+        adapter = session.get_adapter('https://example.com/')
+        self.assertIs(session.get_adapter('http://example.com/'), adapter)
+        self.assertEqual(adapter._pool_connections, config.HTTP_POOL_CONNECTIONS)
+        self.assertEqual(adapter._pool_maxsize, config.HTTP_POOL_MAXSIZE)
+        self.assertEqual(adapter._pool_block, config.HTTP_POOL_BLOCK)
+        self.assertNotEqual(session.headers.get('Connection'), 'close')
+
+    def test_create_http_session_timeouts(self):
+        config = self.init_config()
+
+        session = create_http_session(config)
+
+        for url in ('http://example.com/', 'https://example.com/'):
+            pool = session.get_adapter(url).get_connection(url)
+            timeout = pool._get_timeout(MAGIC_NUMBER)
+            self.assertEqual(timeout.connect_timeout, config.HTTP_CONNECT_TIMEOUT)
+            self.assertEqual(timeout.read_timeout, config.HTTP_READ_TIMEOUT)
+
+    def test_create_http_session_without_keep_alive(self):
+        config = self.init_config()
+        config.HTTP_KEEP_ALIVE = False
+
+        session = create_http_session(config)
+
+        self.assertEqual(session.headers['Connection'], 'close')
+
     def test_stop_handler(self):
         source.notification_pusher.run_application = True
 
@@ -100,29 +655,83 @@ class NotificationPusherTestCase(unittest.TestCase):
         config.WORKER_POOL_SIZE = 2
         config.QUEUE_TAKE_TIMEOUT = 0
         config.SLEEP = 0
-        config.HTTP_CONNECTION_TIMEOUT = 0
+        config.HTTP_CONNECT_TIMEOUT = 1
+        config.HTTP_READ_TIMEOUT = 2
+        config.HTTP_TASK_DEADLINE = 3
+        config.JSON_ENCODERS = ['json']
+        config.DRAIN_TIMEOUT = 0
+        config.HTTP_POOL_CONNECTIONS = 2
+        config.HTTP_POOL_MAXSIZE = 3
+        config.HTTP_POOL_BLOCK = True
+        config.HTTP_KEEP_ALIVE = True
+        config.HOST_CONCURRENCY_LIMIT = 1
+        config.HOST_CONCURRENCY_LIMITS = {}
+        config.SCHEDULER_BACKLOG_SIZE = 2
+        config.HOST_BACKLOG_SIZE = 2
+        config.HOST_BACKLOG_POSTPONE_DELAY = 5
+        config.WORKER_POOL_MIN_SIZE = 1
+        config.WORKER_POOL_MAX_SIZE = 2
+        config.WORKER_POOL_ADJUST_INTERVAL = 100
+        config.WORKER_POOL_MAX_ERROR_RATE = 0.5
+        config.RETRY_MAX_ATTEMPTS = 5
+        config.RETRY_BASE_DELAY = 10
+        config.RETRY_MAX_DELAY = 600
+        config.CIRCUIT_BREAKER_FAILURE_THRESHOLD = 2
+        config.CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+        config.CIRCUIT_BREAKER_POSTPONE_DELAY = 10
         return config
 
     @patch('source.notification_pusher.tarantool_queue', Mock(spec=tarantool_queue))
-    @patch('source.notification_pusher.sleep', Mock(side_effect=app_stop))
-    def test_main_loop(self):
+    @patch('source.notification_pusher.gevent.spawn')
+    def test_main_loop(self, mock_spawn):
         config = self.init_config()
-        mock_pool = Mock()
+        task = Mock(data={'callback_url': 'http://host/'})
+        mock_pool = MagicMock()
         mock_pool().free_count.return_value = 1
+        mock_pool().wait_available.side_effect = stop_on_call(3)
 
         with patch('source.notification_pusher.Pool', mock_pool):
             with patch('source.notification_pusher.run_application', True):
                 with patch('source.notification_pusher.Greenlet') as mock_greenlet:
-                    source.notification_pusher.main_loop(config)
+                    with patch('source.notification_pusher.take_tasks', Mock(side_effect=[[task], []])):
+                        source.notification_pusher.main_loop(config)
 
         self.assertEqual(mock_greenlet.call_count, 1)
+        self.assertIs(mock_greenlet.call_args[0][1], task)
         self.assertEqual(mock_greenlet().start.call_count, 1)
+        self.assertEqual(mock_greenlet().link.call_count, 4)
+        mock_spawn.assert_called_once_with(
+            source.notification_pusher.ack_flusher, ANY, config.SLEEP, {'retry': (5, 10, 600), 'postpone': (10,), 'postpone_backlog': (5,)}
+        )
+        mock_spawn().join.assert_called_once_with()
 
     @patch('source.notification_pusher.tarantool_queue', Mock(spec=tarantool_queue))
-    @patch('source.notification_pusher.sleep', Mock(side_effect=app_stop))
+    @patch('source.notification_pusher.gevent.spawn')
+    def test_main_loop_drain(self, mock_spawn):
+        config = self.init_config()
+        mock_pool = MagicMock()
+        mock_pool().wait_available.side_effect = app_stop
+        calls = []
+
+        with patch('source.notification_pusher.Pool', mock_pool):
+            with patch('source.notification_pusher.run_application', True):
+                with patch('source.notification_pusher.drain_workers',
+                           Mock(side_effect=lambda *args: calls.append('drain'))) as mock_drain:
+                    mock_spawn().join.side_effect = lambda: calls.append('join')
+                    with patch('source.notification_pusher.done_with_processed_tasks',
+                               Mock(side_effect=lambda *args: calls.append('flush'))) as mock_done:
+                        source.notification_pusher.main_loop(config)
+
+        self.assertEqual(calls, ['drain', 'join', 'flush'])
+        mock_drain.assert_called_once_with(mock_pool(), ANY, ANY, config.DRAIN_TIMEOUT)
+        processed_task_queue = mock_spawn.call_args[0][1]
+        mock_done.assert_called_once_with(processed_task_queue, mock_spawn.call_args[0][3])
+
+    @patch('source.notification_pusher.tarantool_queue', Mock(spec=tarantool_queue))
+    @patch('source.notification_pusher.gevent.spawn', Mock())
     def test_main_loop_false(self):
         config = self.init_config()
-        mock_pool = Mock()
+        mock_pool = MagicMock()
         mock_pool().free_count.return_value = 1
 
         with patch('source.notification_pusher.Pool', mock_pool):
@@ -133,50 +742,108 @@ class NotificationPusherTestCase(unittest.TestCase):
         self.assertFalse(mock_greenlet.called)
         self.assertFalse(mock_greenlet().start.called)
 
-    @patch('source.notification_pusher.sleep', Mock(side_effect=app_stop))
-    def test_main_loop_empty(self):
+    @patch('source.notification_pusher.gevent.spawn', Mock())
+    def test_main_loop_stopped_while_waiting_for_worker(self):
         config = self.init_config()
-        mock_pool = Mock()
-        mock_pool().free_count.return_value = 0
+        mock_pool = MagicMock()
+        mock_pool().wait_available.side_effect = app_stop
 
         with patch('source.notification_pusher.Pool', mock_pool):
             with patch('source.notification_pusher.run_application', True):
                 with patch('source.notification_pusher.Greenlet') as mock_greenlet:
-                    with patch('source.notification_pusher.tarantool_queue',
-                               Mock(spec=tarantool_queue)) as mock_tarantool_queue:
-                        source.notification_pusher.main_loop(config)
+                    with patch('source.notification_pusher.tarantool_queue', Mock(spec=tarantool_queue)):
+                        with patch('source.notification_pusher.take_tasks') as mock_take_tasks:
+                            source.notification_pusher.main_loop(config)
 
-        self.assertFalse(mock_tarantool_queue.Queue().tube().take.called)
+        self.assertFalse(mock_take_tasks.called)
         self.assertFalse(mock_greenlet.called)
         self.assertFalse(mock_greenlet().start.called)
 
-    @patch('source.notification_pusher.sleep', Mock(side_effect=app_stop))
+    @patch('source.notification_pusher.tarantool_queue', Mock(spec=tarantool_queue))
+    @patch('source.notification_pusher.gevent.spawn', Mock())
+    def test_main_loop_backlog_full(self):
+        config = self.init_config()
+        config.SCHEDULER_BACKLOG_SIZE = 0
+        mock_pool = MagicMock()
+        mock_pool().free_count.return_value = 1
+        mock_pool().wait_available.side_effect = stop_on_call(2)
+
+        with patch('source.notification_pusher.Pool', mock_pool):
+            with patch('source.notification_pusher.run_application', True):
+                with patch('source.notification_pusher.take_tasks') as mock_take_tasks:
+                    with patch('source.notification_pusher.HostScheduler.wait') as mock_wait:
+                        source.notification_pusher.main_loop(config)
+
+        self.assertFalse(mock_take_tasks.called)
+        mock_wait.assert_called_once_with(config.SLEEP)
+
+    @patch('source.notification_pusher.gevent.spawn', Mock())
     def test_main_loop_no_task(self):
         config = self.init_config()
-        mock_pool = Mock()
+        mock_pool = MagicMock()
         mock_pool().free_count.return_value = 1
         mock_tarantool_queue = Mock(spec=tarantool_queue)
-        mock_tarantool_queue.Queue().tube().take.return_value = False
 
         with patch('source.notification_pusher.Pool', mock_pool):
             with patch('source.notification_pusher.run_application', True):
                 with patch('source.notification_pusher.Greenlet') as mock_greenlet:
                     with patch('source.notification_pusher.tarantool_queue', mock_tarantool_queue):
-                        source.notification_pusher.main_loop(config)
+                        with patch('source.notification_pusher.take_tasks',
+                                   Mock(side_effect=take_and_stop([]))) as mock_take_tasks:
+                            source.notification_pusher.main_loop(config)
 
-        mock_tarantool_queue.Queue().tube().take.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
+        mock_take_tasks.assert_called_once_with(mock_tarantool_queue.Queue().tube(), 1, config.QUEUE_TAKE_TIMEOUT)
         self.assertFalse(mock_greenlet.called)
         self.assertFalse(mock_greenlet().start.called)
 
+    @patch('source.notification_pusher.tarantool_queue', Mock(spec=tarantool_queue))
+    @patch('source.notification_pusher.gevent.spawn')
+    def test_main_loop_exception_kills_flusher(self, mock_spawn):
+        config = self.init_config()
+        mock_pool = MagicMock()
+        mock_pool().free_count.return_value = 1
+
+        with patch('source.notification_pusher.Pool', mock_pool):
+            with patch('source.notification_pusher.run_application', True):
+                with patch('source.notification_pusher.take_tasks', Mock(side_effect=tarantool.NetworkError)):
+                    self.assertRaises(tarantool.NetworkError, source.notification_pusher.main_loop, config)
+
+        mock_spawn().kill.assert_called_once_with()
+        self.assertFalse(mock_spawn().join.called)
+
+    def test_ack_flusher(self):
+        task_queue = Mock()
+        task_queue.peek.side_effect = [gevent_queue.Empty, None]
+
+        with patch('source.notification_pusher.run_application', True):
+            with patch('source.notification_pusher.done_with_processed_tasks',
+                       Mock(side_effect=app_stop)) as mock_done:
+                ack_flusher(task_queue, MAGIC_NUMBER)
+
+        task_queue.peek.assert_called_with(timeout=MAGIC_NUMBER)
+        self.assertEqual(task_queue.peek.call_count, 2)
+        self.assertEqual(mock_done.call_count, 2)
+
+    def test_locked_connection_call(self):
+        with patch('source.notification_pusher.tarantool.Connection.__init__', Mock(return_value=None)):
+            connection = LockedConnection('localhost', MAGIC_NUMBER)
+
+        with patch('source.notification_pusher.tarantool.Connection.call', autospec=True) as mock_call:
+            mock_call.return_value = MAGIC_NUMBER
+            self.assertEqual(connection.call('queue.take', 'args'), MAGIC_NUMBER)
+
+        mock_call.assert_called_once_with(connection, 'queue.take', 'args')
+
     def test_parse_cmd_args__abbr(self):
         cfg = '/conf'
         pidfile = '/pidfile'
 
-        parsed_args = parse_cmd_args(['-c', cfg, '-P', pidfile, '-d'])
+        parsed_args = parse_cmd_args(['-c', cfg, '-P', pidfile, '-d', '-p', '4'])
 
         self.assertEqual(parsed_args.config, cfg)
         self.assertEqual(parsed_args.pidfile, pidfile)
         self.assertTrue(parsed_args.daemon)
+        self.assertEqual(parsed_args.processes, 4)
 
     def test_parse_cmd_args__full(self):
         cfg = '/conf'
@@ -187,6 +854,7 @@ class NotificationPusherTestCase(unittest.TestCase):
         self.assertEqual(parsed_args.config, cfg)
         self.assertEqual(parsed_args.pidfile, pidfile)
         self.assertFalse(parsed_args.daemon)
+        self.assertEqual(parsed_args.processes, 1)
 
     def test_daemonize_ok(self):
         pid = 42
@@ -317,30 +985,181 @@ class NotificationPusherTestCase(unittest.TestCase):
     def test_main__ok(self, mock_init):
         config = source.notification_pusher.Config()
         config.LOGGING = Mock()
+        config.METRICS_PORT = None
+        mock_init.return_value = config
         argv = list()
 
         with patch('source.notification_pusher.parse_cmd_args',
-                   Mock(return_value=Mock(daemon=True, pidfile=True))) as mock_parse:
+                   Mock(return_value=Mock(daemon=True, pidfile=True, processes=1))) as mock_parse:
             exit_code = main(argv)
 
         self.assertEquals(source.notification_pusher.exit_code, exit_code)
         mock_init.assert_called_once_with(mock_parse(argv))
 
-    @patch('source.notification_pusher.parse_cmd_args', Mock(return_value=Mock(daemon=True, pidfile=True)))
+    @patch('source.notification_pusher.parse_cmd_args', Mock(return_value=Mock(daemon=True, pidfile=True, processes=1)))
     @patch('source.notification_pusher.main_loop', Mock(side_effect=Exception))
     @patch('source.notification_pusher.init')
     def test_main__exception(self, mock_init):
         config = source.notification_pusher.Config()
         config.LOGGING = Mock()
         config.SLEEP_ON_FAIL = 42
+        config.METRICS_PORT = None
         mock_init.return_value = config
         argv = list()
 
         with patch('source.notification_pusher.parse_cmd_args',
-                   Mock(return_value=Mock(daemon=True, pidfile=True))) as mock_parse:
+                   Mock(return_value=Mock(daemon=True, pidfile=True, processes=1))) as mock_parse:
             with patch('source.notification_pusher.sleep', Mock(side_effect=app_stop)) as mock_sleep:
                 exit_code = main(argv)
 
         mock_sleep.assert_called_once_with(config.SLEEP_ON_FAIL)
         self.assertEquals(source.notification_pusher.exit_code, exit_code)
         mock_init.assert_called_once_with(mock_parse(argv))
+
+    @patch('source.notification_pusher.init')
+    def test_main__processes(self, mock_init):
+        with patch('source.notification_pusher.parse_cmd_args',
+                   Mock(return_value=Mock(daemon=False, pidfile=False, processes=3))):
+            with patch('source.notification_pusher.supervise') as mock_supervise:
+                with patch('source.notification_pusher.run_pusher') as mock_run_pusher:
+                    main([])
+
+        mock_supervise.assert_called_once_with(mock_init(), 3)
+        self.assertFalse(mock_run_pusher.called)
+
+    def test_spawn_pusher_process_parent(self):
+        with patch('os.fork', Mock(return_value=MAGIC_NUMBER)):
+            with patch('source.notification_pusher.run_pusher') as mock_run_pusher:
+                pid = spawn_pusher_process(Mock(), 0)
+
+        self.assertEqual(pid, MAGIC_NUMBER)
+        self.assertFalse(mock_run_pusher.called)
+
+    def test_spawn_pusher_process_child(self):
+        config = Mock(METRICS_PORT=None)
+
+        with patch('os.fork', Mock(return_value=0)):
+            with patch('os._exit') as os_exit:
+                with patch('source.notification_pusher.exit_code', MAGIC_NUMBER):
+                    with patch('source.notification_pusher.run_pusher') as mock_run_pusher:
+                        with patch('source.notification_pusher.logging.shutdown') as mock_shutdown:
+                            spawn_pusher_process(config, 0)
+
+        mock_run_pusher.assert_called_once_with(config)
+        mock_shutdown.assert_called_once_with()
+        os_exit.assert_called_once_with(MAGIC_NUMBER)
+
+    def test_spawn_pusher_process_child_exception(self):
+        with patch('os.fork', Mock(return_value=0)):
+            with patch('os._exit') as os_exit:
+                with patch('source.notification_pusher.run_pusher', Mock(side_effect=KeyboardInterrupt)):
+                    with patch('source.notification_pusher.logging.shutdown'):
+                        self.assertRaises(KeyboardInterrupt, spawn_pusher_process, Mock(METRICS_PORT=None), 0)
+
+        os_exit.assert_called_once_with(1)
+
+    def test_spawn_pusher_process_child_metrics_port(self):
+        config = Mock(METRICS_PORT=9101)
+
+        with patch('os.fork', Mock(return_value=0)):
+            with patch('os._exit'):
+                with patch('source.notification_pusher.run_pusher'):
+                    with patch('source.notification_pusher.logging.shutdown'):
+                        spawn_pusher_process(config, 2)
+
+        self.assertEqual(config.METRICS_PORT, 9103)
+
+    def test_start_metrics_server_disabled(self):
+        self.assertIsNone(start_metrics_server(Mock(METRICS_PORT=None)))
+
+    def test_start_metrics_server(self):
+        config = Mock(METRICS_HOST='127.0.0.1', METRICS_PORT=9101)
+        pywsgi = Mock()
+
+        with patch.dict('sys.modules', {'gevent.pywsgi': pywsgi}):
+            server = start_metrics_server(config)
+
+        pywsgi.WSGIServer.assert_called_once_with(('127.0.0.1', 9101), source.notification_pusher.metrics, log=None)
+        self.assertIs(server, pywsgi.WSGIServer())
+        server.start.assert_called_once_with()
+
+    def test_run_pusher_stops_metrics_server(self):
+        config = Mock()
+
+        with patch('source.notification_pusher.start_metrics_server') as mock_start_metrics_server:
+            with patch('source.notification_pusher.main_loop', Mock(side_effect=app_stop)):
+                with patch('source.notification_pusher.run_application', True):
+                    run_pusher(config)
+
+        mock_start_metrics_server.assert_called_once_with(config)
+        mock_start_metrics_server().stop.assert_called_once_with()
+
+    def test_reap_pusher_processes(self):
+        processes = {1: 0, 2: 1}
+
+        with patch('os.waitpid', Mock(side_effect=[(1, 256), (0, 0)])):
+            reap_pusher_processes(processes)
+
+        self.assertEqual(processes, {2: 1})
+
+    def test_reap_pusher_processes_no_children(self):
+        processes = {1: 0}
+
+        with patch('os.waitpid', Mock(side_effect=OSError)):
+            reap_pusher_processes(processes)
+
+        self.assertEqual(processes, {})
+
+    def test_supervise(self):
+        config = Mock(SLEEP=0, PROCESS_RESTART_BASE_DELAY=0, PROCESS_RESTART_MAX_DELAY=60)
+        pids = iter([10, 11, 12])
+
+        calls = []
+
+        def reap(processes):
+            calls.append(processes)
+            if len(calls) == 1:
+                del processes[10]
+            elif len(calls) == 2:
+                source.notification_pusher.stop_handler(15)
+            else:
+                processes.clear()
+
+        with patch('source.notification_pusher.run_application', True):
+            with patch('source.notification_pusher.exit_code', 0):
+                with patch('source.notification_pusher.spawn_pusher_process',
+                           Mock(side_effect=lambda *args: next(pids))) as mock_spawn:
+                    with patch('source.notification_pusher.reap_pusher_processes', Mock(side_effect=reap)):
+                        with patch('source.notification_pusher.sleep'):
+                            with patch('os.kill') as os_kill:
+                                supervise(config, 2)
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(mock_spawn.call_args_list, [((config, 0),), ((config, 1),), ((config, 0),)])
+        self.assertEqual(sorted(os_kill.call_args_list), [((11, 15),), ((12, 15),)])
+
+    def test_supervise_restart_backoff(self):
+        config = Mock(SLEEP=0, PROCESS_RESTART_BASE_DELAY=1, PROCESS_RESTART_MAX_DELAY=60)
+        calls = []
+
+        def reap(processes):
+            # every process fails at startup
+            calls.append(processes)
+            processes.clear()
+            if len(calls) == 5:
+                source.notification_pusher.stop_handler(15)
+
+        with patch('source.notification_pusher.run_application', True):
+            with patch('source.notification_pusher.exit_code', 0):
+                with patch('source.notification_pusher.spawn_pusher_process',
+                           Mock(side_effect=[10, 11])) as mock_spawn:
+                    with patch('source.notification_pusher.reap_pusher_processes', Mock(side_effect=reap)):
+                        with patch('source.notification_pusher.sleep'):
+                            with patch('source.notification_pusher.time', Mock(side_effect=[0, 0.5, 1, 1.5, 2])):
+                                with patch('source.notification_pusher.logger') as mock_logger:
+                                    supervise(config, 1)
+
+        # restarted 1 second after the first crash, the next restart is delayed by 2 seconds
+        self.assertEqual(mock_spawn.call_count, 2)
+        self.assertEqual(mock_logger.error.call_count, 2)
+        self.assertIn('restart in 2s', mock_logger.error.call_args[0][0])
@@ -1,12 +1,13 @@
 import unittest
 from mock import Mock, patch
+from source.lib.worker import green_worker
 from source.redirect_checker import main_loop, main
 
 
 class RedirectCheckerTestCase(unittest.TestCase):
 
     def run_main_loop(self, worker_pool_size):
-        config = Mock(WORKER_POOL_SIZE=worker_pool_size, SLEEP=0)
+        config = Mock(WORKER_POOL_SIZE=worker_pool_size, SLEEP=0, REDIRECT_CACHE_SHARED=False, WORKER_GREENLETS=1)
         with patch('source.redirect_checker.sleep', side_effect=KeyboardInterrupt):
             with self.assertRaises(KeyboardInterrupt):
                 main_loop(config)
@@ -18,6 +19,34 @@ class RedirectCheckerTestCase(unittest.TestCase):
         self.run_main_loop(3)
         self.assertEqual(mock_spawn_workers.call_count, 1)
 
+    @patch('source.redirect_checker.spawn_workers')
+    @patch('source.redirect_checker.check_network_status')
+    def test_main_loop_worker_greenlets(self, mock_check_network_status, mock_spawn_workers):
+        mock_check_network_status.return_value = True
+        config = Mock(WORKER_POOL_SIZE=3, SLEEP=0, REDIRECT_CACHE_SHARED=False, WORKER_GREENLETS=100)
+
+        with patch('source.redirect_checker.sleep', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                main_loop(config)
+
+        self.assertIs(green_worker, mock_spawn_workers.call_args[1]['target'])
+
+    @patch('source.redirect_checker.spawn_workers')
+    @patch('source.redirect_checker.check_network_status')
+    def test_main_loop_shared_cache(self, mock_check_network_status, mock_spawn_workers):
+        mock_check_network_status.return_value = True
+        config = Mock(WORKER_POOL_SIZE=3, SLEEP=0, REDIRECT_CACHE_SHARED=True, WORKER_GREENLETS=1,
+                      REDIRECT_CACHE_SIZE=10, REDIRECT_CACHE_TTL=60)
+        cache = Mock()
+
+        with patch('source.redirect_checker.sleep', side_effect=KeyboardInterrupt):
+            with patch('source.redirect_checker.start_shared_cache', return_value=cache) as start_shared_cache:
+                with self.assertRaises(KeyboardInterrupt):
+                    main_loop(config)
+
+        start_shared_cache.assert_called_once_with(10, 60)
+        self.assertEqual({'cache': cache}, mock_spawn_workers.call_args[1]['kwargs'])
+
     @patch('source.redirect_checker.spawn_workers')
     @patch('source.redirect_checker.check_network_status')
     def test_main_loop_ok_network_no_spawning(self, mock_check_network_status, mock_spawn_workers):
@@ -30,7 +59,7 @@ class RedirectCheckerTestCase(unittest.TestCase):
     def test_main_loop_network_not_ok(self, mock_check_network_status, mock_spawn_workers):
         mock_check_network_status.return_value = False
 
-        config = Mock(WORKER_POOL_SIZE=3, SLEEP=0)
+        config = Mock(WORKER_POOL_SIZE=3, SLEEP=0, REDIRECT_CACHE_SHARED=False, WORKER_GREENLETS=1)
         child = Mock()
 
         with patch('source.redirect_checker.sleep', side_effect=KeyboardInterrupt):